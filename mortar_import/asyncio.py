@@ -0,0 +1,110 @@
+import asyncio
+from inspect import isawaitable
+from typing import (
+    Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, Sequence, Union
+)
+
+from .diff import Diff, Change, Counts, OPS, chunks
+from .spill import Entry
+from .typing import Existing, Imported
+
+
+class AsyncDiff(Diff):
+    """
+    A :class:`Diff` for use with asyncio, where ``existing`` and ``imported``
+    may be async iterables and ``add``, ``update`` and ``delete``, or their
+    ``*_many`` counterparts, are coroutine functions.
+    """
+
+    # The number of add, update or delete coroutines, or batches if the
+    # *_many hooks are provided, that may be running at once in each phase.
+    # Each phase still finishes before the next begins:
+    concurrency: int = 10
+
+    def __init__(
+            self,
+            existing: Union[Iterable[Existing], AsyncIterator[Existing]],
+            imported: Union[Iterable[Imported], AsyncIterator[Imported]],
+    ):
+        for name in 'sorted_inputs', 'spill_after', 'streaming':
+            if getattr(self, name):
+                raise TypeError(name + ' cannot be used with AsyncDiff')
+        super(AsyncDiff, self).__init__(existing, imported)
+
+    async def _extract_async(self, name: str) -> AsyncIterator[Entry]:
+        objects = getattr(self, name)
+        if not hasattr(objects, '__aiter__'):
+            for entry in self._extract(name):
+                yield entry
+            return
+        extract = getattr(self, 'extract_' + name)
+        async for raw in objects:
+            extracted = extract(raw)
+            if extracted is None:
+                continue
+            key, extracted = extracted
+            yield key, raw, extracted
+
+    async def compute(self) -> None:
+        # imported is indexed, with any problems dealt with, before existing
+        # is extracted, so that existing objects can be limited to those with
+        # imported keys:
+        imported = [entry async for entry in self._extract_async('imported')]
+        self._index(('imported',), sources={'imported': imported})
+        existing = [entry async for entry in self._extract_async('existing')]
+        self._index(('existing',), sources={'existing': existing})
+        self.to_add = list(self._mapped('add'))
+        self.to_update = list(self._mapped('update'))
+        self.to_delete = list(self._mapped('delete'))
+        self._release()
+
+    def iter_changes(self, ops: Sequence[str] = OPS) -> Iterator[Change]:
+        raise TypeError('AsyncDiff must be awaited, use compute() or apply() instead')
+
+    async def _run(
+            self, handle: Callable[[Any], Awaitable[None]], items: Iterable
+    ) -> None:
+        # Run handle for each item with no more than concurrency running at
+        # once, cancelling the rest if any of them fail:
+        pending = set()
+        try:
+            for item in items:
+                if len(pending) >= self.concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        task.result()
+                pending.add(asyncio.ensure_future(handle(item)))
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_EXCEPTION
+                )
+                for task in done:
+                    task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    async def apply(self) -> Counts:
+        if self.to_add is None:
+            await self.compute()
+        counts = {}
+        for op in OPS:
+            changes = getattr(self, 'to_' + op)
+            many = getattr(self, op + '_many')
+            if many is None:
+                meth = getattr(self, op)
+                await self._run(lambda change: meth(*change), changes)
+            else:
+                await self._run(many, chunks(changes, self.batch_size))
+            counts[op] = len(changes)
+            post = getattr(self, 'post_' + op)
+            if post is not None:
+                result = post()
+                if isawaitable(result):
+                    await result
+        self.applied = True
+        return Counts(**counts)
@@ -0,0 +1,253 @@
+from typing import (
+    Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Sequence, Tuple, Union
+)
+
+import numpy as np
+
+from .diff import Diff, Addition, Update, Deletion, Change, chunks
+from .typing import Key
+
+Columns = Dict[str, np.ndarray]
+Source = Union[Mapping[str, Sequence], Iterable[Union[Mapping[str, Any], NamedTuple]]]
+
+
+def to_column(values: Sequence) -> np.ndarray:
+    """
+    Return ``values`` as an array. Values of more than one type, such as ints
+    and floats, are kept as they are in an array of objects rather than being
+    converted to a common type, so that ``3`` doesn't become ``3.0``.
+    """
+    if isinstance(values, np.ndarray):
+        return values
+    values = list(values)
+    if len({type(value) for value in values}) > 1:
+        column = np.empty(len(values), object)
+        for i, value in enumerate(values):
+            column[i] = value
+        return column
+    return np.asarray(values)
+
+
+def to_columns(source: Source) -> Columns:
+    """
+    Return ``source`` as a dict of field name to array of values, made using
+    :func:`to_column`. ``source`` can be a mapping of field name to column of
+    values, or records that are either all dicts or all named tuples with the
+    same fields, such as those returned by
+    :class:`~mortar_import.extractors.DictExtractor` or taken by
+    :class:`~mortar_import.extractors.NamedTupleExtractor`.
+    """
+    if isinstance(source, Mapping):
+        return {name: to_column(values) for name, values in source.items()}
+    records = list(source)
+    if not records:
+        return {}
+    first = records[0]
+    if isinstance(first, tuple):
+        return {
+            name: to_column(values)
+            for name, values in zip(first._fields, zip(*records))
+        }
+    return {name: to_column([record[name] for record in records]) for name in first}
+
+
+class ColumnarDiff(Diff):
+    """
+    A :class:`Diff` for flat tables where every existing and imported record
+    has the same fields. Each side is turned into columns using
+    :func:`to_columns`, keys are matched by sorting and changed rows are found
+    by comparing whole columns at once. Changes are only built for the rows
+    that have them, with the position of the row as the raw object and a dict
+    of its fields as the extracted one.
+
+    :meth:`differs` is not used: a row is updated if any of its fields are
+    not equal to those imported.
+    """
+
+    # The names of the fields that make up the key of each record. If there
+    # is only one, the key is its value rather than a tuple:
+    key_fields: Sequence[str] = None
+
+    def __init__(self, existing: Source, imported: Source):
+        if self.key_fields is None:
+            raise TypeError('key_fields must be specified')
+        for name in 'sorted_inputs', 'spill_after', 'snapshot', 'processes', 'threads':
+            if getattr(self, name):
+                raise TypeError(name + ' cannot be used with ColumnarDiff')
+        for name in 'existing', 'imported':
+            if getattr(self, 'handle_' + name + '_problem', None):
+                raise TypeError(
+                    'handle_' + name + '_problem cannot be used with ColumnarDiff'
+                )
+        super(ColumnarDiff, self).__init__(to_columns(existing), to_columns(imported))
+
+    def _length(self, name: str) -> int:
+        columns = getattr(self, name)
+        if not columns:
+            return 0
+        return len(columns[self.key_fields[0]])
+
+    def _rows(
+            self, name: str, positions: np.ndarray
+    ) -> Iterator[Tuple[Key, int, Dict[str, Any]]]:
+        # Build the key and extracted dict for each row at positions, a batch
+        # at a time so that only the values needed are turned into objects:
+        columns = getattr(self, name)
+        for batch in chunks(positions.tolist(), self.batch_size):
+            values = {
+                field: column[batch].tolist() for field, column in columns.items()
+            }
+            for i, position in enumerate(batch):
+                extracted = {field: values[field][i] for field in columns}
+                if len(self.key_fields) == 1:
+                    key = extracted[self.key_fields[0]]
+                else:
+                    key = tuple(extracted[field] for field in self.key_fields)
+                yield key, position, extracted
+
+    def _extract_row(self, name: str, position: int) -> Tuple[Key, Dict[str, Any]]:
+        key, _, extracted = next(self._rows(name, np.array([position])))
+        return key, extracted
+
+    def extract_existing(self, position: int) -> Tuple[Key, Dict[str, Any]]:
+        """
+        Return the key and fields of the existing row at ``position``.
+        """
+        return self._extract_row('existing', position)
+
+    def extract_imported(self, position: int) -> Tuple[Key, Dict[str, Any]]:
+        """
+        Return the key and fields of the imported row at ``position``.
+        """
+        return self._extract_row('imported', position)
+
+    def _codes(self) -> Tuple[np.ndarray, np.ndarray, int]:
+        # Number the distinct keys across both sides, in key order when the
+        # ordering is 'sorted', returning the number of each existing and
+        # imported row's key and how many distinct keys there are:
+        sizes = self._length('existing'), self._length('imported')
+        columns = {
+            field: [
+                getattr(self, name)[field]
+                for name, size in zip(('existing', 'imported'), sizes) if size
+            ]
+            for field in self.key_fields
+        }
+        if not any(sizes):
+            return np.zeros(0, np.intp), np.zeros(0, np.intp), 0
+        # numpy can only number keys without changing them when every column
+        # holds the same kind of values, such as all ints or all strings:
+        if any(
+            len({column.dtype.kind for column in values}) > 1 or
+            values[0].dtype.kind == 'O'
+            for values in columns.values()
+        ):
+            return self._object_codes(columns, sizes[0])
+        per_field = []
+        for values in columns.values():
+            _, codes = np.unique(np.concatenate(values), return_inverse=True)
+            per_field.append(codes.reshape(-1))
+        if len(per_field) == 1:
+            codes = per_field[0]
+        else:
+            _, codes = np.unique(
+                np.stack(per_field, axis=1), axis=0, return_inverse=True
+            )
+            codes = codes.reshape(-1)
+        return codes[:sizes[0]], codes[sizes[0]:], int(codes.max(initial=-1)) + 1
+
+    def _object_codes(
+            self, columns: Dict[str, List[np.ndarray]], size: int
+    ) -> Tuple[np.ndarray, np.ndarray, int]:
+        # Number the keys using a dict of the Python values, so that they are
+        # matched as they would be by Diff, such as 1 not matching '1':
+        keys = zip(*(
+            [value for column in values for value in column.tolist()]
+            for values in columns.values()
+        ))
+        if len(self.key_fields) == 1:
+            keys = (key for key, in keys)
+        numbers = {}
+        codes = np.fromiter(
+            (numbers.setdefault(key, len(numbers)) for key in keys), np.intp
+        )
+        if self.ordering == 'sorted':
+            order = np.empty(len(numbers), np.intp)
+            order[[numbers[key] for key in sorted(numbers)]] = np.arange(len(numbers))
+            codes = order[codes]
+        return codes[:size], codes[size:], len(numbers)
+
+    def _check_duplicates(self, codes: Dict[str, np.ndarray], count: int) -> None:
+        lines = []
+        for name in 'existing', 'imported':
+            duplicated = np.flatnonzero(np.bincount(codes[name], minlength=count) > 1)
+            for code in duplicated.tolist():
+                positions = np.flatnonzero(codes[name] == code)
+                rows = list(self._rows(name, positions))
+                key = rows[0][0]
+                dups = [(position, extracted) for _, position, extracted in rows]
+                lines.append((key, self._problem_line(name, key, dups)))
+        if lines:
+            if self.ordering == 'sorted':
+                lines.sort(key=lambda item: item[0])
+            raise AssertionError('\n'.join(line for _, line in lines))
+
+    def _changed(self, existing: np.ndarray, imported: np.ndarray) -> np.ndarray:
+        # Which of the pairs of existing and imported rows at these positions
+        # have any fields that differ:
+        if set(self.existing) != set(self.imported):
+            return np.ones(len(existing), bool)
+        changed = np.zeros(len(existing), bool)
+        for field, column in self.existing.items():
+            changed |= np.asarray(column[existing] != self.imported[field][imported])
+        return changed
+
+    def _join(self) -> Dict[str, np.ndarray]:
+        existing_codes, imported_codes, count = self._codes()
+        self._check_duplicates(
+            {'existing': existing_codes, 'imported': imported_codes}, count
+        )
+        # the position of the row with each key on each side, or -1:
+        existing = np.full(count, -1, np.intp)
+        existing[existing_codes] = np.arange(len(existing_codes))
+        imported = np.full(count, -1, np.intp)
+        imported[imported_codes] = np.arange(len(imported_codes))
+
+        if self.ordering not in ('sorted', None, 'existing', 'imported'):
+            raise ValueError('Unknown ordering: {!r}'.format(self.ordering))
+
+        def ordered(codes: np.ndarray, name: str) -> np.ndarray:
+            # codes are already in key order:
+            if self.ordering in ('existing', 'imported'):
+                positions = existing if name == 'existing' else imported
+                return codes[np.argsort(positions[codes], kind='stable')]
+            return codes
+
+        added = ordered(np.flatnonzero((imported >= 0) & (existing < 0)), 'imported')
+        deleted = ordered(np.flatnonzero((existing >= 0) & (imported < 0)), 'existing')
+        matched = np.flatnonzero((existing >= 0) & (imported >= 0))
+        matched = matched[self._changed(existing[matched], imported[matched])]
+        updated = ordered(matched, self.ordering)
+        return {
+            'add': imported[added],
+            'update': np.stack([existing[updated], imported[updated]]),
+            'delete': existing[deleted],
+        }
+
+    def _changes(self, op: str, positions: np.ndarray) -> Iterator[Change]:
+        if op == 'add':
+            for row in self._rows('imported', positions):
+                yield Addition(*row)
+        elif op == 'update':
+            existing = self._rows('existing', positions[0])
+            imported = self._rows('imported', positions[1])
+            for (key, e, e_extracted), (_, i, i_extracted) in zip(existing, imported):
+                yield Update(key, e, e_extracted, i, i_extracted)
+        else:
+            for row in self._rows('existing', positions):
+                yield Deletion(*row)
+
+    def _classified(self, ops: Sequence[str]) -> Iterator[Tuple[str, Iterable[Change]]]:
+        positions = self._join()
+        for op in ops:
+            yield op, self._changes(op, positions[op])
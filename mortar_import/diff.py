@@ -1,10 +1,35 @@
 from abc import ABC, abstractmethod
-from collections import defaultdict
-from typing import Tuple, List, Set, Dict, Callable, NamedTuple, Sequence
+from collections import defaultdict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+)
+from copy import copy
+from heapq import heappop, heappush
+from itertools import count, groupby, islice
+from operator import itemgetter
+from typing import (
+    Tuple, List, Set, Dict, Callable, NamedTuple, Sequence, Iterator, Iterable,
+    Optional, Union, Any, Mapping, TypeVar
+)
 
+from .snapshot import Snapshot, digest
+from .spill import Spill, Entry
 from .typing import Existing, Imported, ExtractedExisting, ExtractedImported, Key
 
 
+def changed_fields(
+        existing: Mapping[str, Any], imported: Mapping[str, Any]
+) -> Set[str]:
+    """
+    Return the names of the fields in ``imported`` that are either missing
+    from ``existing`` or have a different value there.
+    """
+    return {
+        name for name, value in imported.items()
+        if name not in existing or existing[name] != value
+    }
+
+
 class Addition(NamedTuple):
     key: Key
     imported: Imported
@@ -18,6 +43,14 @@ class Update(NamedTuple):
     imported: Imported
     imported_extracted: ExtractedImported
 
+    @property
+    def changed(self) -> Set[str]:
+        """
+        The names of the fields that have changed, for use when both
+        extracted values are mappings.
+        """
+        return changed_fields(self.existing_extracted, self.imported_extracted)
+
 
 class Deletion(NamedTuple):
     key: Key
@@ -25,6 +58,58 @@ class Deletion(NamedTuple):
     existing_extracted: ExtractedExisting
 
 
+class Counts(NamedTuple):
+    add: int
+    update: int
+    delete: int
+
+
+Change = Union[Addition, Update, Deletion]
+
+T = TypeVar('T')
+
+OPS = 'delete', 'update', 'add'
+CHANGE_TYPES = {'add': Addition, 'update': Update, 'delete': Deletion}
+
+# The fewest partitions used when spilling, unless spill_partitions is set:
+SPILL_PARTITIONS = 16
+
+
+def chunks(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Yield lists of up to ``size`` items from ``iterable``.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _duplicate_key(key: Key) -> ValueError:
+    return ValueError('Problem handling for {!r} resulted in duplicate key'.format(key))
+
+
+def _partitions(spills: Dict[str, Spill]) -> int:
+    # Every side is spilled to the same number of partitions:
+    return next(iter(spills.values())).partitions
+
+
+# The diff used for extraction in each worker process:
+_worker_diff: Optional['Diff'] = None
+
+
+def _start_worker(diff: 'Diff') -> None:
+    global _worker_diff
+    _worker_diff = diff
+
+
+def _extract_batch(name: str, objects: List[Any]) -> List[Optional[Tuple[Key, Any]]]:
+    extract = getattr(_worker_diff, 'extract_' + name)
+    return [extract(obj) for obj in objects]
+
+
 class Diff(ABC):
 
     # Used internally:
@@ -32,13 +117,76 @@ class Diff(ABC):
     existing_keys: Set[Key]
     imported_mapping: Dict[Key, Tuple[Imported, ExtractedImported]]
     imported_keys: Set[Key]
+    candidate_keys: Optional[Set[Key]] = None
+    snapshot_digests: Optional[Dict[Key, bytes]] = None
+    # set by apply(), so that save_snapshot() only records applied imports:
+    applied: bool = False
 
     # Populated by :meth:`compute`:
     to_add: List[Addition] = None
     to_update: List[Update] = None
     to_delete: List[Deletion] = None
 
+    # If both existing and imported are sorted by key, setting this to True
+    # will walk them in step rather than building mappings of both. Keys
+    # returned by handle_*_problem are merged back into place, so may sort
+    # after later keys, but not before keys that have already been passed on:
+    sorted_inputs: bool = False
+
+    # The order in which changes are passed on when sorted_inputs is not set:
+    # 'sorted' by key, in the order of 'imported' or 'existing', where
+    # additions always follow imported and deletions always follow existing,
+    # or None for whatever order is quickest:
+    ordering: Optional[str] = 'sorted'
+
+    # Set to True to have apply() pass changes on as they are classified rather
+    # than building to_add, to_update and to_delete first:
+    streaming: bool = False
+
+    # If set to a Snapshot, imported objects whose digests match those of the
+    # last import applied are skipped, as are existing objects other than
+    # those with the remaining keys. This is only done when the snapshot is
+    # valid for the fingerprint returned by existing_fingerprint(). Call
+    # save_snapshot() once the changes made by apply() have been committed:
+    snapshot: Optional[Snapshot] = None
+
+    # Set to a number of objects to hold in memory from each side, when
+    # sorted_inputs is not set, before writing each side to a temporary file
+    # in spill_directory, partitioned by the hash of their keys, and comparing
+    # them one partition at a time. Raw and extracted objects must then be
+    # picklable and the ordering only applies within each partition:
+    spill_after: Optional[int] = None
+    # The number of partitions to spill to, or None to use at least 16 and as
+    # many more as are needed for each to hold about spill_after objects from
+    # each side:
+    spill_partitions: Optional[int] = None
+    spill_directory: Optional[str] = None
+
+    # Set to a number of processes to run extract_existing and extract_imported
+    # in a pool of that many processes, batch_size objects at a time. A copy of
+    # the diff, without its existing and imported objects, is sent to each
+    # process, so it must be picklable, as must the objects and what is
+    # extracted from them:
+    processes: Optional[int] = None
+
+    # Set to a number of threads to run extract_existing and extract_imported
+    # on that many objects at once, for extractors that wait on I/O. Objects
+    # are passed on in the order they came in unless threads_ordered is
+    # False, when each is passed on as soon as it has been extracted:
+    threads: Optional[int] = None
+    threads_ordered: bool = True
+
     def __init__(self, existing: Sequence[Existing], imported: Sequence[Existing]):
+        if self.snapshot is not None:
+            if self.sorted_inputs:
+                raise TypeError('snapshot cannot be used with sorted_inputs')
+            if self.spill_after is not None:
+                raise TypeError('snapshot cannot be used with spill_after')
+        if self.threads is not None:
+            if self.processes is not None:
+                raise TypeError('threads cannot be used with processes')
+            if self.sorted_inputs and not self.threads_ordered:
+                raise TypeError('threads_ordered must be set when using sorted_inputs')
         self.existing = existing
         self.imported = imported
 
@@ -95,95 +243,572 @@ class Diff(ABC):
         Handle the deletion of an existing object.
         """
 
+    def differs(
+            self,
+            existing_extracted: ExtractedExisting,
+            imported_extracted: ExtractedImported,
+    ) -> bool:
+        """
+        Return ``True`` if the existing object needs to be updated to match
+        the imported object.
+        """
+        return existing_extracted != imported_extracted
+
+    def existing_fingerprint(self) -> Any:
+        """
+        Return a value that changes whenever the existing objects change
+        other than through this diff, so that a :attr:`snapshot` can be
+        checked. ``None`` means a snapshot can never be used.
+        """
+        return None
+
     post_add: Callable[[], None] = None
     post_update: Callable[[], None] = None
     post_delete: Callable[[], None] = None
 
-    def compute(self) -> None:
-        problems = defaultdict(list)
-        for name in 'existing', 'imported':
+    # If provided, these are used in place of add, update and delete and are
+    # passed lists of up to batch_size changes at a time:
+    add_many: Callable[[List[Addition]], None] = None
+    update_many: Callable[[List[Update]], None] = None
+    delete_many: Callable[[List[Deletion]], None] = None
+    batch_size: int = 1000
+
+    def _extract(self, name: str) -> Iterator[Entry]:
+        if self.processes is not None:
+            return self._extract_in_processes(name)
+        if self.threads is not None:
+            return self._extract_in_threads(name)
+        return self._extracted(name, getattr(self, name))
+
+    def _extracted(self, name: str, objects: Iterable[Any]) -> Iterator[Entry]:
+        extract = getattr(self, 'extract_' + name)
+        for raw in objects:
+            extracted = extract(raw)
+            if extracted is None:
+                continue
+            key, extracted = extracted
+            yield key, raw, extracted
+
+    def _worker(self) -> 'Diff':
+        worker = copy(self)
+        for name in (
+            'existing', 'imported',
+            'existing_mapping', 'existing_keys', 'imported_mapping', 'imported_keys',
+            'candidate_keys', 'snapshot_digests', 'to_add', 'to_update', 'to_delete',
+        ):
+            if name in worker.__dict__:
+                setattr(worker, name, None)
+        worker.processes = None
+        return worker
+
+    def _extract_in_processes(self, name: str) -> Iterator[Entry]:
+        # Only keys and extracted values come back from the workers, so the
+        # changes refer to the original objects:
+        with ProcessPoolExecutor(
+                self.processes, initializer=_start_worker, initargs=(self._worker(),)
+        ) as executor:
+            pending = deque()
+            for batch in chunks(getattr(self, name), self.batch_size):
+                pending.append((batch, executor.submit(_extract_batch, name, batch)))
+                if len(pending) > self.processes * 2:
+                    batch, future = pending.popleft()
+                    yield from self._paired(batch, future.result())
+            while pending:
+                batch, future = pending.popleft()
+                yield from self._paired(batch, future.result())
+
+    def _extract_in_threads(self, name: str) -> Iterator[Entry]:
+        extract = getattr(self, 'extract_' + name)
+        limit = self.threads * 2
+        with ThreadPoolExecutor(self.threads) as executor:
+            if self.threads_ordered:
+                pending = deque()
+                for raw in getattr(self, name):
+                    pending.append((raw, executor.submit(extract, raw)))
+                    if len(pending) > limit:
+                        raw, future = pending.popleft()
+                        yield from self._paired([raw], [future.result()])
+                while pending:
+                    raw, future = pending.popleft()
+                    yield from self._paired([raw], [future.result()])
+            else:
+                running: Dict[Future, Any] = {}
+                for raw in getattr(self, name):
+                    running[executor.submit(extract, raw)] = raw
+                    if len(running) > limit:
+                        yield from self._completed(running)
+                while running:
+                    yield from self._completed(running)
+
+    def _completed(self, running: Dict[Future, Any]) -> Iterator[Entry]:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield from self._paired([running.pop(future)], [future.result()])
+
+    @staticmethod
+    def _paired(
+            objects: List[Any], results: List[Optional[Tuple[Key, Any]]]
+    ) -> Iterator[Entry]:
+        for raw, extracted in zip(objects, results):
+            if extracted is None:
+                continue
+            key, extracted = extracted
+            yield key, raw, extracted
+
+    def _handle_problem(
+            self, name: str, key: Key, dups: List[Tuple[Any, Any]]
+    ) -> Optional[Iterable[Tuple[Key, Any, Any]]]:
+        handler = getattr(self, 'handle_' + name + '_problem', None)
+        if handler:
+            result = handler(key, dups)
+            if result:
+                return result
+        return None
+
+    @staticmethod
+    def _problem_line(name: str, key: Key, dups: List[Tuple[Any, Any]]) -> str:
+        return "{key!r} occurs {len} times in {name}: {repr}".format(
+            key=key,
+            len=len(dups),
+            name=name,
+            repr=', '.join(
+                repr(extracted) + ' from ' + repr(raw)
+                for raw, extracted in dups
+            ),
+        )
+
+    def _imported_first(self) -> bool:
+        # Whether imported must be extracted before existing, so that its
+        # keys can be used to limit the existing objects that are loaded:
+        return self.snapshot is not None
+
+    def _extraction_order(self) -> Tuple[str, str]:
+        if self._imported_first():
+            return 'imported', 'existing'
+        return 'existing', 'imported'
+
+    def _index(
+            self,
+            names: Optional[Sequence[str]] = None,
+            sources: Optional[Dict[str, Iterable[Entry]]] = None,
+    ) -> None:
+        if names is None:
+            names = self._extraction_order()
+        if 'imported' in names:
+            self.candidate_keys = self.snapshot_digests = None
+        lines = []
+        for name in names:
+            if name == 'existing' and self.snapshot is not None and not lines:
+                self._check_snapshot()
             mapping = {}
-            sequence = getattr(self, name)
-            extract = getattr(self, 'extract_' + name)
-            for raw in sequence:
-                extracted = extract(raw)
-                if extracted is None:
+            dups = defaultdict(list)
+            entries = self._extract(name) if sources is None else sources[name]
+            for key, raw, extracted in entries:
+                if (name == 'existing' and self.candidate_keys is not None and
+                        key not in self.candidate_keys):
                     continue
-                key, extracted = extracted
                 if key in mapping:
-                    problems[name, key].append((raw, extracted))
+                    dups[key].append((raw, extracted))
                 else:
                     mapping[key] = raw, extracted
             setattr(self, name + '_mapping', mapping)
             setattr(self, name + '_keys', set(mapping))
+            # problems are dealt with before the next side is extracted, so
+            # that imported_keys is final by the time existing is:
+            lines.extend((name, line) for line in self._index_problems(name, dups))
 
-        if problems:
-            lines = []
-            for name_key, dups in sorted(problems.items()):
-                name, key = name_key
-                mapping = getattr(self, name + '_mapping')
-                keys = getattr(self, name + '_keys')
-                dups.insert(0, mapping[key])
-
-                handler = getattr(self, 'handle_' + name + '_problem', None)
-                if handler:
-                    result = handler(key, dups)
-                    if result:
-                        del mapping[key]
-                        keys.remove(key)
-                        for key, raw, extracted in result:
-                            if key in mapping:
-                                raise ValueError(
-                                    (
-                                        'Problem handling for {!r} '
-                                        'resulted in duplicate key'
-                                    ).format(key)
-                                )
-                            mapping[key] = raw, extracted
-                            keys.add(key)
-                        continue
-
-                lines.append(
-                    "{key!r} occurs {len} times in {name}: {repr}".format(
-                        key=key,
-                        len=len(dups),
-                        name=name,
-                        repr=', '.join(
-                            repr(extracted) + ' from ' + repr(raw)
-                            for raw, extracted in dups
-                        ),
-                    )
-                )
-            if lines:
-                raise AssertionError('\n'.join(lines))
-
-        self.to_add = []
-        self.to_update = []
-        self.to_delete = []
-
-        for key in sorted(self.imported_keys - self.existing_keys):
-            self.to_add.append(Addition(key, *self.imported_mapping[key]))
-
-        for key in sorted(self.imported_keys & self.existing_keys):
-            existing, existing_extracted = self.existing_mapping[key]
-            imported, imported_extracted = self.imported_mapping[key]
-            if existing_extracted != imported_extracted:
-                self.to_update.append(
-                    Update(
+        if lines:
+            lines.sort(key=lambda item: item[0])
+            raise AssertionError('\n'.join(line for _, line in lines))
+
+        if self.snapshot is not None:
+            if 'imported' in names and self.snapshot_digests is None:
+                self.snapshot_digests = self._digests()
+            if self.candidate_keys is not None:
+                for key in self.imported_keys - self.candidate_keys:
+                    del self.imported_mapping[key]
+                self.imported_keys &= self.candidate_keys
+
+    def _index_problems(
+            self, name: str, problems: Dict[Key, List[Tuple[Any, Any]]]
+    ) -> Iterator[str]:
+        # Handle the duplicate keys found when indexing name, yielding a line
+        # for each that wasn't dealt with:
+        mapping = getattr(self, name + '_mapping')
+        keys = getattr(self, name + '_keys')
+        items = problems.items()
+        if self.ordering == 'sorted':
+            items = sorted(items)
+        for key, dups in items:
+            dups.insert(0, mapping[key])
+
+            result = self._handle_problem(name, key, dups)
+            if result is None:
+                yield self._problem_line(name, key, dups)
+                continue
+
+            del mapping[key]
+            keys.remove(key)
+            for new_key, raw, extracted in result:
+                if new_key in mapping:
+                    raise _duplicate_key(new_key)
+                mapping[new_key] = raw, extracted
+                keys.add(new_key)
+
+    def _digests(self) -> Dict[Key, bytes]:
+        return {
+            key: digest(extracted)
+            for key, (_, extracted) in self.imported_mapping.items()
+        }
+
+    def _check_snapshot(self) -> None:
+        self.snapshot_digests = self._digests()
+        if self.snapshot.valid(self.existing_fingerprint()):
+            self.candidate_keys = self.snapshot.changed(self.snapshot_digests)
+
+    def _spill(self) -> Optional[Dict[str, Spill]]:
+        # Extract both sides, only indexing them in memory if neither has
+        # more than spill_after objects:
+        held = {}
+        spills = {}
+        for name in self._extraction_order():
+            entries = []
+            spill = None
+            if spills:
+                spill = self._new_spill()
+            for entry in self._extract(name):
+                if spill is not None:
+                    spill.add(entry)
+                    continue
+                entries.append(entry)
+                if len(entries) > self.spill_after:
+                    spill = self._new_spill()
+                    spill.extend(entries)
+                    entries = None
+            if spill is None:
+                held[name] = entries
+            else:
+                spill.flush()
+                spills[name] = spill
+
+        if not spills:
+            self._index(sources=held)
+            return None
+
+        for name, entries in held.items():
+            spill = spills[name] = self._new_spill()
+            spill.extend(entries)
+            spill.flush()
+
+        if self.spill_partitions is None:
+            # now that the number of objects is known, spread them over more
+            # partitions if that's needed to keep each one within spill_after:
+            largest = max(len(spill) for spill in spills.values())
+            partitions = -(-largest // self.spill_after)
+            if partitions > SPILL_PARTITIONS:
+                for name, spill in spills.items():
+                    spills[name] = spill.repartitioned(partitions)
+        return spills
+
+    def _new_spill(self) -> Spill:
+        # only spill_after objects are held in memory before being written:
+        return Spill(
+            self.spill_partitions or SPILL_PARTITIONS,
+            self.spill_directory,
+            self.spill_after,
+        )
+
+    def _spilled_problems(
+            self, spills: Dict[str, Spill]
+    ) -> Tuple[Dict[str, Set[Key]], Dict[str, Dict[int, List[Entry]]]]:
+        # Find and handle duplicate keys before any changes are passed on,
+        # returning the keys to leave out and the entries to use instead,
+        # by partition:
+        problems = {}
+        for partition in range(_partitions(spills)):
+            for name, spill in spills.items():
+                mapping = {}
+                dups = defaultdict(list)
+                for key, raw, extracted in spill.entries(partition):
+                    if key in mapping:
+                        dups[key].append((raw, extracted))
+                    else:
+                        mapping[key] = raw, extracted
+                for key, entries in dups.items():
+                    entries.insert(0, mapping[key])
+                    problems[name, key] = entries
+
+        removed = {name: set() for name in spills}
+        replacements = {name: defaultdict(list) for name in spills}
+        if self.ordering == 'sorted':
+            items = sorted(problems.items())
+        else:
+            items = sorted(problems.items(), key=lambda item: item[0][0])
+        lines = []
+        for (name, key), dups in items:
+            result = self._handle_problem(name, key, dups)
+            if result is None:
+                lines.append(self._problem_line(name, key, dups))
+                continue
+            removed[name].add(key)
+            for entry in result:
+                replacements[name][spills[name].partition(entry[0])].append(entry)
+        if lines:
+            raise AssertionError('\n'.join(lines))
+
+        for name, by_partition in replacements.items():
+            for partition, entries in by_partition.items():
+                keys = {
+                    key for key, _, _ in spills[name].entries(partition)
+                    if key not in removed[name]
+                }
+                for key, _, _ in entries:
+                    if key in keys:
+                        raise _duplicate_key(key)
+                    keys.add(key)
+
+        return removed, replacements
+
+    def _spilled(
+            self,
+            op: str,
+            spills: Dict[str, Spill],
+            removed: Dict[str, Set[Key]],
+            replacements: Dict[str, Dict[int, List[Entry]]],
+    ) -> Iterator[Change]:
+        for partition in range(_partitions(spills)):
+            for name, spill in spills.items():
+                mapping = {
+                    key: (raw, extracted)
+                    for key, raw, extracted in spill.entries(partition)
+                    if key not in removed[name]
+                }
+                for key, raw, extracted in replacements[name].get(partition, ()):
+                    mapping[key] = raw, extracted
+                setattr(self, name + '_mapping', mapping)
+                setattr(self, name + '_keys', set(mapping))
+            yield from self._mapped(op)
+
+    def _release(self) -> None:
+        # Once classified, the changes hold everything that's needed, so drop
+        # the mappings to free the unchanged objects:
+        for name in 'existing', 'imported':
+            setattr(self, name + '_mapping', None)
+            setattr(self, name + '_keys', None)
+
+    def _ordered(self, keys: Set[Key], name: str) -> Iterable[Key]:
+        if self.ordering == 'sorted':
+            return sorted(keys)
+        if self.ordering is None:
+            return keys
+        if self.ordering not in ('existing', 'imported'):
+            raise ValueError('Unknown ordering: {!r}'.format(self.ordering))
+        return (key for key in getattr(self, name + '_mapping') if key in keys)
+
+    def _mapped(self, op: str) -> Iterator[Change]:
+        if op == 'add':
+            keys = self.imported_keys - self.existing_keys
+            for key in self._ordered(keys, 'imported'):
+                yield Addition(key, *self.imported_mapping[key])
+
+        elif op == 'update':
+            keys = self.imported_keys & self.existing_keys
+            for key in self._ordered(keys, self.ordering):
+                existing, existing_extracted = self.existing_mapping[key]
+                imported, imported_extracted = self.imported_mapping[key]
+                if self.differs(existing_extracted, imported_extracted):
+                    yield Update(
                         key, existing, existing_extracted, imported, imported_extracted
                     )
-                )
 
-        for key in sorted(self.existing_keys - self.imported_keys):
-            self.to_delete.append(Deletion(key, *self.existing_mapping[key]))
+        else:
+            keys = self.existing_keys - self.imported_keys
+            for key in self._ordered(keys, 'existing'):
+                yield Deletion(key, *self.existing_mapping[key])
+
+    def _sorted_side(
+            self, name: str, lines: List[str]
+    ) -> Iterator[Tuple[Key, Any, Any]]:
+        # entries from handle_*_problem, held until their keys come up, as
+        # (key, number, entry) so that the entries are never compared:
+        replacements = []
+        numbers = count()
+        previous = None
+
+        def checked(entry: Entry) -> Entry:
+            nonlocal previous
+            if previous is not None and not previous[0] < entry[0]:
+                if previous[0] == entry[0]:
+                    raise _duplicate_key(entry[0])
+                raise ValueError('{} is not sorted: {!r} follows {!r}'.format(
+                    name, entry[0], previous[0]
+                ))
+            previous = entry
+            return entry
+
+        for key, group in groupby(self._extract(name), key=itemgetter(0)):
+            entries = list(group)
+            if len(entries) > 1:
+                dups = [(raw, extracted) for _, raw, extracted in entries]
+                result = self._handle_problem(name, key, dups)
+                if result is None:
+                    lines.append(self._problem_line(name, key, dups))
+                else:
+                    for entry in result:
+                        if previous is not None and entry[0] < previous[0]:
+                            raise ValueError(
+                                'Problem handling for {!r} resulted in {!r}, which '
+                                'sorts before {!r} in {}'.format(
+                                    key, entry[0], previous[0], name
+                                )
+                            )
+                        heappush(replacements, (entry[0], next(numbers), entry))
+                entries = []
+            for entry in entries:
+                while replacements and not entry[0] < replacements[0][0]:
+                    yield checked(heappop(replacements)[2])
+                yield checked(entry)
+        while replacements:
+            yield checked(heappop(replacements)[2])
+
+    def _merge(self) -> Iterator[Change]:
+        existing_lines = []
+        imported_lines = []
+        existing = self._sorted_side('existing', existing_lines)
+        imported = self._sorted_side('imported', imported_lines)
+        e = next(existing, None)
+        i = next(imported, None)
+        while e is not None or i is not None:
+            if i is None or (e is not None and e[0] < i[0]):
+                yield Deletion(*e)
+                e = next(existing, None)
+            elif e is None or i[0] < e[0]:
+                yield Addition(*i)
+                i = next(imported, None)
+            else:
+                key, existing_raw, existing_extracted = e
+                _, imported_raw, imported_extracted = i
+                if self.differs(existing_extracted, imported_extracted):
+                    yield Update(
+                        key,
+                        existing_raw, existing_extracted,
+                        imported_raw, imported_extracted,
+                    )
+                e = next(existing, None)
+                i = next(imported, None)
+        lines = existing_lines + imported_lines
+        if lines:
+            raise AssertionError('\n'.join(lines))
+
+    def _check_sorted(self) -> None:
+        lines = []
+        for name in 'existing', 'imported':
+            for _ in self._sorted_side(name, lines):
+                pass
+        if lines:
+            raise AssertionError('\n'.join(lines))
 
-    def apply(self) -> None:
-        if self.to_add is None:
+    def _merged(self, op: str) -> Iterator[Change]:
+        change_type = CHANGE_TYPES[op]
+        return (change for change in self._merge() if type(change) is change_type)
+
+    def _phases(self, ops: Sequence[str]) -> Iterator[Tuple[str, Iterable[Change]]]:
+        if self.to_add is not None:
+            for op in ops:
+                yield op, getattr(self, 'to_' + op)
+        elif self.sorted_inputs:
+            if len(ops) > 1:
+                for name in 'existing', 'imported':
+                    if isinstance(getattr(self, name), Iterator):
+                        raise TypeError(
+                            name + ' must be re-iterable to stream changes '
+                                   'from sorted inputs'
+                        )
+                # walk both sides once so that problems are raised before
+                # any changes are passed on:
+                self._check_sorted()
+            for op in ops:
+                yield op, self._merged(op)
+        else:
+            yield from self._classified(ops)
+
+    def _classified(self, ops: Sequence[str]) -> Iterator[Tuple[str, Iterable[Change]]]:
+        spills = None
+        if self.spill_after is None:
+            self._index()
+        else:
+            spills = self._spill()
+        if spills is None:
+            for op in ops:
+                yield op, self._mapped(op)
+        else:
+            try:
+                removed, replacements = self._spilled_problems(spills)
+                for op in ops:
+                    yield op, self._spilled(op, spills, removed, replacements)
+            finally:
+                for spill in spills.values():
+                    spill.close()
+        self._release()
+
+    def iter_changes(self, ops: Sequence[str] = OPS) -> Iterator[Change]:
+        """
+        Yield the changes for each of the ``ops`` in turn, classifying
+        them as they are yielded rather than building lists of them.
+
+        When :attr:`sorted_inputs` is set, the existing and imported
+        sequences are walked once per op, so must be re-iterable.
+        """
+        for _, changes in self._phases(ops):
+            yield from changes
+
+    def compute(self) -> None:
+        if self.sorted_inputs:
+            to_add, to_update, to_delete = [], [], []
+            lists = {Addition: to_add, Update: to_update, Deletion: to_delete}
+            for change in self._merge():
+                lists[type(change)].append(change)
+        else:
+            lists = {}
+            for op, changes in self._classified(OPS):
+                lists[op] = list(changes)
+            to_add, to_update, to_delete = lists['add'], lists['update'], lists['delete']
+        self.to_add, self.to_update, self.to_delete = to_add, to_update, to_delete
+
+    def apply(self) -> Counts:
+        if self.to_add is None and not self.streaming:
             self.compute()
-        for op in 'delete', 'update', 'add':
-            meth = getattr(self, op)
-            for action in getattr(self, 'to_' + op):
-                meth(*action)
+        counts = {}
+        for op, changes in self._phases(OPS):
+            count = 0
+            many = getattr(self, op + '_many')
+            if many is None:
+                meth = getattr(self, op)
+                for action in changes:
+                    meth(*action)
+                    count += 1
+            else:
+                for batch in chunks(changes, self.batch_size):
+                    many(batch)
+                    count += len(batch)
+            counts[op] = count
             post = getattr(self, 'post_' + op)
             if post is not None:
                 post()
+        self.applied = True
+        return Counts(**counts)
+
+    def save_snapshot(self) -> None:
+        """
+        Record the import applied in :attr:`snapshot`, along with the current
+        fingerprint of the existing objects. This should only be called once
+        the changes made by :meth:`apply` have been committed, so that the
+        snapshot never describes changes that were rolled back.
+        """
+        if self.snapshot is None:
+            raise TypeError('snapshot is not set')
+        if not self.applied:
+            raise TypeError('save_snapshot() can only be called after apply()')
+        self.snapshot.save(self.snapshot_digests, self.existing_fingerprint())
+        self.snapshot_digests = None
+        self.applied = False
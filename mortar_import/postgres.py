@@ -0,0 +1,363 @@
+from enum import Enum
+from typing import Sequence, Iterator, Iterable, Any, List, Optional
+
+from psycopg2.extensions import Binary
+from psycopg2.extras import Range
+from sqlalchemy import (
+    JSON, Column, MetaData, Table, and_, cast, exists, func, inspect, literal_column,
+    select, tuple_
+)
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.orm import Session
+
+from .diff import Counts, Change, OPS, chunks
+from .sqlalchemy import SQLAlchemyDiff
+from .typing import Imported
+
+
+def text_value(value: Any) -> str:
+    """
+    Render a value that isn't ``None`` in the text form Postgres reads for
+    its type, once it has been through the column type's bind processor.
+    """
+    if isinstance(value, Binary):
+        value = value.adapted
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, Range):
+        if value.isempty:
+            return 'empty'
+        return '{}{},{}{}'.format(
+            '[' if value.lower_inc else '(',
+            '' if value.lower is None else quoted_text(value.lower),
+            '' if value.upper is None else quoted_text(value.upper),
+            ']' if value.upper_inc else ')',
+        )
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join(
+            'NULL' if element is None else
+            text_value(element) if isinstance(element, (list, tuple)) else
+            quoted_text(element)
+            for element in value
+        ) + '}'
+    return str(value)
+
+
+def quoted_text(value: Any) -> str:
+    """
+    Render ``value`` as a quoted element of an array or bound of a range.
+    """
+    return '"{}"'.format(
+        text_value(value).replace('\\', '\\\\').replace('"', '\\"')
+    )
+
+
+def copy_text(value: Any) -> str:
+    """
+    Render ``value`` in the text format used by Postgres' ``COPY``.
+    """
+    if value is None:
+        return '\\N'
+    return (
+        text_value(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+def distinct(columns: List[Column], others: List[Column]):
+    """
+    Return a clause that is true where the values of ``columns`` are distinct
+    from those of ``others``. json has no equality operator, so json columns
+    are compared as jsonb.
+    """
+    def comparable(column: Column):
+        if isinstance(column.type, JSON) and not isinstance(column.type, JSONB):
+            return cast(column, JSONB)
+        return column
+    return tuple_(*(comparable(c) for c in columns)).is_distinct_from(
+        tuple_(*(comparable(c) for c in others))
+    )
+
+
+class CopyBuffer:
+    """
+    A file-like object that reads lines for ``COPY ... FROM STDIN`` from an
+    iterable of rows without rendering them all up front.
+    """
+
+    def __init__(self, rows: Iterable[Sequence[Any]]):
+        self.lines: Iterator[str] = (
+            '\t'.join(copy_text(value) for value in row) + '\n' for row in rows
+        )
+        self.buffer = ''
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class PostgresDiff(SQLAlchemyDiff):
+    """
+    A :class:`SQLAlchemyDiff` that applies changes inside a Postgres database
+    using set-based SQL, so existing rows are never loaded into Python.
+    """
+
+    # The fields that make up the key, defaulting to the primary key:
+    key_fields: Sequence[str] = None
+
+    # How changes are applied:
+    # 'staging' copies the imported rows into a staging table and then runs
+    # separate DELETE, UPDATE and INSERT statements against it.
+    # 'upsert' copies only the imported keys into a staging table to run the
+    # DELETE, and then sends the imported rows in batches of batch_size using
+    # INSERT ... ON CONFLICT DO UPDATE, which only rewrites rows that have
+    # changed. This needs a unique constraint on key_fields.
+    strategy: str = 'staging'
+
+    def __init__(self, session: Session, imported: Sequence[Imported]):
+        for name in 'restrict_existing', 'digest', 'snapshot':
+            if getattr(self, name):
+                raise TypeError(name + ' cannot be used with PostgresDiff')
+        super(PostgresDiff, self).__init__(session, imported)
+        if self.key_fields is None:
+            self.key_fields = [
+                self.columns().names[i] for i in self.columns().primary_key
+            ]
+
+    def field_names(self) -> List[str]:
+        """
+        The key fields followed by any other fields being compared.
+        """
+        columns = self.columns()
+        names = list(self.key_fields)
+        for i in columns.compared:
+            name = columns.names[i]
+            if name not in names:
+                names.append(name)
+        return names
+
+    def scope(self) -> Optional[Any]:
+        """
+        The criteria that select the existing rows covered by the import,
+        taken from the query returned by :meth:`existing`.
+        """
+        return self.full_existing.whereclause
+
+    def check_existing_duplicates(self, key: List[Column]) -> None:
+        statement = select(*key, func.count()).group_by(*key).having(func.count() > 1)
+        scope = self.scope()
+        if scope is not None:
+            statement = statement.where(scope)
+        lines = []
+        for *values, count in self.session.execute(statement):
+            lines.append(
+                '{!r} occurs {} times in existing'.format(tuple(values), count)
+            )
+        if lines:
+            raise AssertionError('\n'.join(lines))
+
+    def stage(self, names: List[str], columns: List[Column]) -> Table:
+        """
+        Create a temporary table with the given columns and copy the named
+        fields of the imported rows into it.
+        """
+        connection = self.session.connection()
+        table = inspect(self.model).local_table
+        staging = Table(
+            'staging_' + table.name,
+            MetaData(),
+            *(Column(column.name, column.type) for column in columns),
+        )
+        preparer = connection.dialect.identifier_preparer
+        # copy the column types from the table, so that types such as enums
+        # aren't created or dropped along with the staging table:
+        connection.exec_driver_sql(
+            'CREATE TEMPORARY TABLE {} AS {} WITH NO DATA'.format(
+                preparer.format_table(staging),
+                select(*columns).compile(dialect=connection.dialect),
+            )
+        )
+        # render values as they would be bound in an INSERT:
+        processors = [
+            column.type.dialect_impl(connection.dialect).bind_processor(
+                connection.dialect
+            )
+            for column in columns
+        ]
+        rows = (
+            tuple(
+                value if process is None or value is None else process(value)
+                for process, value in zip(
+                    processors, (extracted[name] for name in names)
+                )
+            )
+            for _, extracted in self.imported_mapping.values()
+        )
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN'.format(
+                    preparer.format_table(staging),
+                    ', '.join(preparer.quote(column.name) for column in columns),
+                ),
+                CopyBuffer(rows),
+            )
+        finally:
+            cursor.close()
+        return staging
+
+    def check_imported(self, names: List[str]) -> None:
+        """
+        Make sure every imported row has all the named fields, as a missing
+        field would otherwise be written as NULL, overriding any default.
+        """
+        for key, (_, extracted) in self.imported_mapping.items():
+            missing = [name for name in names if name not in extracted]
+            if missing:
+                raise ValueError('{!r} is missing {}'.format(
+                    key, ', '.join(repr(name) for name in missing)
+                ))
+
+    def unstage(self, staging: Table) -> None:
+        # Only called once the statements using staging have succeeded, as
+        # after a failure the transaction can only be rolled back, which
+        # drops the table anyway:
+        connection = self.session.connection()
+        connection.exec_driver_sql(
+            'DROP TABLE ' + connection.dialect.identifier_preparer.format_table(staging)
+        )
+
+    def delete_missing(
+            self, table: Table, staging: Table, key: List[Column]
+    ) -> int:
+        matched = and_(*(column == staging.c[column.name] for column in key))
+        return self.session.execute(
+            table.delete().where(and_(*self.in_scope(), ~exists().where(matched)))
+        ).rowcount
+
+    def in_scope(self) -> List[Any]:
+        scope = self.scope()
+        return [] if scope is None else [scope]
+
+    def apply_staging(
+            self,
+            table: Table,
+            names: List[str],
+            key: List[Column],
+            values: List[Column],
+    ) -> Counts:
+        columns = key + values
+        staging = self.stage(names, columns)
+        staged = staging.c
+        matched = and_(*(column == staged[column.name] for column in key))
+
+        deleted = self.delete_missing(table, staging, key)
+
+        updated = 0
+        if values:
+            updated = self.session.execute(
+                table.update().values({
+                    column: staged[column.name] for column in values
+                }).where(and_(
+                    matched,
+                    *self.in_scope(),
+                    distinct(values, [staged[column.name] for column in values]),
+                ))
+            ).rowcount
+
+        added = self.session.execute(
+            table.insert().from_select(
+                columns,
+                select(*(staged[column.name] for column in columns)).where(
+                    ~exists().where(and_(matched, *self.in_scope()))
+                ),
+            )
+        ).rowcount
+
+        self.unstage(staging)
+        return Counts(add=added, update=updated, delete=deleted)
+
+    def apply_upsert(
+            self,
+            table: Table,
+            names: List[str],
+            key: List[Column],
+            values: List[Column],
+    ) -> Counts:
+        staging = self.stage(names[:len(key)], key)
+        deleted = self.delete_missing(table, staging, key)
+        self.unstage(staging)
+
+        added = updated = 0
+        columns = key + values
+        for batch in chunks(self.imported_mapping.values(), self.batch_size):
+            statement = insert(table).values([
+                {column.key: extracted[n] for n, column in zip(names, columns)}
+                for _, extracted in batch
+            ])
+            if values:
+                excluded = statement.excluded
+                statement = statement.on_conflict_do_update(
+                    index_elements=key,
+                    set_={column.key: excluded[column.key] for column in values},
+                    where=distinct(
+                        values, [excluded[column.key] for column in values]
+                    ),
+                )
+            else:
+                statement = statement.on_conflict_do_nothing(index_elements=key)
+            statement = statement.returning(literal_column('xmax = 0'))
+            for inserted, in self.session.execute(statement):
+                if inserted:
+                    added += 1
+                else:
+                    updated += 1
+        return Counts(add=added, update=updated, delete=deleted)
+
+    def compute(self) -> None:
+        raise TypeError(
+            'PostgresDiff applies changes in the database, use apply() instead'
+        )
+
+    def iter_changes(self, ops: Sequence[str] = OPS) -> Iterator[Change]:
+        raise TypeError(
+            'PostgresDiff applies changes in the database, use apply() instead'
+        )
+
+    def apply(self) -> Counts:
+        if self.strategy not in ('staging', 'upsert'):
+            raise ValueError('Unknown strategy: {!r}'.format(self.strategy))
+
+        self.session.flush()
+        self._index(('imported',))
+
+        mapper = inspect(self.model)
+        table = mapper.local_table
+        names = self.field_names()
+        columns = [mapper.column_attrs[name].columns[0] for name in names]
+        key = columns[:len(self.key_fields)]
+        values = columns[len(self.key_fields):]
+
+        if [column.name for column in key] != [c.name for c in mapper.primary_key]:
+            self.check_existing_duplicates(key)
+        self.check_imported(names)
+
+        counts = getattr(self, 'apply_' + self.strategy)(table, names, key, values)
+
+        self.session.expire_all()
+        self._release()
+        return counts
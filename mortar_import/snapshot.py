@@ -0,0 +1,81 @@
+import pickle
+import sqlite3
+from hashlib import md5
+from typing import Any, Dict, Optional, Set
+
+from .typing import Key
+
+
+def digest(value: Any) -> bytes:
+    """
+    Return a digest of a picklable value. Equal digests mean equal values,
+    although equal values may occasionally have different digests.
+    """
+    return md5(pickle.dumps(value, protocol=4)).digest()
+
+
+class Snapshot:
+    """
+    A local sqlite file recording the key and a digest of each object in the
+    last import that was applied, along with a fingerprint of the existing
+    objects it left behind.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS digests (key BLOB PRIMARY KEY, digest BLOB)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprint (value TEXT)'
+        )
+
+    def fingerprint(self) -> Optional[str]:
+        row = self.connection.execute('SELECT value FROM fingerprint').fetchone()
+        return None if row is None else row[0]
+
+    def valid(self, fingerprint: Any) -> bool:
+        """
+        Is the snapshot usable given the current fingerprint of the existing
+        objects? A fingerprint of ``None`` is never valid.
+        """
+        return fingerprint is not None and self.fingerprint() == repr(fingerprint)
+
+    def changed(self, digests: Dict[Key, bytes]) -> Set[Key]:
+        """
+        Return the keys that are either in ``digests`` with a different
+        digest to the one recorded, or only in one of the two.
+        """
+        recorded = dict(self.connection.execute('SELECT key, digest FROM digests'))
+        keys = set()
+        for key, value in digests.items():
+            if recorded.pop(pickle.dumps(key, protocol=4), None) != value:
+                keys.add(key)
+        keys.update(pickle.loads(key) for key in recorded)
+        return keys
+
+    def save(self, digests: Dict[Key, bytes], fingerprint: Any) -> None:
+        """
+        Replace the contents of the snapshot.
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM digests')
+            self.connection.execute('DELETE FROM fingerprint')
+            self.connection.executemany(
+                'INSERT INTO digests VALUES (?, ?)',
+                ((pickle.dumps(key, protocol=4), value) for key, value in digests.items())
+            )
+            if fingerprint is not None:
+                self.connection.execute(
+                    'INSERT INTO fingerprint VALUES (?)', (repr(fingerprint),)
+                )
+
+    def invalidate(self) -> None:
+        """
+        Remove the contents of the snapshot, so that the next import is
+        compared in full.
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM digests')
+            self.connection.execute('DELETE FROM fingerprint')
@@ -0,0 +1,84 @@
+import pickle
+from collections import defaultdict
+from tempfile import TemporaryFile
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .typing import Key
+
+Entry = Tuple[Key, Any, Any]
+
+
+class Spill:
+    """
+    Entries of ``(key, raw, extracted)`` written to a temporary file, split
+    into partitions chosen by the hash of the key. Entries are held in memory
+    until ``buffer_size`` of them have been added and then written out as one
+    run for each partition, so only one file is ever open, however many
+    partitions there are.
+    """
+
+    def __init__(
+            self,
+            partitions: int,
+            directory: Optional[str] = None,
+            buffer_size: int = 1000,
+    ):
+        self.partitions = partitions
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.file = TemporaryFile(dir=directory)
+        # the entries not yet written, by partition:
+        self.buffer: Dict[int, List[Entry]] = defaultdict(list)
+        self.buffered = 0
+        # the offsets in file of the runs written, by partition:
+        self.runs: Dict[int, List[int]] = defaultdict(list)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def partition(self, key: Key) -> int:
+        return hash(key) % self.partitions
+
+    def add(self, entry: Entry) -> None:
+        self.buffer[self.partition(entry[0])].append(entry)
+        self.buffered += 1
+        self.count += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def extend(self, entries: Iterable[Entry]) -> None:
+        for entry in entries:
+            self.add(entry)
+
+    def flush(self) -> None:
+        """
+        Write out any entries held in memory.
+        """
+        self.file.seek(0, 2)
+        for partition, entries in self.buffer.items():
+            self.runs[partition].append(self.file.tell())
+            pickle.dump(entries, self.file, pickle.HIGHEST_PROTOCOL)
+        self.buffer = defaultdict(list)
+        self.buffered = 0
+
+    def entries(self, partition: int) -> Iterator[Entry]:
+        self.flush()
+        for offset in self.runs.get(partition, ()):
+            self.file.seek(offset)
+            yield from pickle.load(self.file)
+
+    def repartitioned(self, partitions: int) -> 'Spill':
+        """
+        Return a new spill holding the same entries in ``partitions``
+        partitions, closing this one.
+        """
+        spill = Spill(partitions, self.directory, self.buffer_size)
+        for partition in range(self.partitions):
+            spill.extend(self.entries(partition))
+        spill.flush()
+        self.close()
+        return spill
+
+    def close(self) -> None:
+        self.file.close()
@@ -1,26 +1,189 @@
 # import orm here so that event registration work
 
 from abc import abstractmethod
-from typing import Set, Sequence, TypeVar, Type, Tuple, Any, Dict
+from collections import defaultdict
+from functools import lru_cache
+from hashlib import md5
+from struct import pack
+from typing import (
+    Set, Sequence, TypeVar, Type, Tuple, Any, Dict, List, FrozenSet, NamedTuple, Union,
+    Optional, Iterator, Iterable, Callable, AsyncIterator
+)
 
-from sqlalchemy import inspect
-from sqlalchemy.orm import Session
+from sqlalchemy import (
+    Column, inspect, and_, bindparam, tuple_, false, func, not_, cast, literal, Text,
+    Float, BigInteger
+)
+from sqlalchemy.dialects.postgresql import BIT
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, Query
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.types import TypeEngine
 
-from .diff import Diff
+from .asyncio import AsyncDiff
+from .diff import Diff, Addition, Update, Deletion, Change, changed_fields, chunks
 from .typing import Imported, Key
 
 Model = TypeVar('Model')
 ModelAttributes = Dict[str, Any]
 
 
+def in_keys(columns: Sequence[Column], keys: Sequence[Tuple]):
+    """
+    Return a clause matching rows where the values of ``columns`` are
+    one of the tuples in ``keys``.
+    """
+    if len(columns) == 1:
+        return columns[0].in_([key[0] for key in keys])
+    return tuple_(*columns).in_(keys)
+
+
+def digest_text(value: Any, type_: Optional[TypeEngine] = None) -> str:
+    """
+    Render ``value`` for inclusion in a row digest, matching the text that
+    :func:`digest_expression` produces in the database for the same value
+    in a column of type ``type_``.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        text = 'true' if value else 'false'
+    elif isinstance(type_, Float) and isinstance(value, (int, float)):
+        text = pack('>d', value).hex()
+    else:
+        text = str(value)
+    return '{}:{}'.format(len(text), text)
+
+
+def digest_expression(columns: Sequence[Column]):
+    """
+    Return an md5 digest of the text forms of ``columns``, each prefixed with
+    its length so that the result is unambiguous, with NULLs left empty.
+    Floating point columns are rendered as the hex of their binary values,
+    as their text forms may be rounded.
+    """
+    parts = []
+    for column in columns:
+        if isinstance(column.type, Float):
+            text = func.encode(func.float8send(cast(column, Float(53))), 'hex')
+        else:
+            text = cast(column, Text)
+        parts.append(func.coalesce(
+            cast(func.length(text), Text) + literal(':') + text, literal('')
+        ))
+    return func.md5(func.concat_ws(',', *parts))
+
+
+class RowDigest(NamedTuple):
+    primary_key: Tuple
+    key: Key
+    digest: str
+
+
+class ModelColumns(NamedTuple):
+    # the names of the attributes to load, in order:
+    names: Tuple[str, ...]
+    # the positions of the primary key attributes in names:
+    primary_key: Tuple[int, ...]
+    # the positions of the attributes to compare in names:
+    compared: Tuple[int, ...]
+
+
+@lru_cache()
+def model_columns(model: Type[Model], ignore_fields: FrozenSet[str]) -> ModelColumns:
+    """
+    Work out the column attributes to load for ``model`` when extracting
+    existing rows as tuples.
+    """
+    mapper = inspect(model)
+    names = [mapper.get_property_by_column(column).key for column in mapper.primary_key]
+    primary_key = tuple(range(len(names)))
+    compared = []
+    for attr in mapper.column_attrs:
+        if attr.key in ignore_fields:
+            continue
+        if attr.key not in names:
+            names.append(attr.key)
+        compared.append(names.index(attr.key))
+    return ModelColumns(tuple(names), primary_key, tuple(compared))
+
+
 class SQLAlchemyDiff(Diff):
 
     flush_per_type: bool = True
     ignore_fields: Set[str] = set()
 
+    # Set to True to insert additions in batches of batch_size rows
+    # rather than creating a model instance for each one:
+    bulk_add: bool = False
+
+    # Set to True to apply updates in batches of batch_size rows using
+    # UPDATE statements keyed on primary key, one for each set of changed
+    # fields, rather than by modifying each model instance:
+    bulk_update: bool = False
+
+    # Set to True to delete in batches of batch_size rows using
+    # DELETE ... WHERE pk IN (...). This bypasses ORM cascades, so leave it
+    # off for models that rely on them:
+    bulk_delete: bool = False
+
+    # Set to True to load existing rows as tuples of column values rather than
+    # as model instances. Instances are then only loaded, by primary key, when
+    # needed by update or delete:
+    load_columns: bool = False
+
+    # Set to a number of rows to stream existing rows from the database
+    # through a server-side cursor in batches of that size, rather than
+    # buffering the whole result set:
+    yield_per: Optional[int] = None
+
+    # Set to True to only load the existing rows whose keys are in the import,
+    # in batches of batch_size keys, along with any rows matching
+    # deletion_scope(), for imports that only cover part of a table:
+    restrict_existing: bool = False
+
+    # Set to True to only load the primary key, key and a digest of the compared
+    # columns of each existing row. Imported rows are digested in Python and
+    # only existing rows whose digests differ, or that are to be deleted, are
+    # then loaded in full, in batches of batch_size. Values whose text forms
+    # differ between Python and the database are loaded and compared in full.
+    # Floating point values are digested from their binary form, as the
+    # database may round their text forms, which could hide a change:
+    digest: bool = False
+
+    # Set to a number of changes to flush the session after each time that
+    # many have been handled by add, update or delete, expunging the objects
+    # that add and update created or changed. Each phase is then always
+    # flushed before the next begins. Objects that were added or updated
+    # won't be in the session after apply(), so don't set this if you need
+    # to use them afterwards. Other objects in the session are left alone:
+    flush_every: Optional[int] = None
+
     def __init__(self, session: Session, imported: Sequence[Imported]):
         self.session: Session = session
-        super(SQLAlchemyDiff, self).__init__(self.existing(), imported)
+        self.unflushed: int = 0
+        # the instances added or updated since the last flush_and_expunge,
+        # only recorded when flush_every is set:
+        self.handled: List[Model] = []
+        existing = self.full_existing = self.existing()
+        if self.digest:
+            if self.sorted_inputs:
+                raise TypeError('digest cannot be used with sorted_inputs')
+            existing = self.digested(existing)
+        if self.yield_per is not None:
+            existing = existing.yield_per(self.yield_per)
+        if self.restrict_existing:
+            if self.sorted_inputs:
+                raise TypeError('restrict_existing cannot be used with sorted_inputs')
+            if self.spill_after is not None:
+                raise TypeError('restrict_existing cannot be used with spill_after')
+            existing = self.restricted(existing)
+        elif self.snapshot is not None:
+            existing = self.restricted(existing)
+        if self.digest:
+            existing = self.row_digests(existing)
+        super(SQLAlchemyDiff, self).__init__(existing, imported)
 
     @property
     @abstractmethod
@@ -29,10 +192,185 @@ class SQLAlchemyDiff(Diff):
         The model that will be used to source existing objects.
         """
 
-    def existing(self) -> Sequence[Model]:
+    def _imported_first(self) -> bool:
+        return self.restrict_existing or super(SQLAlchemyDiff, self)._imported_first()
+
+    def columns(self) -> ModelColumns:
+        return model_columns(self.model, frozenset(self.ignore_fields))
+
+    def existing(self) -> Sequence[Union[Model, Row]]:
+        if self.load_columns:
+            return self.session.query(
+                *(getattr(self.model, name) for name in self.columns().names)
+            )
         return self.session.query(self.model)
 
-    def extract_existing(self, obj: Model) -> Tuple[Key, ModelAttributes]:
+    def compared_names(self) -> List[str]:
+        """
+        The names of the attributes compared between existing and imported
+        objects.
+        """
+        columns = self.columns()
+        return [columns.names[i] for i in columns.compared]
+
+    def key_columns(self) -> Sequence[Column]:
+        """
+        The columns that make up the keys of existing objects.
+        """
+        return inspect(self.model).primary_key
+
+    def existing_fingerprint(self) -> Any:
+        """
+        By default, the number of existing rows along with the sum of the
+        first 64 bits of each of their digests, so that rows changed in place
+        are noticed as well as those added or deleted.
+        """
+        hashed = cast(
+            cast(literal('x') + func.substr(self.compared_digest(), 1, 16), BIT(64)),
+            BigInteger,
+        )
+        count, total = self.full_existing.order_by(None).with_entities(
+            func.count(), func.sum(hashed)
+        ).one()
+        return count, total
+
+    def deletion_scope(self) -> Optional[Any]:
+        """
+        When :attr:`restrict_existing` is set, this can return criteria
+        selecting the existing rows that should be deleted if their keys are
+        not in the import. By default, nothing is deleted.
+        """
+        return None
+
+    def restrictions(self, query: Query) -> Iterator[Query]:
+        """
+        Yield the queries that load the existing objects needed, in turn.
+        """
+        # candidate_keys is set when a snapshot has narrowed down the keys
+        # that need looking at:
+        keys = self.candidate_keys
+        if self.restrict_existing:
+            # deletions are only ever found through the deletion scope:
+            if keys is None:
+                keys = self.imported_keys
+            else:
+                keys = keys & self.imported_keys
+            scope = self.deletion_scope()
+            if scope is not None:
+                yield query.filter(scope)
+                query = query.filter(not_(func.coalesce(scope, false())))
+        elif keys is None:
+            yield query
+            return
+        for batch in chunks(keys, self.batch_size):
+            yield query.filter(in_keys(self.key_columns(), batch))
+
+    def restricted(self, query: Query) -> Iterator[Union[Model, Row]]:
+        for restriction in self.restrictions(query):
+            yield from restriction
+
+    def digested(self, query: Query) -> Query:
+        """
+        Turn a query for existing objects into one for their primary keys,
+        keys and row digests.
+        """
+        return query.with_entities(
+            *inspect(self.model).primary_key,
+            *self.key_columns(),
+            self.compared_digest(),
+        )
+
+    def compared_digest(self):
+        """
+        The :func:`digest_expression` of the compared columns of existing rows.
+        """
+        mapper = inspect(self.model)
+        return digest_expression([
+            mapper.column_attrs[name].columns[0] for name in self.compared_names()
+        ])
+
+    def row_digests(self, rows: Iterable[Row]) -> Iterator[RowDigest]:
+        size = len(inspect(self.model).primary_key)
+        for row in rows:
+            yield RowDigest(tuple(row[:size]), tuple(row[size:-1]), row[-1])
+
+    def row_digest(self, extracted: ModelAttributes) -> Optional[str]:
+        """
+        Return the digest of an imported object's extracted attributes, or
+        ``None`` if they don't match the compared attributes.
+        """
+        names = self.compared_names()
+        if set(extracted) != set(names):
+            return None
+        attrs = inspect(self.model).column_attrs
+        text = ','.join(
+            digest_text(extracted[name], attrs[name].columns[0].type) for name in names
+        )
+        return md5(text.encode('utf-8')).hexdigest()
+
+    def differs(
+            self,
+            existing_extracted: Union[ModelAttributes, str],
+            imported_extracted: ModelAttributes,
+    ) -> bool:
+        if self.digest:
+            return existing_extracted != self.row_digest(imported_extracted)
+        return existing_extracted != imported_extracted
+
+    def fetched(self, changes: Iterable[Change]) -> Iterator[Change]:
+        """
+        Load the existing objects for changes found using row digests, in
+        batches, dropping any updates where nothing has actually changed.
+        """
+        primary_key = inspect(self.model).primary_key
+        for batch in chunks(changes, self.batch_size):
+            keys = [change.existing.primary_key for change in batch]
+            loaded = {
+                self.primary_key(obj): obj
+                for obj in self.full_existing.filter(in_keys(primary_key, keys))
+            }
+            for change in batch:
+                existing = loaded[change.existing.primary_key]
+                _, existing_extracted = self.extract_existing(existing)
+                change = change._replace(
+                    existing=existing, existing_extracted=existing_extracted
+                )
+                if (type(change) is Deletion or
+                        existing_extracted != change.imported_extracted):
+                    yield change
+
+    def _mapped(self, op: str) -> Iterator[Change]:
+        changes = super(SQLAlchemyDiff, self)._mapped(op)
+        if self.digest and op != 'add':
+            changes = self.fetched(changes)
+        return changes
+
+    def primary_key(self, existing: Union[Model, Row]) -> Tuple:
+        """
+        Return the primary key of an existing object, in the order of the
+        model's mapped primary key columns.
+        """
+        if isinstance(existing, Row):
+            return tuple(existing[i] for i in self.columns().primary_key)
+        return inspect(existing).identity
+
+    def instance(self, existing: Union[Model, Row]) -> Model:
+        """
+        Return the model instance for an existing object, loading it by
+        primary key if it was loaded as a tuple of column values.
+        """
+        if isinstance(existing, Row):
+            return self.session.get(self.model, self.primary_key(existing))
+        return existing
+
+    def extract_existing(self, obj: Union[Model, Row]) -> Tuple[Key, ModelAttributes]:
+        if isinstance(obj, RowDigest):
+            return obj.key, obj.digest
+        if isinstance(obj, Row):
+            columns = self.columns()
+            key = tuple(obj[i] for i in columns.primary_key)
+            extracted = {columns.names[i]: obj[i] for i in columns.compared}
+            return key, extracted
         state = inspect(obj)
         relationships = state.mapper.relationships
         key = state.identity
@@ -57,29 +395,187 @@ class SQLAlchemyDiff(Diff):
             imported: Imported,
             extracted_imported: ModelAttributes
     ):
-        self.session.add(self.model(**extracted_imported))
+        obj = self.model(**extracted_imported)
+        self.session.add(obj)
+        self._track(obj)
+
+    def add_many(self, additions: List[Addition]) -> None:
+        if self.bulk_add:
+            # make sure pending changes from earlier phases go first:
+            self.session.flush()
+            self.session.bulk_insert_mappings(
+                self.model, [addition.imported_extracted for addition in additions]
+            )
+        else:
+            self.handle_each(self.add, additions)
 
     def update(
             self,
             key: Key,
-            existing: Model,
+            existing: Union[Model, Row],
             existing_extracted: ModelAttributes,
             imported: Imported,
             imported_extracted: ModelAttributes,
     ):
-        for key, value in imported_extracted.items():
-            setattr(existing, key, value)
+        existing = self.instance(existing)
+        for name in changed_fields(existing_extracted, imported_extracted):
+            setattr(existing, name, imported_extracted[name])
+        self._track(existing)
+
+    def update_many(self, updates: List[Update]) -> None:
+        if not self.bulk_update:
+            self.handle_each(self.update, updates)
+            return
+
+        # make sure pending changes from earlier phases go first:
+        self.session.flush()
+        mapper = inspect(self.model)
+        primary_key = mapper.primary_key
+        by_changed = defaultdict(list)
+        for update in updates:
+            changed = update.changed
+            if changed:
+                by_changed[tuple(sorted(changed))].append(update)
+
+        for names, group in by_changed.items():
+            statement = mapper.local_table.update().where(and_(*(
+                column == bindparam('pk_' + column.key) for column in primary_key
+            ))).values({
+                mapper.column_attrs[name].columns[0]: bindparam('new_' + name)
+                for name in names
+            })
+            params = []
+            for update in group:
+                values = {
+                    'pk_' + column.key: value for column, value in
+                    zip(primary_key, self.primary_key(update.existing))
+                }
+                for name in names:
+                    values['new_' + name] = update.imported_extracted[name]
+                params.append(values)
+            self.session.execute(statement, params)
+
+            # keep the instances in step with the database without dirtying them:
+            for update in group:
+                if isinstance(update.existing, Row):
+                    continue
+                for name in names:
+                    set_committed_value(
+                        update.existing, name, update.imported_extracted[name]
+                    )
 
     def delete(
             self,
             key: Key,
-            existing: Model,
+            existing: Union[Model, Row],
             existing_extracted: ModelAttributes
     ):
-        self.session.delete(existing)
+        self.session.delete(self.instance(existing))
+
+    def delete_many(self, deletions: List[Deletion]) -> None:
+        if not self.bulk_delete:
+            self.handle_each(self.delete, deletions)
+            return
+
+        self.session.flush()
+        mapper = inspect(self.model)
+        keys = [self.primary_key(deletion.existing) for deletion in deletions]
+        self.session.execute(
+            mapper.local_table.delete().where(in_keys(mapper.primary_key, keys))
+        )
+        for deletion in deletions:
+            if not isinstance(deletion.existing, Row):
+                self.session.expunge(deletion.existing)
+
+    def handle_each(self, handle: Callable[..., None], changes: List[Change]) -> None:
+        for change in changes:
+            handle(*change)
+            if self.flush_every is not None:
+                self.unflushed += 1
+                if self.unflushed >= self.flush_every:
+                    self.flush_and_expunge()
+
+    def _track(self, obj: Model) -> None:
+        # Record an instance that was added or changed, so that it can be
+        # expunged once flushed:
+        if self.flush_every is not None:
+            self.handled.append(obj)
+
+    def flush_and_expunge(self) -> None:
+        """
+        Flush the session and then expunge the objects that were added or
+        updated since the last time this was called.
+        """
+        self.session.flush()
+        for obj in self.handled:
+            if obj in self.session:
+                self.session.expunge(obj)
+        self.handled = []
+        self.unflushed = 0
 
     def per_type_flush(self) -> None:
-        if self.flush_per_type:
+        if self.flush_every is not None:
+            self.flush_and_expunge()
+        elif self.flush_per_type:
             self.session.flush()
 
     post_add = post_update = post_delete = per_type_flush
+
+
+class AsyncSQLAlchemyDiff(SQLAlchemyDiff, AsyncDiff):
+    """
+    A :class:`SQLAlchemyDiff` for use with an
+    :class:`~sqlalchemy.ext.asyncio.AsyncSession`. Existing objects are
+    streamed from the database and each batch of changes is applied using
+    :meth:`~sqlalchemy.ext.asyncio.AsyncSession.run_sync`, so :attr:`session`
+    is the synchronous session behind :attr:`async_session`.
+    """
+
+    # An AsyncSession can only be used by one coroutine at a time, so batches
+    # are applied one after another. Use a diff with its own session for each
+    # import that should run concurrently:
+    concurrency: int = 1
+
+    def __init__(self, session: AsyncSession, imported: Sequence[Imported]):
+        for name in 'digest', 'snapshot':
+            if getattr(self, name):
+                raise TypeError(name + ' cannot be used with an AsyncSession')
+        self.async_session: AsyncSession = session
+        self.session: Session = session.sync_session
+        self.unflushed: int = 0
+        self.handled: List[Model] = []
+        self.full_existing = self.existing()
+        AsyncDiff.__init__(self, self.streamed(), imported)
+
+    async def streamed(self) -> AsyncIterator[Union[Model, Row]]:
+        for query in self.restrictions(self.full_existing):
+            statement = query.statement
+            if self.yield_per is not None:
+                statement = statement.execution_options(yield_per=self.yield_per)
+            result = await self.async_session.stream(statement)
+            if not self.load_columns:
+                result = result.scalars()
+            async for obj in result:
+                yield obj
+
+    async def add_many(self, additions: List[Addition]) -> None:
+        await self.async_session.run_sync(
+            lambda session: super(AsyncSQLAlchemyDiff, self).add_many(additions)
+        )
+
+    async def update_many(self, updates: List[Update]) -> None:
+        await self.async_session.run_sync(
+            lambda session: super(AsyncSQLAlchemyDiff, self).update_many(updates)
+        )
+
+    async def delete_many(self, deletions: List[Deletion]) -> None:
+        await self.async_session.run_sync(
+            lambda session: super(AsyncSQLAlchemyDiff, self).delete_many(deletions)
+        )
+
+    async def per_type_flush(self) -> None:
+        await self.async_session.run_sync(
+            lambda session: super(AsyncSQLAlchemyDiff, self).per_type_flush()
+        )
+
+    post_add = post_update = post_delete = per_type_flush
@@ -1,11 +1,24 @@
 from abc import abstractmethod
 from datetime import datetime
-from typing import Sequence, cast, Tuple, Dict, Any, Union
+from typing import (
+    Sequence, cast, Tuple, Dict, Any, Union, List, Iterable, NamedTuple, Optional
+)
 
 from mortar_mixins import Temporal
+from psycopg2.extras import DateTimeRange
+from sqlalchemy import (
+    Column, func, inspect, literal, and_, bindparam, case, select, event
+)
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 
-from .sqlalchemy import SQLAlchemyDiff, Model, ModelAttributes
+from .diff import Addition, Update, Deletion, Counts, changed_fields, chunks
+from .sqlalchemy import (
+    SQLAlchemyDiff, AsyncSQLAlchemyDiff, Model, ModelAttributes, RowDigest, in_keys
+)
 from .typing import Imported, Key
 
 
@@ -13,11 +26,24 @@ from .typing import Imported, Key
 TemporalModel = Union[Temporal, Model]
 
 
+class BackfillPeriod(NamedTuple):
+    # the primary key of the row, once it is in the database:
+    primary_key: Optional[Tuple]
+    extracted: ModelAttributes
+    value_from: Optional[datetime]
+    value_to: Optional[datetime]
+
+
 class TemporalDiff(SQLAlchemyDiff):
 
     # is it okay to replace whole rows because the update
     # has the same time period as the existing value?
     replace = False
+
+    # bulk_add, bulk_update and bulk_delete close existing periods with one
+    # UPDATE of period per batch, keyed by id, and insert new and successor
+    # rows with bulk inserts.
+
     key_fields: Sequence[str] = None
 
     def __init__(self, session: Session, imported: Sequence[Imported], at: datetime):
@@ -33,11 +59,24 @@ class TemporalDiff(SQLAlchemyDiff):
         The model that will be used to source existing objects.
         """
 
-    def existing(self) -> Sequence[TemporalModel]:
-        return cast(Sequence[Temporal],
-                    self.session.query(self.model).filter(self.model.value_at(self.at)))
+    def existing(self) -> Sequence[Union[TemporalModel, Row]]:
+        return cast(
+            Sequence[Temporal],
+            super(TemporalDiff, self).existing().filter(self.model.value_at(self.at)),
+        )
+
+    def key_columns(self) -> Sequence[Column]:
+        return [getattr(self.model, name) for name in self.key_fields]
+
+    def compared_names(self) -> List[str]:
+        return [
+            name for name in super(TemporalDiff, self).compared_names()
+            if name not in ('period', 'id')
+        ]
 
     def extract_existing(self, obj: TemporalModel) -> Tuple[Key, ModelAttributes]:
+        if isinstance(obj, RowDigest):
+            return obj.key, obj.digest
         _, extracted = super(TemporalDiff, self).extract_existing(obj)
         del extracted['period']
         del extracted['id']
@@ -58,6 +97,7 @@ class TemporalDiff(SQLAlchemyDiff):
         obj = self.model(**extracted_imported)
         obj.value_from = self.at
         self.session.add(obj)
+        self._track(obj)
 
     def update(
             self,
@@ -67,22 +107,15 @@ class TemporalDiff(SQLAlchemyDiff):
             imported: Imported,
             imported_extracted: ModelAttributes
     ):
+        existing = self.instance(existing)
         if existing.value_from == self.at:
             if self.replace:
-                for key, value in imported_extracted.items():
-                    setattr(existing, key, value)
+                for name in changed_fields(existing_extracted, imported_extracted):
+                    setattr(existing, name, imported_extracted[name])
+                self._track(existing)
             else:
-                raise ValueError(
-                    (
-                        "Replacing existing value for {key!r} over {period!r} "
-                        "would lose history. Existing: {existing}, "
-                        "imported {imported}."
-                    ).format(
-                        key=key,
-                        period=existing.period,
-                        existing=existing_extracted,
-                        imported=imported_extracted,
-                    )
+                raise self.lost_history(
+                    key, existing, existing_extracted, imported_extracted
                 )
         else:
             existing_value_to = existing.value_to
@@ -91,6 +124,8 @@ class TemporalDiff(SQLAlchemyDiff):
             obj.value_from = self.at
             obj.value_to = existing_value_to
             self.session.add(obj)
+            self._track(existing)
+            self._track(obj)
 
     def delete(
             self,
@@ -98,4 +133,392 @@ class TemporalDiff(SQLAlchemyDiff):
             existing: TemporalModel,
             existing_extracted: ModelAttributes
     ):
+        existing = self.instance(existing)
         existing.value_to = self.at
+        self._track(existing)
+
+    @staticmethod
+    def lost_history(
+            key: Key,
+            existing: Union[TemporalModel, Row],
+            existing_extracted: ModelAttributes,
+            imported_extracted: ModelAttributes,
+    ) -> ValueError:
+        return ValueError(
+            (
+                "Replacing existing value for {key!r} over {period!r} "
+                "would lose history. Existing: {existing}, "
+                "imported {imported}."
+            ).format(
+                key=key,
+                period=existing.period,
+                existing=existing_extracted,
+                imported=imported_extracted,
+            )
+        )
+
+    def close(self, existing: Sequence[Union[TemporalModel, Row]]) -> None:
+        """
+        End the periods of the existing objects at :attr:`at` using a single
+        UPDATE keyed on primary key.
+        """
+        mapper = inspect(self.model)
+        table = mapper.local_table
+        self.session.execute(
+            table.update().where(
+                in_keys(mapper.primary_key, [self.primary_key(obj) for obj in existing])
+            ).values(
+                period=func.tsrange(func.lower(table.c.period), literal(self.at))
+            )
+        )
+        # keep the instances in step with the database without dirtying them:
+        for obj in existing:
+            if not isinstance(obj, Row):
+                set_committed_value(
+                    obj, 'period', DateTimeRange(obj.value_from, self.at)
+                )
+
+    def add_many(self, additions: List[Addition]) -> None:
+        if not self.bulk_add:
+            super(TemporalDiff, self).add_many(additions)
+            return
+        self.session.flush()
+        self.session.bulk_insert_mappings(self.model, [
+            dict(addition.imported_extracted, period=DateTimeRange(self.at, None))
+            for addition in additions
+        ])
+
+    def update_many(self, updates: List[Update]) -> None:
+        if not self.bulk_update:
+            super(TemporalDiff, self).update_many(updates)
+            return
+
+        replaced, closed = [], []
+        for update in updates:
+            existing = update.existing
+            if existing.period.lower == self.at:
+                if not self.replace:
+                    raise self.lost_history(
+                        update.key,
+                        existing,
+                        update.existing_extracted,
+                        update.imported_extracted,
+                    )
+                replaced.append(update)
+            else:
+                closed.append(update)
+
+        if replaced:
+            super(TemporalDiff, self).update_many(replaced)
+        if closed:
+            self.session.flush()
+            successors = [
+                dict(
+                    update.imported_extracted,
+                    period=DateTimeRange(self.at, update.existing.period.upper),
+                )
+                for update in closed
+            ]
+            self.close([update.existing for update in closed])
+            self.session.bulk_insert_mappings(self.model, successors)
+
+    def delete_many(self, deletions: List[Deletion]) -> None:
+        if not self.bulk_delete:
+            super(TemporalDiff, self).delete_many(deletions)
+            return
+        self.session.flush()
+        self.close([deletion.existing for deletion in deletions])
+
+    @classmethod
+    def backfill(
+            cls,
+            session: Session,
+            snapshots: Iterable[Tuple[datetime, Sequence[Imported]]],
+            checkpoint: Optional[int] = None,
+    ) -> Counts:
+        """
+        Apply a sequence of ``(at, imported)`` snapshots, in order of ``at``,
+        with the same results as applying each of them with its own diff.
+
+        Existing rows are only loaded once, as at the first snapshot, and
+        each snapshot is compared with the one before in memory, so keys
+        that don't change get one period rather than being closed and
+        re-opened. The periods are then written using bulk statements.
+
+        If ``checkpoint`` is a number of snapshots, everything so far is
+        written and the session committed after each time that many have
+        been applied, so an interrupted backfill can be restarted from the
+        snapshot following the last checkpoint.
+        """
+        diff = None
+        counts = Counts(add=0, update=0, delete=0)
+        for number, (at, imported) in enumerate(snapshots, 1):
+            if diff is None:
+                diff = cls(session, imported, at)
+                if diff.sorted_inputs or diff.digest or diff.restrict_existing:
+                    raise TypeError(
+                        'backfill cannot be used with sorted_inputs, digest '
+                        'or restrict_existing'
+                    )
+                diff.load_periods()
+            else:
+                if at <= diff.at:
+                    raise ValueError(
+                        'Snapshots are not in order: '
+                        '{!r} follows {!r}'.format(at, diff.at)
+                    )
+                diff.imported, diff.at = imported, at
+                diff._index(('imported',))
+            counts = Counts(*(
+                total + count for total, count in zip(counts, diff.advance())
+            ))
+            if checkpoint is not None and number % checkpoint == 0:
+                diff.write_periods(reopen=True)
+                session.commit()
+        if diff is not None:
+            diff.write_periods(reopen=False)
+            diff._release()
+            session.expire_all()
+        return counts
+
+    def load_periods(self) -> None:
+        self._index()
+        self.periods: Dict[Key, BackfillPeriod] = {}
+        self.closes: List[Tuple[Tuple, datetime]] = []
+        self.rows: List[ModelAttributes] = []
+        for key, (existing, extracted) in self.existing_mapping.items():
+            self.periods[key] = BackfillPeriod(
+                self.primary_key(existing),
+                extracted,
+                existing.period.lower,
+                existing.period.upper,
+            )
+
+    def end_period(self, key: Key) -> None:
+        period = self.periods.pop(key)
+        if period.primary_key is None:
+            self.rows.append(dict(
+                period.extracted, period=DateTimeRange(period.value_from, self.at)
+            ))
+        else:
+            self.closes.append((period.primary_key, self.at))
+
+    def advance(self) -> Counts:
+        """
+        Compare the current snapshot with the periods as they stand,
+        recording the periods that end and starting new ones.
+        """
+        for key, period in self.periods.items():
+            if period.value_to is not None and period.value_to <= self.at:
+                raise ValueError(
+                    'The period for {!r} ends at {!r}, '
+                    'before the snapshot at {!r}'.format(key, period.value_to, self.at)
+                )
+
+        deleted = self.periods.keys() - self.imported_keys
+        for key in deleted:
+            self.end_period(key)
+
+        added = updated = 0
+        for key, (imported, extracted) in self.imported_mapping.items():
+            period = self.periods.get(key)
+            if period is None:
+                self.periods[key] = BackfillPeriod(None, extracted, self.at, None)
+                added += 1
+            elif period.extracted != extracted:
+                updated += 1
+                if period.value_from == self.at:
+                    existing = self.session.get(self.model, period.primary_key)
+                    self.update(key, existing, period.extracted, imported, extracted)
+                    self.periods[key] = period._replace(extracted=extracted)
+                else:
+                    self.end_period(key)
+                    self.periods[key] = BackfillPeriod(
+                        None, extracted, self.at, period.value_to
+                    )
+
+        return Counts(add=added, update=updated, delete=len(deleted))
+
+    def write_periods(self, reopen: bool) -> None:
+        """
+        Write the periods that have ended along with those still open. If
+        ``reopen`` is set, the open periods are tracked by primary key
+        afterwards so they can be ended later.
+        """
+        self.session.flush()
+        mapper = inspect(self.model)
+        table = mapper.local_table
+        primary_key = mapper.primary_key
+
+        statement = table.update().where(and_(*(
+            column == bindparam('pk_' + column.key) for column in primary_key
+        ))).values(
+            period=func.tsrange(func.lower(table.c.period), bindparam('ends'))
+        )
+        for batch in chunks(self.closes, self.batch_size):
+            params = []
+            for key, ends in batch:
+                values = {'pk_' + c.key: value for c, value in zip(primary_key, key)}
+                values['ends'] = ends
+                params.append(values)
+            self.session.execute(statement, params)
+
+        opened = [
+            (key, period) for key, period in self.periods.items()
+            if period.primary_key is None
+        ]
+        rows = [
+            dict(
+                period.extracted,
+                period=DateTimeRange(period.value_from, period.value_to),
+            )
+            for _, period in opened
+        ]
+        for batch in chunks(self.rows, self.batch_size):
+            self.session.bulk_insert_mappings(self.model, batch)
+        for batch in chunks(rows, self.batch_size):
+            self.session.bulk_insert_mappings(self.model, batch, return_defaults=reopen)
+        self.closes, self.rows = [], []
+
+        if reopen:
+            columns = self.columns()
+            names = [columns.names[i] for i in columns.primary_key]
+            for (key, period), row in zip(opened, rows):
+                self.periods[key] = period._replace(
+                    primary_key=tuple(row[name] for name in names)
+                )
+
+    @classmethod
+    def compact(
+            cls, session: Session, scope: Optional[Any] = None, dry_run: bool = False
+    ) -> Counts:
+        """
+        Merge runs of adjacent periods for the same key where the values,
+        compared as they would be by this diff, are the same. The merges are
+        done in batches of :attr:`batch_size` runs, each with one DELETE of
+        all but the first row of each run and one UPDATE extending the first
+        row's period.
+
+        ``scope`` can be criteria limiting the rows to compact. If
+        ``dry_run`` is set, nothing is changed. Either way, the counts of
+        rows that are, or would be, updated and deleted are returned.
+        """
+        diff = cls(session, (), None)
+        mapper = inspect(diff.model)
+        table = mapper.local_table
+        primary_key, = mapper.primary_key
+        period = table.c.period
+
+        def column(name: str) -> Column:
+            return mapper.column_attrs[name].columns[0]
+
+        keys = [column(name) for name in diff.key_fields]
+        values = [
+            column(name) for name in diff.compared_names()
+            if name not in diff.key_fields
+        ]
+
+        window = dict(partition_by=keys, order_by=func.lower(period))
+        previous = func.lag(period, type_=period.type).over(**window)
+        flagged = select(
+            primary_key,
+            period,
+            *keys,
+            case(
+                (and_(
+                    previous.adjacent_to(period),
+                    *(func.lag(c).over(**window).is_not_distinct_from(c) for c in values)
+                ), 0),
+                else_=1,
+            ).label('starts'),
+        )
+        if scope is not None:
+            flagged = flagged.where(scope)
+        flagged = flagged.subquery()
+
+        numbered = select(
+            flagged.c[primary_key.name],
+            flagged.c.period,
+            *(flagged.c[c.name] for c in keys),
+            func.sum(flagged.c.starts).over(
+                partition_by=[flagged.c[c.name] for c in keys],
+                order_by=func.lower(flagged.c.period),
+            ).label('run'),
+        ).subquery()
+        lower = func.lower(numbered.c.period)
+        runs = select(
+            array_agg(aggregate_order_by(numbered.c[primary_key.name], lower)),
+            array_agg(aggregate_order_by(func.upper(numbered.c.period), lower)),
+        ).group_by(
+            *(numbered.c[c.name] for c in keys), numbered.c.run
+        ).having(func.count() > 1)
+
+        session.flush()
+        updated = deleted = 0
+        delete = table.delete()
+        update = table.update().where(
+            primary_key == bindparam('pk')
+        ).values(period=func.tsrange(func.lower(period), bindparam('ends')))
+        for batch in chunks(session.execute(runs), diff.batch_size):
+            updated += len(batch)
+            merged = [id_ for ids, _ in batch for id_ in ids[1:]]
+            deleted += len(merged)
+            if dry_run:
+                continue
+            session.execute(delete.where(primary_key.in_(merged)))
+            session.execute(update, [
+                dict(pk=ids[0], ends=uppers[-1]) for ids, uppers in batch
+            ])
+        if not dry_run:
+            session.expire_all()
+        return Counts(add=0, update=updated, delete=deleted)
+
+
+class AsyncTemporalDiff(AsyncSQLAlchemyDiff, TemporalDiff):
+    """
+    A :class:`TemporalDiff` for use with an
+    :class:`~sqlalchemy.ext.asyncio.AsyncSession`. :meth:`backfill` and
+    :meth:`compact` need a synchronous session, so use :class:`TemporalDiff`
+    for those.
+    """
+
+    def __init__(
+            self, session: AsyncSession, imported: Sequence[Imported], at: datetime
+    ):
+        self.at: datetime = at
+        if self.key_fields is None:
+            self.key_fields = self.model.key_columns
+        super(AsyncTemporalDiff, self).__init__(session, imported)
+
+
+def asyncpg_ranges(engine: AsyncEngine) -> None:
+    """
+    Have ``engine`` send the :class:`~psycopg2.extras.DateTimeRange` periods
+    that :class:`~mortar_mixins.Temporal` models use as the ranges that asyncpg
+    expects. Periods are loaded as asyncpg ranges, which have the same
+    ``lower`` and ``upper`` attributes.
+    """
+    from asyncpg import Range
+
+    def converted(value: Any) -> Any:
+        if not isinstance(value, DateTimeRange):
+            return value
+        if value.isempty:
+            return Range(empty=True)
+        return Range(
+            value.lower, value.upper,
+            lower_inc=value.lower_inc, upper_inc=value.upper_inc,
+        )
+
+    def before_cursor_execute(
+            conn, cursor, statement, parameters, context, executemany
+    ):
+        if executemany:
+            parameters = [tuple(converted(v) for v in p) for p in parameters]
+        else:
+            parameters = tuple(converted(v) for v in parameters)
+        return statement, parameters
+
+    event.listen(
+        engine.sync_engine, 'before_cursor_execute', before_cursor_execute, retval=True
+    )
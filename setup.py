@@ -24,10 +24,13 @@ setup(
             'pytest',
             'pytest-cov',
             'testfixtures',
-            'SQLAlchemy<2',
+            'SQLAlchemy[asyncio]<2',
+            'asyncpg',
             'mortar_mixins>=3',
             'mock',
+            'numpy',
         ],
+        columnar=['numpy'],
         build=['setuptools-git', 'wheel', 'twine'],
     ),
 )
@@ -1,8 +1,41 @@
+import asyncio
+from os import environ
+
 import pytest
 from mortar_mixins.testing import connection_in_transaction
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from mortar_import.temporal import asyncpg_ranges
 
 
 @pytest.fixture(scope='session')
 def db():
     with connection_in_transaction() as conn:
         yield conn
+
+
+@pytest.fixture()
+def run_async():
+    """
+    A function to run ``test(session)`` to completion, where ``session`` is an
+    AsyncSession on a connection with the tables of ``base`` created in a
+    transaction that is rolled back afterwards.
+    """
+    def run(base, test):
+        async def main():
+            url = make_url(environ['DB_URL']).set(drivername='postgresql+asyncpg')
+            engine = create_async_engine(url)
+            asyncpg_ranges(engine)
+            try:
+                async with engine.connect() as conn:
+                    transaction = await conn.begin()
+                    try:
+                        await conn.run_sync(base.metadata.create_all)
+                        return await test(AsyncSession(conn))
+                    finally:
+                        await transaction.rollback()
+            finally:
+                await engine.dispose()
+        return asyncio.run(main())
+    return run
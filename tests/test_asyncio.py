@@ -0,0 +1,215 @@
+import asyncio
+
+from testfixtures import compare, ShouldRaise
+
+from mortar_import.asyncio import AsyncDiff
+from mortar_import.diff import Counts
+from mortar_import.snapshot import Snapshot
+
+
+class Server:
+    """
+    An in-process stand-in for a remote store that is written to with
+    coroutines, recording the calls made and how many were in flight.
+    """
+
+    def __init__(self, **items):
+        self.items = items
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def rows(self):
+        for key, value in sorted(self.items.items()):
+            await asyncio.sleep(0)
+            yield key, value
+
+    async def call(self, name, *args):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if args and args[0] == 'fail':
+                raise ValueError('failed: ' + args[0])
+            await asyncio.sleep(0.01)
+            self.calls.append((name,) + args)
+        finally:
+            self.running -= 1
+
+
+async def aiter(items):
+    for item in items:
+        yield item
+
+
+def make_diff(server, **attrs):
+
+    class ServerDiff(AsyncDiff):
+
+        def extract_existing(self, obj):
+            return obj
+
+        extract_imported = extract_existing
+
+        async def add(self, key, imported, imported_extracted):
+            await server.call('add', key, imported_extracted)
+            server.items[key] = imported_extracted
+
+        async def update(
+                self, key, existing, existing_extracted, imported, imported_extracted
+        ):
+            await server.call('update', key, imported_extracted)
+            server.items[key] = imported_extracted
+
+        async def delete(self, key, existing, existing_extracted):
+            await server.call('delete', key)
+            del server.items[key]
+
+    for name, value in attrs.items():
+        setattr(ServerDiff, name, value)
+    return ServerDiff
+
+
+class TestAsyncDiff:
+
+    def test_apply(self):
+        server = Server(a=1, b=2, c=3)
+        diff = make_diff(server)(
+            server.rows(), aiter([('a', 1), ('b', 4), ('d', 5)])
+        )
+        compare(asyncio.run(diff.apply()), expected=Counts(add=1, update=1, delete=1))
+        compare(server.calls, expected=[
+            ('delete', 'c'),
+            ('update', 'b', 4),
+            ('add', 'd', 5),
+        ])
+        compare(server.items, expected={'a': 1, 'b': 4, 'd': 5})
+
+    def test_sync_iterables(self):
+        server = Server(a=1)
+        diff = make_diff(server)(list(server.items.items()), [('b', 2)])
+        compare(asyncio.run(diff.apply()), expected=Counts(add=1, update=0, delete=1))
+        compare(server.items, expected={'b': 2})
+
+    def test_compute(self):
+        server = Server(a=1)
+        diff = make_diff(server)(server.rows(), aiter([('a', 2)]))
+        asyncio.run(diff.compute())
+        compare(diff.to_add, expected=[])
+        compare(diff.to_update, expected=[('a', ('a', 1), 1, ('a', 2), 2)])
+        compare(diff.to_delete, expected=[])
+        compare(server.calls, expected=[])
+
+    def test_bounded_concurrency(self):
+        server = Server()
+        imported = [('k{:02d}'.format(i), i) for i in range(20)]
+        diff = make_diff(server, concurrency=3)(aiter([]), aiter(imported))
+        compare(asyncio.run(diff.apply()), expected=Counts(add=20, update=0, delete=0))
+        compare(server.max_running, expected=3)
+        compare(len(server.calls), expected=20)
+
+    def test_phases_do_not_overlap(self):
+        server = Server(**{'d{:02d}'.format(i): i for i in range(5)})
+        events = []
+
+        def post(op):
+            def post_op(self):
+                events.append(('post', op, server.running))
+            return post_op
+
+        diff = make_diff(
+            server,
+            post_delete=post('delete'),
+            post_update=post('update'),
+            post_add=post('add'),
+        )(server.rows(), aiter([('a{:02d}'.format(i), i) for i in range(5)]))
+        asyncio.run(diff.apply())
+        compare(events, expected=[
+            ('post', 'delete', 0),
+            ('post', 'update', 0),
+            ('post', 'add', 0),
+        ])
+        compare(
+            [call[0] for call in server.calls], expected=['delete'] * 5 + ['add'] * 5
+        )
+
+    def test_async_post_hook(self):
+        server = Server(a=1)
+
+        async def post_delete(self):
+            await server.call('flush')
+
+        diff = make_diff(server, post_delete=post_delete)(server.rows(), aiter([]))
+        asyncio.run(diff.apply())
+        compare(server.calls, expected=[('delete', 'a'), ('flush',)])
+
+    def test_many(self):
+        server = Server()
+        batches = []
+
+        async def add_many(self, batch):
+            await server.call('add_many', len(batch))
+            batches.append([change.key for change in batch])
+
+        diff = make_diff(server, add_many=add_many, batch_size=2)(
+            aiter([]), aiter([('a', 1), ('b', 2), ('c', 3)])
+        )
+        compare(asyncio.run(diff.apply()), expected=Counts(add=3, update=0, delete=0))
+        compare(sorted(batches), expected=[['a', 'b'], ['c']])
+
+    def test_failure_cancels_pending(self):
+        server = Server()
+        diff = make_diff(server, concurrency=2)(
+            aiter([]), aiter([('fail', 0), ('b', 1), ('c', 2), ('d', 3)])
+        )
+        with ShouldRaise(ValueError('failed: fail')):
+            asyncio.run(diff.apply())
+        compare(server.running, expected=0)
+        compare(server.calls, expected=[('add', 'b', 1), ('add', 'c', 2)])
+
+    def test_sorted_inputs(self):
+        with ShouldRaise(TypeError('sorted_inputs cannot be used with AsyncDiff')):
+            make_diff(Server(), sorted_inputs=True)([], [])
+
+    def test_save_snapshot(self, tmp_path):
+        server = Server(a=1)
+        diff = make_diff(
+            server,
+            snapshot=Snapshot(str(tmp_path / 'snapshot.db')),
+            existing_fingerprint=lambda self: len(server.items),
+        )(server.rows(), aiter([('a', 1), ('b', 2)]))
+        with ShouldRaise(TypeError('save_snapshot() can only be called after apply()')):
+            diff.save_snapshot()
+        asyncio.run(diff.apply())
+        diff.save_snapshot()
+        assert diff.snapshot.valid(2)
+
+    def test_streaming(self):
+        with ShouldRaise(TypeError('streaming cannot be used with AsyncDiff')):
+            make_diff(Server(), streaming=True)([], [])
+
+    def test_iter_changes(self):
+        diff = make_diff(Server())([], [('a', 1)])
+        with ShouldRaise(
+            TypeError('AsyncDiff must be awaited, use compute() or apply() instead')
+        ):
+            diff.iter_changes()
+
+    def test_imported_problem_handled_before_existing(self):
+        server = Server(a=1, b=2)
+        seen = []
+
+        def handle_imported_problem(self, key, dups):
+            yield key, dups[0][0], dups[0][1]
+            yield 'b', dups[1][0], dups[1][1]
+
+        async def existing():
+            seen.append(set(diff.imported_keys))
+            async for row in server.rows():
+                yield row
+
+        diff = make_diff(server, handle_imported_problem=handle_imported_problem)(
+            existing(), aiter([('a', 3), ('a', 4)])
+        )
+        compare(asyncio.run(diff.apply()), expected=Counts(add=0, update=2, delete=0))
+        compare(seen, expected=[{'a', 'b'}])
+        compare(server.items, expected={'a': 3, 'b': 4})
@@ -0,0 +1,257 @@
+from collections import namedtuple
+
+import numpy as np
+from mock import Mock, call
+from testfixtures import compare, ShouldRaise
+
+from mortar_import.columnar import ColumnarDiff, to_columns
+from mortar_import.diff import Addition, Update, Deletion, Counts
+
+
+def make_differ(**attrs):
+    mock = Mock()
+
+    class TestDiff(ColumnarDiff):
+        key_fields = ('key',)
+        add = mock.add
+        update = mock.update
+        delete = mock.delete
+
+    for name, value in attrs.items():
+        setattr(TestDiff, name, value)
+    return TestDiff, mock
+
+
+class TestToColumns:
+
+    def test_mapping(self):
+        columns = to_columns({'key': ['a', 'b'], 'value': [1, 2]})
+        compare(columns['key'].tolist(), expected=['a', 'b'])
+        compare(columns['value'].dtype, expected=np.dtype(int))
+
+    def test_dicts(self):
+        columns = to_columns([dict(key='a', value=1), dict(key='b', value=2)])
+        compare({name: column.tolist() for name, column in columns.items()},
+                expected={'key': ['a', 'b'], 'value': [1, 2]})
+
+    def test_named_tuples(self):
+        Row = namedtuple('Row', 'key value')
+        columns = to_columns([Row('a', 1), Row('b', 2)])
+        compare({name: column.tolist() for name, column in columns.items()},
+                expected={'key': ['a', 'b'], 'value': [1, 2]})
+
+    def test_empty(self):
+        compare(to_columns([]), expected={})
+
+    def test_mixed_types(self):
+        columns = to_columns([
+            dict(key='a', value=3, other=1),
+            dict(key='b', value=4.5, other='x'),
+        ])
+        compare(columns['value'].dtype, expected=np.dtype(object))
+        compare(columns['value'].tolist(), expected=[3, 4.5])
+        compare([type(value) for value in columns['value'].tolist()],
+                expected=[int, float])
+        compare(columns['other'].tolist(), expected=[1, 'x'])
+
+    def test_arrays_left_alone(self):
+        values = np.array([1.0, 2.0])
+        assert to_columns({'value': values})['value'] is values
+
+    def test_mixed_types_diff(self):
+        TestDiff, mock = make_differ()
+        diff = TestDiff(
+            [dict(key='a', value=3), dict(key='b', value=1.5)],
+            [dict(key='a', value=3), dict(key='b', value='1.5')],
+        )
+        compare(diff.apply(), expected=Counts(add=0, update=1, delete=0))
+        compare(mock.mock_calls, expected=[
+            call.update(
+                'b', 1, dict(key='b', value=1.5), 1, dict(key='b', value='1.5')
+            ),
+        ])
+
+
+class TestColumnarDiff:
+
+    def test_compute(self):
+        TestDiff, mock = make_differ()
+        diff = TestDiff(
+            {'key': ['c', 'a', 'b'], 'value': [3, 1, 2]},
+            {'key': ['d', 'b', 'c'], 'value': [4, 2, 5]},
+        )
+        diff.compute()
+        compare(diff.to_add, expected=[
+            Addition('d', 0, {'key': 'd', 'value': 4}),
+        ])
+        compare(diff.to_update, expected=[
+            Update('c', 0, {'key': 'c', 'value': 3}, 2, {'key': 'c', 'value': 5}),
+        ])
+        compare(diff.to_delete, expected=[
+            Deletion('a', 1, {'key': 'a', 'value': 1}),
+        ])
+        compare(mock.mock_calls, expected=[])
+
+    def test_apply(self):
+        TestDiff, mock = make_differ()
+        diff = TestDiff(
+            [dict(key='a', value=1.0), dict(key='b', value=2.0)],
+            [dict(key='b', value=2.5), dict(key='c', value=3.0)],
+        )
+        compare(diff.apply(), expected=Counts(add=1, update=1, delete=1))
+        compare(mock.mock_calls, expected=[
+            call.delete('a', 0, {'key': 'a', 'value': 1.0}),
+            call.update('b', 1, {'key': 'b', 'value': 2.0},
+                        0, {'key': 'b', 'value': 2.5}),
+            call.add('c', 1, {'key': 'c', 'value': 3.0}),
+        ])
+
+    def test_multi_column_key(self):
+        Row = namedtuple('Row', 'name index value')
+        TestDiff, mock = make_differ(key_fields=('name', 'index'))
+        diff = TestDiff(
+            [Row('a', 2, 0), Row('a', 10, 0), Row('b', 1, 0)],
+            [Row('b', 1, 0), Row('a', 10, 1), Row('a', 3, 0)],
+        )
+        diff.compute()
+        compare([c.key for c in diff.to_add], expected=[('a', 3)])
+        compare([c.key for c in diff.to_update], expected=[('a', 10)])
+        compare([c.key for c in diff.to_delete], expected=[('a', 2)])
+
+    def test_ordering(self):
+        TestDiff, mock = make_differ(ordering='imported')
+        diff = TestDiff(
+            {'key': [1, 2, 3], 'value': [0, 0, 0]},
+            {'key': [5, 3, 4, 2], 'value': [0, 1, 0, 1]},
+        )
+        compare([c.key for c in diff.iter_changes()], expected=[1, 3, 2, 5, 4])
+
+    def test_unknown_ordering(self):
+        TestDiff, mock = make_differ(ordering='foo')
+        with ShouldRaise(ValueError("Unknown ordering: 'foo'")):
+            TestDiff({'key': [1]}, {'key': [1]}).compute()
+
+    def test_empty_sides(self):
+        TestDiff, mock = make_differ()
+        diff = TestDiff([], {'key': [1, 2]})
+        compare([c.key for c in diff.iter_changes()], expected=[1, 2])
+        diff = TestDiff({'key': [1, 2]}, [])
+        compare([c.key for c in diff.iter_changes()], expected=[1, 2])
+        compare(TestDiff([], []).apply(), expected=Counts(add=0, update=0, delete=0))
+
+    def test_different_fields(self):
+        TestDiff, mock = make_differ()
+        diff = TestDiff(
+            {'key': [1, 2], 'value': [0, 0]},
+            {'key': [1, 2], 'value': [0, 0], 'other': [0, 0]},
+        )
+        compare([c.key for c in diff.iter_changes()], expected=[1, 2])
+
+    def test_batches(self):
+        batches = []
+        TestDiff, mock = make_differ(
+            batch_size=2, add_many=lambda self, batch: batches.append(batch)
+        )
+        diff = TestDiff({'key': []}, {'key': np.arange(5), 'value': np.arange(5)})
+        compare(diff.apply(), expected=Counts(add=5, update=0, delete=0))
+        compare([[c.key for c in batch] for batch in batches],
+                expected=[[0, 1], [2, 3], [4]])
+        compare(type(batches[0][0].key), expected=int)
+
+    def test_duplicates(self):
+        TestDiff, mock = make_differ()
+        diff = TestDiff(
+            {'key': ['b', 'a', 'b'], 'value': [1, 2, 3]},
+            {'key': ['a', 'a'], 'value': [4, 5]},
+        )
+        with ShouldRaise(AssertionError(
+            "'a' occurs 2 times in imported: "
+            "{'key': 'a', 'value': 4} from 0, {'key': 'a', 'value': 5} from 1\n"
+            "'b' occurs 2 times in existing: "
+            "{'key': 'b', 'value': 1} from 0, {'key': 'b', 'value': 3} from 2"
+        )):
+            diff.compute()
+
+    def test_key_types_differ(self):
+        TestDiff, mock = make_differ(ordering=None)
+        diff = TestDiff(
+            {'key': [1, 2], 'value': [0, 0]},
+            {'key': ['1', '2'], 'value': [0, 0]},
+        )
+        compare(diff.apply(), expected=Counts(add=2, update=0, delete=2))
+        compare(mock.mock_calls, expected=[
+            call.delete(1, 0, {'key': 1, 'value': 0}),
+            call.delete(2, 1, {'key': 2, 'value': 0}),
+            call.add('1', 0, {'key': '1', 'value': 0}),
+            call.add('2', 1, {'key': '2', 'value': 0}),
+        ])
+
+    def test_key_types_differ_sorted(self):
+        TestDiff, mock = make_differ()
+        diff = TestDiff(
+            {'key': [3, 1], 'value': [0, 0]},
+            {'key': [2.5, 0.5, 3.0], 'value': [0, 0, 1]},
+        )
+        compare([c.key for c in diff.iter_changes()], expected=[1, 3, 0.5, 2.5])
+
+    def test_unsortable_keys(self):
+        TestDiff, mock = make_differ(ordering=None)
+        diff = TestDiff(
+            {'key': [None, 'a'], 'value': [0, 0]},
+            {'key': ['a', 'b', None], 'value': [1, 0, 0]},
+        )
+        compare(diff.apply(), expected=Counts(add=1, update=1, delete=0))
+        compare(mock.mock_calls, expected=[
+            call.update('a', 1, {'key': 'a', 'value': 0}, 0, {'key': 'a', 'value': 1}),
+            call.add('b', 1, {'key': 'b', 'value': 0}),
+        ])
+
+    def test_unsortable_keys_duplicated(self):
+        TestDiff, mock = make_differ(ordering=None)
+        diff = TestDiff(
+            {'key': [None, 'a', None], 'value': [1, 2, 3]},
+            {'key': [], 'value': []},
+        )
+        with ShouldRaise(AssertionError(
+            "None occurs 2 times in existing: "
+            "{'key': None, 'value': 1} from 0, {'key': None, 'value': 3} from 2"
+        )):
+            diff.compute()
+
+    def test_unsortable_keys_sorted(self):
+        TestDiff, mock = make_differ()
+        diff = TestDiff({'key': [None, 'a'], 'value': [0, 0]}, {'key': [], 'value': []})
+        with ShouldRaise(TypeError):
+            diff.compute()
+
+    def test_multi_column_object_key(self):
+        TestDiff, mock = make_differ(key_fields=('a', 'b'), ordering=None)
+        diff = TestDiff(
+            {'a': [1, 1], 'b': [None, 'x'], 'value': [0, 0]},
+            {'a': [1, 1], 'b': ['x', None], 'value': [1, 0]},
+        )
+        compare(diff.apply(), expected=Counts(add=0, update=1, delete=0))
+        compare(mock.update.call_args.args[0], expected=(1, 'x'))
+
+    def test_extract(self):
+        TestDiff, mock = make_differ(key_fields=('key', 'other'))
+        diff = TestDiff({'key': [1], 'other': ['x']}, {'key': [2], 'other': ['y']})
+        compare(diff.extract_existing(0), expected=((1, 'x'), {'key': 1, 'other': 'x'}))
+        compare(diff.extract_imported(0), expected=((2, 'y'), {'key': 2, 'other': 'y'}))
+
+    def test_key_fields_required(self):
+        TestDiff, mock = make_differ(key_fields=None)
+        with ShouldRaise(TypeError('key_fields must be specified')):
+            TestDiff([], [])
+
+    def test_unsupported(self):
+        TestDiff, mock = make_differ(sorted_inputs=True)
+        with ShouldRaise(TypeError('sorted_inputs cannot be used with ColumnarDiff')):
+            TestDiff([], [])
+
+    def test_problem_handler(self):
+        TestDiff, mock = make_differ(handle_imported_problem=lambda self, key, dups: [])
+        with ShouldRaise(TypeError(
+            'handle_imported_problem cannot be used with ColumnarDiff'
+        )):
+            TestDiff([], [])
@@ -1,12 +1,37 @@
+import os
+import threading
+import time
+import weakref
 from collections import namedtuple
 
+import pytest
 from mock import Mock, call
 from testfixtures import compare, ShouldRaise
 
-from mortar_import.diff import Diff
+from mortar_import.diff import Diff, Addition, Update, Deletion, Counts
 from mortar_import.extractors import DictExtractor, NamedTupleExtractor
 
 
+class ProcessDiff(Diff):
+    # defined here so that it can be pickled for worker processes
+
+    processes = 2
+    batch_size = 2
+
+    def extract_existing(self, obj):
+        return obj[0], obj[1]
+
+    def extract_imported(self, obj):
+        if obj[1] is None:
+            return None
+        return obj[0], (obj[1], os.getpid())
+
+    def differs(self, existing_extracted, imported_extracted):
+        return existing_extracted != imported_extracted[0]
+
+    add = update = delete = None
+
+
 class TestPlain:
 
     def test_abstract(self):
@@ -44,7 +69,7 @@ class TestPlain:
 
         compare([], mock.mock_calls)
 
-        diff.apply()
+        compare(diff.apply(), expected=Counts(add=1, update=1, delete=1))
 
         compare(
             [
@@ -348,3 +373,845 @@ class TestPlain:
             ],
             mock.mock_calls,
         )
+
+    def test_sorted_inputs(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.sorted_inputs = True
+
+        diff = DiffTuple(
+            iter([('a', 1, 2), ('b', 3, 4), ('c', 5, 6), ('e', 9, 10)]),
+            iter([('b', 3, 4), ('c', 5, 7), ('d', 7, 8), ('f', 11, 12)]),
+        )
+
+        diff.compute()
+
+        compare([('d', ('d', 7, 8), ('d', 8)), ('f', ('f', 11, 12), ('f', 12))],
+                diff.to_add)
+        compare([('c', ('c', 5, 6), ('c', 6), ('c', 5, 7), ('c', 7))], diff.to_update)
+        compare([('a', ('a', 1, 2), ('a', 2)), ('e', ('e', 9, 10), ('e', 10))],
+                diff.to_delete)
+
+        diff.apply()
+
+        compare(
+            [
+                call.delete('a', ('a', 1, 2), ('a', 2)),
+                call.delete('e', ('e', 9, 10), ('e', 10)),
+                call.update('c', ('c', 5, 6), ('c', 6), ('c', 5, 7), ('c', 7)),
+                call.add('d', ('d', 7, 8), ('d', 8)),
+                call.add('f', ('f', 11, 12), ('f', 12)),
+            ],
+            mock.mock_calls,
+        )
+
+    def test_sorted_inputs_not_sorted(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.sorted_inputs = True
+
+        diff = DiffTuple([], [('b', 3, 4), ('a', 1, 2)])
+
+        with ShouldRaise(ValueError("imported is not sorted: 'a' follows 'b'")):
+            diff.compute()
+
+        compare(diff.to_add, expected=None)
+
+    def test_sorted_inputs_duplicate_keys(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.sorted_inputs = True
+
+        diff = DiffTuple(
+            [('a', 1, 2), ('a', 3, 4), ('b', 1, 2), ('b', 3, 4)],
+            [('c', 1, 2), ('c', 3, 4)],
+        )
+
+        with ShouldRaise(
+            AssertionError(
+                "'a' occurs 2 times in existing: "
+                "('a', 2) from ('a', 1, 2), "
+                "('a', 4) from ('a', 3, 4)\n"
+                "'b' occurs 2 times in existing: "
+                "('b', 2) from ('b', 1, 2), "
+                "('b', 4) from ('b', 3, 4)\n"
+                "'c' occurs 2 times in imported: "
+                "('c', 2) from ('c', 1, 2), "
+                "('c', 4) from ('c', 3, 4)"
+            )
+        ):
+            diff.compute()
+
+        compare(diff.to_add, expected=None)
+
+    def test_sorted_inputs_duplicate_key_dealt_with_new_key(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.sorted_inputs = True
+
+        def handle_imported_problem(self, key, dups):
+            for raw, extracted in reversed(dups):
+                yield key + str(raw[1]), raw, extracted
+
+        DiffTuple.handle_imported_problem = handle_imported_problem
+
+        diff = DiffTuple([], [('a', 1, 2), ('a', 3, 4), ('b', 5, 6)])
+
+        diff.apply()
+
+        compare(
+            [
+                call.add('a1', ('a', 1, 2), ('a', 2)),
+                call.add('a3', ('a', 3, 4), ('a', 4)),
+                call.add('b', ('b', 5, 6), ('b', 6)),
+            ],
+            mock.mock_calls,
+        )
+
+    def test_sorted_inputs_duplicate_key_dealt_with_later_key(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.sorted_inputs = True
+
+        def handle_existing_problem(self, key, dups):
+            (raw1, extracted1), (raw2, extracted2) = dups
+            yield 'b1', raw1, extracted1
+            yield 'z', raw2, extracted2
+
+        DiffTuple.handle_existing_problem = handle_existing_problem
+
+        diff = DiffTuple(
+            [('a', 1, 1), ('b', 2, 2), ('b', 3, 3), ('c', 4, 4), ('y', 5, 5)],
+            [('a', 0, 1), ('b1', 0, 2), ('c', 0, 5), ('z', 0, 3)],
+        )
+        compare(diff.apply(), expected=Counts(add=0, update=3, delete=1))
+
+        # 'z' is matched with the existing 'b' that was handled as 'z':
+        compare(
+            [
+                call.delete('y', ('y', 5, 5), ('y', 5)),
+                call.update('b1', ('b', 2, 2), ('b', 2), ('b1', 0, 2), ('b1', 2)),
+                call.update('c', ('c', 4, 4), ('c', 4), ('c', 0, 5), ('c', 5)),
+                call.update('z', ('b', 3, 3), ('b', 3), ('z', 0, 3), ('z', 3)),
+            ],
+            mock.mock_calls,
+        )
+
+    def test_sorted_inputs_duplicate_key_dealt_with_earlier_key(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.sorted_inputs = True
+
+        def handle_imported_problem(self, key, dups):
+            yield 'a', dups[0][0], dups[0][1]
+
+        DiffTuple.handle_imported_problem = handle_imported_problem
+
+        diff = DiffTuple([], [('b', 1, 2), ('c', 3, 4), ('c', 5, 6)])
+
+        with ShouldRaise(ValueError(
+            "Problem handling for 'c' resulted in 'a', which sorts before 'b' "
+            "in imported"
+        )):
+            diff.compute()
+
+    def test_sorted_inputs_duplicate_key_dealt_with_wrong(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.sorted_inputs = True
+
+        def handle_imported_problem(self, key, dups):
+            return [('b', dups[0][0], dups[0][1])]
+
+        DiffTuple.handle_imported_problem = handle_imported_problem
+
+        diff = DiffTuple([], [('a', 1, 2), ('a', 3, 4), ('b', 5, 6)])
+
+        with ShouldRaise(
+            ValueError("Problem handling for 'b' resulted in duplicate key")
+        ):
+            diff.compute()
+
+    def test_iter_changes(self):
+
+        DiffTuple, mock = self.make_differ()
+
+        diff = DiffTuple(
+            [('a', 1, 2), ('b', 3, 4), ('c', 5, 6)],
+            [('b', 3, 4), ('c', 5, 7), ('d', 7, 8)],
+        )
+
+        changes = diff.iter_changes()
+        compare(next(changes), expected=Deletion('a', ('a', 1, 2), ('a', 2)))
+        compare(
+            list(changes),
+            expected=[
+                Update('c', ('c', 5, 6), ('c', 6), ('c', 5, 7), ('c', 7)),
+                Addition('d', ('d', 7, 8), ('d', 8)),
+            ]
+        )
+        compare(diff.to_add, expected=None)
+        compare([], mock.mock_calls)
+
+    def test_iter_changes_some_ops(self):
+
+        DiffTuple, mock = self.make_differ()
+
+        diff = DiffTuple(
+            [('a', 1, 2), ('b', 3, 4), ('c', 5, 6)],
+            [('b', 3, 4), ('c', 5, 7), ('d', 7, 8)],
+        )
+
+        compare(
+            list(diff.iter_changes(['add', 'delete'])),
+            expected=[
+                Addition('d', ('d', 7, 8), ('d', 8)),
+                Deletion('a', ('a', 1, 2), ('a', 2)),
+            ]
+        )
+
+    def test_iter_changes_after_compute(self):
+
+        DiffTuple, mock = self.make_differ()
+
+        diff = DiffTuple([('a', 1, 2)], [('a', 1, 3), ('b', 3, 4)])
+        diff.compute()
+        diff.to_update = []
+
+        compare(
+            list(diff.iter_changes()),
+            expected=[Addition('b', ('b', 3, 4), ('b', 4))]
+        )
+
+    def test_streaming(self):
+
+        mock = Mock()
+
+        class DiffTuple(Diff):
+
+            streaming = True
+
+            def extract_existing(self, obj):
+                mock.extract_existing(obj)
+                return obj[0], obj
+
+            extract_imported = extract_existing
+
+            add = mock.add
+            update = mock.update
+            delete = mock.delete
+            post_add = mock.post_add
+            post_update = mock.post_update
+            post_delete = mock.post_delete
+
+        diff = DiffTuple([('a', 1), ('b', 2)], [('b', 3), ('c', 4)])
+        diff.apply()
+
+        compare(
+            [
+                call.extract_existing(('a', 1)),
+                call.extract_existing(('b', 2)),
+                call.extract_existing(('b', 3)),
+                call.extract_existing(('c', 4)),
+                call.delete('a', ('a', 1), ('a', 1)),
+                call.post_delete(),
+                call.update('b', ('b', 2), ('b', 2), ('b', 3), ('b', 3)),
+                call.post_update(),
+                call.add('c', ('c', 4), ('c', 4)),
+                call.post_add(),
+            ],
+            mock.mock_calls,
+        )
+        compare(diff.to_add, expected=None)
+
+    def test_streaming_sorted_inputs(self):
+
+        mock = Mock()
+
+        class DiffTuple(Diff):
+
+            streaming = True
+            sorted_inputs = True
+
+            def extract_existing(self, obj):
+                mock.extract_existing(obj)
+                return obj[0], obj
+
+            def extract_imported(self, obj):
+                mock.extract_imported(obj)
+                return obj[0], obj
+
+            add = mock.add
+            update = mock.update
+            delete = mock.delete
+            post_delete = mock.post_delete
+
+        diff = DiffTuple([('a', 1), ('b', 2)], [('b', 3), ('c', 4)])
+        diff.apply()
+
+        compare(
+            [
+                # checked for problems first:
+                call.extract_existing(('a', 1)),
+                call.extract_existing(('b', 2)),
+                call.extract_imported(('b', 3)),
+                call.extract_imported(('c', 4)),
+                call.extract_existing(('a', 1)),
+                call.extract_existing(('b', 2)),
+                call.extract_imported(('b', 3)),
+                call.extract_imported(('c', 4)),
+                call.delete('a', ('a', 1), ('a', 1)),
+                call.post_delete(),
+                call.extract_existing(('a', 1)),
+                call.extract_existing(('b', 2)),
+                call.extract_imported(('b', 3)),
+                call.extract_imported(('c', 4)),
+                call.update('b', ('b', 2), ('b', 2), ('b', 3), ('b', 3)),
+                call.extract_existing(('a', 1)),
+                call.extract_existing(('b', 2)),
+                call.extract_imported(('b', 3)),
+                call.extract_imported(('c', 4)),
+                call.add('c', ('c', 4), ('c', 4)),
+            ],
+            mock.mock_calls,
+        )
+
+    def test_streaming_sorted_inputs_duplicate_keys(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.streaming = DiffTuple.sorted_inputs = True
+
+        diff = DiffTuple(
+            [('a', 1, 2), ('b', 1, 2)],
+            [('c', 1, 2), ('c', 3, 4)],
+        )
+
+        with ShouldRaise(AssertionError(
+            "'c' occurs 2 times in imported: "
+            "('c', 2) from ('c', 1, 2), "
+            "('c', 4) from ('c', 3, 4)"
+        )):
+            diff.apply()
+
+        compare([], mock.mock_calls)
+
+    def test_streaming_sorted_inputs_not_reiterable(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.streaming = DiffTuple.sorted_inputs = True
+
+        diff = DiffTuple([('a', 1, 2)], iter([('b', 3, 4)]))
+
+        with ShouldRaise(TypeError(
+            'imported must be re-iterable to stream changes from sorted inputs'
+        )):
+            diff.apply()
+
+        compare([], mock.mock_calls)
+
+    def test_ordering_imported(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.ordering = 'imported'
+
+        diff = DiffTuple(
+            [('z', 1, 2), ('c', 5, 6), ('b', 3, 4), ('a', 1, 2), (None, 0, 0)],
+            [('b', 3, 5), ('d', 7, 8), ('c', 5, 7), (None, 1, 1), ('e', 9, 9)],
+        )
+
+        diff.apply()
+
+        compare(
+            [
+                call.delete('z', ('z', 1, 2), ('z', 2)),
+                call.delete('a', ('a', 1, 2), ('a', 2)),
+                call.update('b', ('b', 3, 4), ('b', 4), ('b', 3, 5), ('b', 5)),
+                call.update('c', ('c', 5, 6), ('c', 6), ('c', 5, 7), ('c', 7)),
+                call.update(None, (None, 0, 0), (None, 0), (None, 1, 1), (None, 1)),
+                call.add('d', ('d', 7, 8), ('d', 8)),
+                call.add('e', ('e', 9, 9), ('e', 9)),
+            ],
+            mock.mock_calls,
+        )
+
+    def test_ordering_existing(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.ordering = 'existing'
+
+        diff = DiffTuple(
+            [('z', 1, 2), ('c', 5, 6), ('b', 3, 4), ('a', 1, 2), (None, 0, 0)],
+            [('b', 3, 5), ('d', 7, 8), ('c', 5, 7), (None, 1, 1), ('e', 9, 9)],
+        )
+
+        diff.apply()
+
+        compare(
+            [
+                call.delete('z', ('z', 1, 2), ('z', 2)),
+                call.delete('a', ('a', 1, 2), ('a', 2)),
+                call.update('c', ('c', 5, 6), ('c', 6), ('c', 5, 7), ('c', 7)),
+                call.update('b', ('b', 3, 4), ('b', 4), ('b', 3, 5), ('b', 5)),
+                call.update(None, (None, 0, 0), (None, 0), (None, 1, 1), (None, 1)),
+                call.add('d', ('d', 7, 8), ('d', 8)),
+                call.add('e', ('e', 9, 9), ('e', 9)),
+            ],
+            mock.mock_calls,
+        )
+
+    def test_ordering_none(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.ordering = None
+
+        diff = DiffTuple(
+            [('a', 1, 2), ('b', 3, 4), (None, 5, 6), (1, 0, 0)],
+            [('b', 3, 4), (None, 5, 7), ('d', 7, 8), (2, 0, 0)],
+        )
+
+        diff.compute()
+
+        compare(
+            sorted(diff.to_add, key=lambda c: str(c.key)),
+            expected=[(2, (2, 0, 0), (2, 0)), ('d', ('d', 7, 8), ('d', 8))],
+        )
+        compare(diff.to_update, expected=[
+            (None, (None, 5, 6), (None, 6), (None, 5, 7), (None, 7))
+        ])
+        compare(
+            sorted(diff.to_delete, key=lambda c: str(c.key)),
+            expected=[(1, (1, 0, 0), (1, 0)), ('a', ('a', 1, 2), ('a', 2))],
+        )
+
+    def test_ordering_none_duplicate_keys(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.ordering = None
+
+        diff = DiffTuple([], [('b', 1, 2), (None, 1, 2), ('b', 3, 4), (None, 3, 4)])
+
+        with ShouldRaise(
+            AssertionError(
+                "'b' occurs 2 times in imported: "
+                "('b', 2) from ('b', 1, 2), "
+                "('b', 4) from ('b', 3, 4)\n"
+                "None occurs 2 times in imported: "
+                "(None, 2) from (None, 1, 2), "
+                "(None, 4) from (None, 3, 4)"
+            )
+        ):
+            diff.compute()
+
+    def test_ordering_unknown(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.ordering = 'foo'
+
+        diff = DiffTuple([], [('a', 1, 2)])
+
+        with ShouldRaise(ValueError("Unknown ordering: 'foo'")):
+            diff.compute()
+
+    def test_update_changed(self):
+        update = Update(
+            'a',
+            None, dict(k='a', x=1, y=2, z=None),
+            None, dict(k='a', x=1, y=3, w=None),
+        )
+        compare(update.changed, expected={'y', 'w'})
+
+    def test_update_changed_nothing(self):
+        update = Update('a', None, dict(k='a', x=1), None, dict(k='a', x=1))
+        compare(update.changed, expected=set())
+
+    def test_batches(self):
+
+        mock = Mock()
+
+        class DiffTuple(Diff):
+
+            batch_size = 2
+
+            def extract_existing(self, obj):
+                return obj[0], obj
+
+            extract_imported = extract_existing
+
+            add = mock.add
+            update = mock.update
+            delete = mock.delete
+            add_many = mock.add_many
+            delete_many = mock.delete_many
+            post_add = mock.post_add
+            post_update = mock.post_update
+            post_delete = mock.post_delete
+
+        diff = DiffTuple(
+            [('a1', 1), ('a2', 1), ('a3', 1), ('c1', 6)],
+            [('c1', 7), ('d1', 8), ('d2', 8)],
+        )
+        compare(diff.apply(), expected=Counts(add=2, update=1, delete=3))
+
+        compare(
+            [
+                call.delete_many([
+                    Deletion('a1', ('a1', 1), ('a1', 1)),
+                    Deletion('a2', ('a2', 1), ('a2', 1)),
+                ]),
+                call.delete_many([
+                    Deletion('a3', ('a3', 1), ('a3', 1)),
+                ]),
+                call.post_delete(),
+                call.update('c1', ('c1', 6), ('c1', 6), ('c1', 7), ('c1', 7)),
+                call.post_update(),
+                call.add_many([
+                    Addition('d1', ('d1', 8), ('d1', 8)),
+                    Addition('d2', ('d2', 8), ('d2', 8)),
+                ]),
+                call.post_add(),
+            ],
+            mock.mock_calls,
+        )
+
+    def test_batches_streaming_nothing_to_do(self):
+
+        mock = Mock()
+
+        class DiffTuple(Diff):
+
+            streaming = True
+
+            def extract_existing(self, obj):
+                return obj[0], obj
+
+            extract_imported = extract_existing
+
+            add = mock.add
+            update = mock.update
+            delete = mock.delete
+            add_many = mock.add_many
+            update_many = mock.update_many
+            delete_many = mock.delete_many
+            post_update = mock.post_update
+
+        diff = DiffTuple([('a', 1)], [('a', 1)])
+        diff.apply()
+
+        compare([call.post_update()], mock.mock_calls)
+
+    def test_unchanged_released(self):
+
+        class Raw:
+            def __init__(self, key, value):
+                self.key, self.value = key, value
+
+        mock = Mock()
+
+        class DiffObjects(Diff):
+
+            def extract_existing(self, obj):
+                return obj.key, obj.value
+
+            extract_imported = extract_existing
+
+            add = mock.add
+            update = mock.update
+            delete = mock.delete
+
+        unchanged = Raw('a', 1)
+        changed = Raw('b', 2)
+        unchanged_ref = weakref.ref(unchanged)
+        changed_ref = weakref.ref(changed)
+
+        diff = DiffObjects(iter([unchanged, changed]), [Raw('a', 1), Raw('b', 3)])
+        del unchanged, changed
+
+        diff.compute()
+
+        compare(unchanged_ref(), expected=None)
+        assert changed_ref() is not None
+        compare(diff.to_update[0].existing, expected=changed_ref())
+
+    def test_ordering_none_duplicate_keys_both(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.ordering = None
+
+        diff = DiffTuple([('b', 1, 2), ('b', 3, 4)], [('a', 1, 2), ('a', 3, 4)])
+
+        with ShouldRaise(
+            AssertionError(
+                "'b' occurs 2 times in existing: "
+                "('b', 2) from ('b', 1, 2), "
+                "('b', 4) from ('b', 3, 4)\n"
+                "'a' occurs 2 times in imported: "
+                "('a', 2) from ('a', 1, 2), "
+                "('a', 4) from ('a', 3, 4)"
+            )
+        ):
+            diff.compute()
+
+    def test_spill(self, tmp_path):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.spill_after = 2
+        DiffTuple.spill_partitions = 3
+        DiffTuple.spill_directory = str(tmp_path)
+
+        existing = [('a', 1), ('b', 2), ('c', 3), ('d', 4), ('e', 5)]
+        imported = [('b', 2), ('c', 6), ('e', 7), ('f', 8)]
+        diff = DiffTuple(existing, imported)
+
+        compare(diff.apply(), expected=Counts(add=1, update=2, delete=2))
+
+        calls = mock.mock_calls
+        compare(
+            [c[0] for c in calls],
+            expected=['delete', 'delete', 'update', 'update', 'add'],
+        )
+        compare(
+            sorted(calls, key=lambda c: (c[0], c[1][0])),
+            expected=[
+                call.add('f', ('f', 8), ('f', 8)),
+                call.delete('a', ('a', 1), ('a', 1)),
+                call.delete('d', ('d', 4), ('d', 4)),
+                call.update('c', ('c', 3), ('c', 3), ('c', 6), ('c', 6)),
+                call.update('e', ('e', 5), ('e', 5), ('e', 7), ('e', 7)),
+            ]
+        )
+        compare(list(tmp_path.iterdir()), expected=[])
+
+    def test_spill_partitions_from_count(self, tmp_path):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.spill_after = 4
+        DiffTuple.spill_directory = str(tmp_path)
+
+        partitions = []
+        mapped = DiffTuple._mapped
+
+        def _mapped(self, op):
+            partitions.append(op)
+            return mapped(self, op)
+
+        DiffTuple._mapped = _mapped
+
+        existing = [(str(i), i) for i in range(200)]
+        imported = [(str(i), i * 2) for i in range(1, 201)]
+        diff = DiffTuple(existing, imported)
+
+        compare(diff.apply(), expected=Counts(add=1, update=199, delete=1))
+        # 200 objects on each side with no more than 4 per partition:
+        compare(len(partitions), expected=3 * 50)
+        compare(list(tmp_path.iterdir()), expected=[])
+
+    def test_spill_many_partitions_few_files(self, tmp_path):
+        resource = pytest.importorskip('resource')
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.spill_after = 10
+        DiffTuple.spill_directory = str(tmp_path)
+
+        existing = [(str(i), i) for i in range(5000)]
+        imported = [(str(i), i * 2) for i in range(1, 5001)]
+        diff = DiffTuple(existing, imported)
+
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        # fewer than the 500 partitions each side is spilled to:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (64, hard))
+        try:
+            counts = diff.apply()
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+        compare(counts, expected=Counts(add=1, update=4999, delete=1))
+        compare(list(tmp_path.iterdir()), expected=[])
+
+    def test_spill_not_needed(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.spill_after = 3
+
+        diff = DiffTuple([('a', 1), ('b', 2)], [('b', 3), ('c', 4)])
+        diff.apply()
+
+        compare(
+            [
+                call.delete('a', ('a', 1), ('a', 1)),
+                call.update('b', ('b', 2), ('b', 2), ('b', 3), ('b', 3)),
+                call.add('c', ('c', 4), ('c', 4)),
+            ],
+            mock.mock_calls,
+        )
+
+    def test_spill_duplicate_keys(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.spill_after = 1
+
+        diff = DiffTuple(
+            [('b', 1, 2), ('b', 3, 4), ('c', 1, 1)],
+            [('a', 1, 2), ('a', 3, 4), ('c', 1, 2)],
+        )
+
+        with ShouldRaise(
+            AssertionError(
+                "'b' occurs 2 times in existing: "
+                "('b', 2) from ('b', 1, 2), "
+                "('b', 4) from ('b', 3, 4)\n"
+                "'a' occurs 2 times in imported: "
+                "('a', 2) from ('a', 1, 2), "
+                "('a', 4) from ('a', 3, 4)"
+            )
+        ):
+            diff.apply()
+
+        compare(mock.mock_calls, expected=[])
+
+    def test_spill_duplicate_key_dealt_with_new_key(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.spill_after = 1
+        DiffTuple.spill_partitions = 5
+
+        def handle_imported_problem(self, key, dups):
+            for raw, extracted in dups:
+                yield key + str(raw[1]), raw, extracted
+
+        DiffTuple.handle_imported_problem = handle_imported_problem
+
+        diff = DiffTuple([('a1', 2)], [('a', 1, 2), ('a', 3, 4), ('b', 5, 6)])
+        diff.compute()
+
+        compare(diff.to_delete, expected=[])
+        # the replacement for 'a' is compared with the existing 'a1', even
+        # though it may be in a different partition to the original:
+        compare(diff.to_update, expected=[
+            Update('a1', ('a1', 2), ('a1', 2), ('a', 1, 2), ('a', 2)),
+        ])
+        compare(
+            sorted(diff.to_add),
+            expected=[
+                Addition('a3', ('a', 3, 4), ('a', 4)),
+                Addition('b', ('b', 5, 6), ('b', 6)),
+            ]
+        )
+
+    def test_spill_duplicate_key_dealt_with_wrong(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.spill_after = 1
+
+        def handle_imported_problem(self, key, dups):
+            return [('b', dups[0][0], dups[0][1])]
+
+        DiffTuple.handle_imported_problem = handle_imported_problem
+
+        diff = DiffTuple([], [('a', 1, 2), ('a', 3, 4), ('b', 5, 6)])
+
+        with ShouldRaise(
+            ValueError("Problem handling for 'b' resulted in duplicate key")
+        ):
+            diff.apply()
+
+        compare(mock.mock_calls, expected=[])
+
+    def test_processes(self):
+        existing = [('a', 1), ('b', 2), ('c', 3), ('d', 4)]
+        imported = [('e', 5), ('b', 2), ('x', None), ('c', 6), ('a', 7), ('f', 8)]
+
+        diff = ProcessDiff(existing, imported)
+        diff.ordering = 'imported'
+        diff.compute()
+
+        compare([a.key for a in diff.to_add], expected=['e', 'f'])
+        compare([u.key for u in diff.to_update], expected=['c', 'a'])
+        compare([d.key for d in diff.to_delete], expected=['d'])
+        # the original objects are passed on:
+        assert diff.to_add[0].imported is imported[0]
+        assert diff.to_delete[0].existing is existing[3]
+
+        pids = {a.imported_extracted[1] for a in diff.to_add + diff.to_update}
+        assert os.getpid() not in pids
+
+    def test_processes_duplicate_keys(self):
+        diff = ProcessDiff([], [('a', 1), ('b', 2), ('c', 3), ('a', 4)])
+
+        with ShouldRaise(AssertionError) as s:
+            diff.compute()
+
+        assert str(s.raised).startswith("'a' occurs 2 times in imported: ")
+
+    def test_threads(self):
+        started = []
+        release = threading.Event()
+
+        class TestDiff(Diff):
+            threads = 3
+            ordering = 'imported'
+
+            def extract_existing(self, obj):
+                return obj
+
+            def extract_imported(self, obj):
+                started.append(obj[0])
+                if len(started) == 3:
+                    release.set()
+                # wait until three extractions are running at once:
+                assert release.wait(timeout=5)
+                if obj[1] is None:
+                    return None
+                return obj
+
+            add = update = delete = None
+
+        imported = [('c', 3), ('a', 1), ('x', None), ('b', 2), ('a', 4)]
+        diff = TestDiff([('b', 5)], imported)
+
+        with ShouldRaise(AssertionError(
+            "'a' occurs 2 times in imported: 1 from ('a', 1), 4 from ('a', 4)"
+        )):
+            diff.compute()
+
+        diff.imported = imported[:-1]
+        diff.compute()
+
+        compare([a.key for a in diff.to_add], expected=['c', 'a'])
+        compare([u.key for u in diff.to_update], expected=['b'])
+        compare(diff.to_delete, expected=[])
+
+    def test_threads_unordered(self):
+        order = []
+
+        class TestDiff(Diff):
+            threads = 2
+            threads_ordered = False
+            ordering = 'imported'
+
+            def extract_existing(self, obj):
+                return obj
+
+            def extract_imported(self, obj):
+                time.sleep(obj[1])
+                order.append(obj[0])
+                return obj
+
+            add = update = delete = None
+
+        diff = TestDiff([], [('a', 0.2), ('b', 0)])
+        diff.compute()
+
+        compare(order, expected=['b', 'a'])
+        compare([a.key for a in diff.to_add], expected=['b', 'a'])
+
+    def test_threads_unordered_sorted_inputs(self):
+
+        DiffTuple, mock = self.make_differ()
+        DiffTuple.threads = 2
+        DiffTuple.threads_ordered = False
+        DiffTuple.sorted_inputs = True
+
+        with ShouldRaise(
+            TypeError('threads_ordered must be set when using sorted_inputs')
+        ):
+            DiffTuple([], [])
@@ -0,0 +1,462 @@
+from datetime import datetime as dt
+from decimal import Decimal
+from enum import Enum
+
+import pytest
+from mortar_mixins.testing import create_tables_and_session
+from psycopg2.extras import DateTimeRange
+from sqlalchemy import (
+    Boolean, Column, DateTime, Enum as EnumType, Float, LargeBinary, Numeric, String
+)
+from sqlalchemy.dialects.postgresql import ARRAY, JSON, JSONB, TSRANGE
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.declarative import declarative_base
+from testfixtures import ShouldRaise, compare
+
+from mortar_import.diff import Counts
+from mortar_import.extractors import MultiKeyDictExtractor
+from mortar_import.postgres import PostgresDiff, copy_text, CopyBuffer
+from .test_sqlalchemy import Base, Simple, MultiPK, AutoPK, SingleColumn
+
+TypesBase = declarative_base()
+
+
+class Colour(Enum):
+    red = 1
+    green = 2
+
+
+class Types(TypesBase):
+    __tablename__ = 'types'
+    key = Column(String, primary_key=True)
+    data = Column(LargeBinary)
+    doc = Column(JSONB)
+    items = Column(JSON)
+    numbers = Column(ARRAY(Float))
+    texts = Column(ARRAY(String))
+    colour = Column(EnumType(Colour))
+    flag = Column(Boolean)
+    at = Column(DateTime)
+    amount = Column(Numeric)
+    ratio = Column(Float)
+    during = Column(TSRANGE)
+
+
+def test_copy_text():
+    compare(copy_text(None), expected='\\N')
+    compare(copy_text(1), expected='1')
+    compare(copy_text('a\\b\tc\nd\re'), expected='a\\\\b\\tc\\nd\\re')
+
+
+def test_copy_text_types():
+    compare(copy_text(b'\\\x00'), expected='\\\\x5c00')
+    compare(copy_text(True), expected='true')
+    compare(copy_text(Colour.red), expected='red')
+    compare(copy_text([1, None, 'a"b\\c']), expected='{"1",NULL,"a\\\\"b\\\\\\\\c"}')
+    compare(copy_text([[1, 2], [3, 4]]), expected='{{"1","2"},{"3","4"}}')
+    compare(copy_text(DateTimeRange(dt(2000, 1, 1), None)),
+            expected='["2000-01-01 00:00:00",)')
+
+
+def test_copy_buffer():
+    buffer = CopyBuffer([(1, 'a'), (2, None)])
+    compare(buffer.read(3), expected='1\ta')
+    compare(buffer.read(), expected='\n2\t\\N\n')
+    compare(buffer.read(10), expected='')
+
+
+class TestPostgres:
+
+    @pytest.fixture(autouse=True)
+    def session(self, db):
+        with create_tables_and_session(db, Base) as session:
+            self.session = session
+            yield session
+
+    def test_abstract(self):
+        with ShouldRaise(TypeError):
+            PostgresDiff([], [])
+
+    def test_simple(self):
+        self.session.add(Simple(key='a', value=2))
+        self.session.add(Simple(key='b', value=1))
+        self.session.add(Simple(key='c', value=3))
+        self.session.add(Simple(key='e', value=6))
+
+        imported = [
+            dict(key='b', value=2),
+            dict(key='c', value=3),
+            dict(key='d', value=1),
+            dict(key='e', value=None),
+        ]
+
+        class TestDiff(PostgresDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+
+        diff = TestDiff(self.session, imported)
+
+        compare(diff.apply(), expected=Counts(add=1, update=2, delete=1))
+
+        actual = [
+            dict(key=o.key, value=o.value)
+            for o in self.session.query(Simple).order_by('key')
+        ]
+
+        compare(imported, actual)
+
+    def test_multi_column_primary_key(self):
+        self.session.add(MultiPK(name='a', index=0, value=1))
+        self.session.add(MultiPK(name='b', index=0, value=2))
+        self.session.add(MultiPK(name='b', index=1, value=-2))
+        self.session.add(MultiPK(name='c', index=0, value=3))
+
+        imported = [
+            dict(name='b', index=0, value=2),
+            dict(name='b', index=2, value=-1),
+            dict(name='c', index=0, value=4),
+            dict(name='d', index=0, value=5),
+        ]
+
+        class TestDiff(PostgresDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+
+        diff = TestDiff(self.session, imported)
+
+        compare(diff.apply(), expected=Counts(add=2, update=1, delete=2))
+
+        actual = [
+            dict(name=o.name, index=o.index, value=o.value)
+            for o in self.session.query(MultiPK).order_by('name', 'index')
+        ]
+
+        compare(imported, actual)
+
+    def test_key_fields_and_ignore_fields(self):
+        self.session.add(AutoPK(name='a', value=1))
+        self.session.add(AutoPK(name='b', value=2))
+        self.session.add(AutoPK(name='c\t\\\n', value=3))
+
+        imported = [
+            dict(name='b', value=2),
+            dict(name='c\t\\\n', value=4),
+            dict(name='d', value=5),
+        ]
+
+        class TestDiff(PostgresDiff):
+            model = AutoPK
+            extract_imported = MultiKeyDictExtractor('name')
+            ignore_fields = {'id'}
+            key_fields = ['name']
+
+        diff = TestDiff(self.session, imported)
+
+        compare(diff.apply(), expected=Counts(add=1, update=1, delete=1))
+
+        actual = [
+            dict(name=o.name, value=o.value)
+            for o in self.session.query(AutoPK).order_by('name')
+        ]
+
+        compare(imported, actual)
+
+    def test_partial_table_contents(self):
+        self.session.add(MultiPK(name='a', index=0, value=1))
+        self.session.add(MultiPK(name='b', index=0, value=2))
+        self.session.add(MultiPK(name='c', index=0, value=3))
+        self.session.add(MultiPK(name='a', index=1, value=4))
+        self.session.add(MultiPK(name='b', index=1, value=5))
+        self.session.add(MultiPK(name='c', index=1, value=6))
+
+        imported = [
+            dict(name='b', index=0, value=2),
+            dict(name='c', index=0, value=7),
+            dict(name='d', index=0, value=8),
+        ]
+
+        class TestDiff(PostgresDiff):
+
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+
+            def existing(self):
+                return self.session.query(MultiPK).filter_by(index=0)
+
+        diff = TestDiff(self.session, imported)
+
+        compare(diff.apply(), expected=Counts(add=1, update=1, delete=1))
+
+        expected = [
+            dict(name='b', index=0, value=2),
+            dict(name='c', index=0, value=7),
+            dict(name='d', index=0, value=8),
+            dict(name='a', index=1, value=4),
+            dict(name='b', index=1, value=5),
+            dict(name='c', index=1, value=6),
+        ]
+
+        actual = [
+            dict(name=o.name, index=o.index, value=o.value)
+            for o in self.session.query(MultiPK).order_by('index', 'name')
+        ]
+
+        compare(expected, actual)
+
+    def test_duplicate_existing_key(self):
+        self.session.add(AutoPK(name='a', value=1))
+        self.session.add(AutoPK(name='a', value=2))
+
+        class TestDiff(PostgresDiff):
+            model = AutoPK
+            extract_imported = MultiKeyDictExtractor('name')
+            ignore_fields = {'id'}
+            key_fields = ['name']
+
+        diff = TestDiff(self.session, [])
+
+        with ShouldRaise(AssertionError("('a',) occurs 2 times in existing")):
+            diff.apply()
+
+    def test_duplicate_imported_key(self):
+
+        class TestDiff(PostgresDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+
+        diff = TestDiff(self.session, [dict(key='a', value=1), dict(key='a', value=2)])
+
+        with ShouldRaise(AssertionError(
+            "('a',) occurs 2 times in imported: "
+            "{'key': 'a', 'value': 1} from {'key': 'a', 'value': 1}, "
+            "{'key': 'a', 'value': 2} from {'key': 'a', 'value': 2}"
+        )):
+            diff.apply()
+
+    def test_loaded_instances_refreshed(self):
+        existing = Simple(key='a', value=1)
+        self.session.add(existing)
+
+        class TestDiff(PostgresDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+
+        diff = TestDiff(self.session, [dict(key='a', value=2)])
+        diff.apply()
+
+        compare(existing.value, expected=2)
+
+    def test_upsert(self):
+        self.session.add(Simple(key='a', value=2))
+        self.session.add(Simple(key='b', value=1))
+        self.session.add(Simple(key='c', value=3))
+        self.session.add(Simple(key='e', value=6))
+
+        imported = [
+            dict(key='b', value=2),
+            dict(key='c', value=3),
+            dict(key='d', value=1),
+            dict(key='e', value=None),
+            dict(key='f', value=7),
+        ]
+
+        class TestDiff(PostgresDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+            strategy = 'upsert'
+            batch_size = 2
+
+        diff = TestDiff(self.session, imported)
+
+        compare(diff.apply(), expected=Counts(add=2, update=2, delete=1))
+
+        actual = [
+            dict(key=o.key, value=o.value)
+            for o in self.session.query(Simple).order_by('key')
+        ]
+
+        compare(imported, actual)
+
+    def test_upsert_partial_table_contents(self):
+        self.session.add(MultiPK(name='a', index=0, value=1))
+        self.session.add(MultiPK(name='b', index=0, value=2))
+        self.session.add(MultiPK(name='c', index=0, value=3))
+        self.session.add(MultiPK(name='a', index=1, value=4))
+        self.session.add(MultiPK(name='b', index=1, value=5))
+        self.session.add(MultiPK(name='c', index=1, value=6))
+
+        imported = [
+            dict(name='b', index=0, value=2),
+            dict(name='c', index=0, value=7),
+            dict(name='d', index=0, value=8),
+        ]
+
+        class TestDiff(PostgresDiff):
+
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            strategy = 'upsert'
+
+            def existing(self):
+                return self.session.query(MultiPK).filter_by(index=0)
+
+        diff = TestDiff(self.session, imported)
+
+        compare(diff.apply(), expected=Counts(add=1, update=1, delete=1))
+
+        expected = [
+            dict(name='b', index=0, value=2),
+            dict(name='c', index=0, value=7),
+            dict(name='d', index=0, value=8),
+            dict(name='a', index=1, value=4),
+            dict(name='b', index=1, value=5),
+            dict(name='c', index=1, value=6),
+        ]
+
+        actual = [
+            dict(name=o.name, index=o.index, value=o.value)
+            for o in self.session.query(MultiPK).order_by('index', 'name')
+        ]
+
+        compare(expected, actual)
+
+    def test_upsert_key_only(self):
+        self.session.add(SingleColumn(value='a'))
+        self.session.add(SingleColumn(value='b'))
+
+        imported = [dict(value='b'), dict(value='c')]
+
+        class TestDiff(PostgresDiff):
+            model = SingleColumn
+            extract_imported = MultiKeyDictExtractor('value')
+            strategy = 'upsert'
+
+        diff = TestDiff(self.session, imported)
+
+        compare(diff.apply(), expected=Counts(add=1, update=0, delete=1))
+
+        compare(
+            [dict(value=o.value)
+             for o in self.session.query(SingleColumn).order_by('value')],
+            expected=imported
+        )
+
+    def test_compute(self):
+
+        class TestDiff(PostgresDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+
+        diff = TestDiff(self.session, [])
+        with ShouldRaise(TypeError(
+            'PostgresDiff applies changes in the database, use apply() instead'
+        )):
+            diff.compute()
+        with ShouldRaise(TypeError(
+            'PostgresDiff applies changes in the database, use apply() instead'
+        )):
+            list(diff.iter_changes())
+
+    def test_restrict_existing(self):
+
+        class TestDiff(PostgresDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+            restrict_existing = True
+
+        with ShouldRaise(TypeError(
+            'restrict_existing cannot be used with PostgresDiff'
+        )):
+            TestDiff(self.session, [])
+
+    @pytest.mark.parametrize('strategy', ['staging', 'upsert'])
+    def test_missing_field(self, strategy):
+        self.session.add(Simple(key='a', value=1))
+
+        class TestDiff(PostgresDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+
+        TestDiff.strategy = strategy
+        diff = TestDiff(self.session, [dict(key='a', value=1), dict(key='b')])
+
+        with ShouldRaise(ValueError("('b',) is missing 'value'")):
+            diff.apply()
+
+    def test_failure_not_hidden(self):
+        # Simple.value is unique:
+        imported = [dict(key='a', value=1), dict(key='b', value=1)]
+
+        class TestDiff(PostgresDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+
+        with ShouldRaise(IntegrityError):
+            TestDiff(self.session, imported).apply()
+
+    def test_unknown_strategy(self):
+
+        class TestDiff(PostgresDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+            strategy = 'foo'
+
+        diff = TestDiff(self.session, [])
+
+        with ShouldRaise(ValueError("Unknown strategy: 'foo'")):
+            diff.apply()
+
+
+class TestPostgresTypes:
+
+    @pytest.fixture(autouse=True)
+    def session(self, db):
+        with create_tables_and_session(db, TypesBase) as session:
+            self.session = session
+            yield session
+
+    def row(self, key, **overrides):
+        row = dict(
+            key=key,
+            data=b'\x00\\\t"x',
+            doc={'a': [1, 'b\t"'], 'c': None},
+            items=[1, 'two'],
+            numbers=[0.30000000000000004, None, 1e100],
+            texts=['a,b', 'c"d', 'e\\f', None, '', 'NULL', '{g}'],
+            colour=Colour.green,
+            flag=False,
+            at=dt(2001, 2, 3, 4, 5, 6, 7),
+            amount=Decimal('1.10'),
+            ratio=0.30000000000000004,
+            during=DateTimeRange(dt(2000, 1, 1), None),
+        )
+        row.update(overrides)
+        return row
+
+    def check(self, strategy):
+        self.session.add(Types(**self.row('same')))
+        self.session.add(Types(**self.row('changed', ratio=0.3, flag=True)))
+        self.session.flush()
+
+        imported = [self.row('same'), self.row('changed'), self.row('new')]
+
+        class TestDiff(PostgresDiff):
+            model = Types
+            extract_imported = MultiKeyDictExtractor('key')
+
+        TestDiff.strategy = strategy
+        compare(TestDiff(self.session, imported).apply(),
+                expected=Counts(add=1, update=1, delete=0))
+
+        actual = {}
+        for obj in self.session.query(Types).order_by('key'):
+            row = {name: getattr(obj, name) for name in imported[0]}
+            row['data'] = bytes(row['data'])
+            actual[obj.key] = row
+        compare(actual, expected={row['key']: row for row in imported})
+
+    def test_staging(self):
+        self.check('staging')
+
+    def test_upsert(self):
+        self.check('upsert')
@@ -0,0 +1,163 @@
+from testfixtures import compare, ShouldRaise
+
+from mortar_import.diff import Diff, Counts
+from mortar_import.snapshot import Snapshot, digest
+
+
+class TestSnapshot:
+
+    def test_empty(self, tmp_path):
+        snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+        compare(snapshot.fingerprint(), expected=None)
+        assert not snapshot.valid(0)
+        compare(snapshot.changed({'a': digest(1)}), expected={'a'})
+
+    def test_save_and_reopen(self, tmp_path):
+        path = str(tmp_path / 'snapshot.db')
+        Snapshot(path).save({('a', 1): digest(1), ('b', 2): digest(2)}, 2)
+
+        snapshot = Snapshot(path)
+        assert snapshot.valid(2)
+        assert not snapshot.valid(3)
+        assert not snapshot.valid(None)
+        compare(
+            snapshot.changed({('b', 2): digest(3), ('c', 3): digest(3)}),
+            expected={('a', 1), ('b', 2), ('c', 3)}
+        )
+        compare(
+            snapshot.changed({('a', 1): digest(1), ('b', 2): digest(2)}),
+            expected=set()
+        )
+
+    def test_invalidate(self, tmp_path):
+        snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+        snapshot.save({'a': digest(1)}, 1)
+        snapshot.invalidate()
+        assert not snapshot.valid(1)
+        compare(snapshot.changed({}), expected=set())
+
+
+class DictDiff(Diff):
+    """
+    Keeps a dict of key to value in step with the imported pairs.
+    """
+
+    def __init__(self, store, imported):
+        super(DictDiff, self).__init__(list(store.items()), imported)
+        self.store = store
+        self.compared = []
+
+    def extract_existing(self, obj):
+        return obj
+
+    extract_imported = extract_existing
+
+    def differs(self, existing_extracted, imported_extracted):
+        self.compared.append(imported_extracted)
+        return existing_extracted != imported_extracted
+
+    def existing_fingerprint(self):
+        return len(self.store)
+
+    def add(self, key, imported, imported_extracted):
+        self.store[key] = imported_extracted
+
+    def update(self, key, existing, existing_extracted, imported, imported_extracted):
+        self.store[key] = imported_extracted
+
+    def delete(self, key, existing, existing_extracted):
+        del self.store[key]
+
+
+class TestDiffWithSnapshot:
+
+    def test_unchanged_skipped(self, tmp_path):
+        store = {}
+
+        class TestDiff(DictDiff):
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+
+        first = TestDiff(store, [('a', 1), ('b', 2), ('c', 3), ('d', 4)])
+        compare(first.apply(), expected=Counts(add=4, update=0, delete=0))
+        first.save_snapshot()
+
+        second = TestDiff(store, [('a', 1), ('b', 5), ('d', 4), ('e', 6)])
+        compare(second.apply(), expected=Counts(add=1, update=1, delete=1))
+        compare(second.compared, expected=[5])
+        compare(store, expected={'a': 1, 'b': 5, 'd': 4, 'e': 6})
+
+    def test_drift_detected(self, tmp_path):
+        store = {}
+
+        class TestDiff(DictDiff):
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+
+        first = TestDiff(store, [('a', 1), ('b', 2)])
+        first.apply()
+        first.save_snapshot()
+        # changed behind the diff's back:
+        store['c'] = 3
+
+        diff = TestDiff(store, [('a', 1), ('b', 2)])
+        compare(diff.apply(), expected=Counts(add=0, update=0, delete=1))
+        compare(diff.compared, expected=[1, 2])
+        compare(store, expected={'a': 1, 'b': 2})
+
+    def test_compute_does_not_save(self, tmp_path):
+        store = {}
+
+        class TestDiff(DictDiff):
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+
+        TestDiff(store, [('a', 1)]).compute()
+        assert not TestDiff.snapshot.valid(0)
+
+    def test_apply_does_not_save(self, tmp_path):
+        store = {}
+
+        class TestDiff(DictDiff):
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+
+        # as if the changes applied were then rolled back:
+        TestDiff(store, [('a', 1), ('b', 2)]).apply()
+        store.clear()
+        assert not TestDiff.snapshot.valid(0)
+
+        diff = TestDiff(store, [('a', 1), ('b', 2)])
+        compare(diff.apply(), expected=Counts(add=2, update=0, delete=0))
+        diff.save_snapshot()
+        assert TestDiff.snapshot.valid(2)
+
+    def test_save_before_apply(self, tmp_path):
+
+        class TestDiff(DictDiff):
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+
+        with ShouldRaise(TypeError('save_snapshot() can only be called after apply()')):
+            TestDiff({}, []).save_snapshot()
+
+    def test_save_after_compute(self, tmp_path):
+
+        class TestDiff(DictDiff):
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+
+        diff = TestDiff({}, [('a', 1)])
+        diff.compute()
+        with ShouldRaise(TypeError('save_snapshot() can only be called after apply()')):
+            diff.save_snapshot()
+        assert not TestDiff.snapshot.valid(0)
+
+    def test_save_twice(self, tmp_path):
+
+        class TestDiff(DictDiff):
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+
+        diff = TestDiff({}, [('a', 1)])
+        diff.apply()
+        diff.save_snapshot()
+        with ShouldRaise(TypeError('save_snapshot() can only be called after apply()')):
+            diff.save_snapshot()
+
+    def test_save_without_snapshot(self):
+        with ShouldRaise(TypeError('snapshot is not set')):
+            DictDiff({}, []).save_snapshot()
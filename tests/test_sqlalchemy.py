@@ -1,14 +1,22 @@
+from datetime import datetime as dt
+from decimal import Decimal
+
 import pytest
 from mortar_mixins.testing import create_tables_and_session
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import (
+    Column, DateTime, Float, Integer, Numeric, REAL, String, ForeignKey, event, select,
+    text
+)
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from testfixtures import ShouldRaise, compare
 
-from mortar_import.diff import Addition, Update, Deletion
+from mortar_import.diff import Addition, Update, Deletion, Counts
 from mortar_import.extractors import MultiKeyDictExtractor
-from mortar_import.sqlalchemy import SQLAlchemyDiff
+from mortar_import.snapshot import Snapshot
+from mortar_import.sqlalchemy import SQLAlchemyDiff, AsyncSQLAlchemyDiff
 
 Base = declarative_base()
 
@@ -33,6 +41,15 @@ class AutoPK(Base):
     value = Column(Integer)
 
 
+class Measurement(Base):
+    __tablename__ = 'measurement'
+    id = Column(Integer, primary_key=True)
+    ratio = Column(Float)
+    small = Column(REAL)
+    amount = Column(Numeric)
+    at = Column(DateTime)
+
+
 class FKToSimple(Base):
     __tablename__ = 'simple_referrer'
     name = Column(String, primary_key=True)
@@ -419,3 +436,978 @@ class TestSQLAlchemy:
         ]
 
         compare(expected, actual)
+
+    def test_update_only_changed_fields(self):
+        self.session.add(AutoPK(name='a', value=1))
+        self.session.flush()
+
+        imported = [dict(name='a', value=2)]
+
+        class TestDiff(SQLAlchemyDiff):
+
+            model = AutoPK
+            extract_imported = MultiKeyDictExtractor('name')
+            ignore_fields = {'id'}
+
+            def extract_existing(self, obj):
+                _, extracted = super(TestDiff, self).extract_existing(obj)
+                return (extracted['name'],), extracted
+
+        diff = TestDiff(self.session, imported)
+
+        diff.compute()
+        compare(diff.to_update[0].changed, expected={'value'})
+
+        sets = []
+
+        def record(target, value, oldvalue, initiator):
+            sets.append((initiator.key, value))
+
+        for attr in AutoPK.name, AutoPK.value:
+            event.listen(attr, 'set', record)
+        try:
+            diff.apply()
+        finally:
+            for attr in AutoPK.name, AutoPK.value:
+                event.remove(attr, 'set', record)
+
+        compare(sets, expected=[('value', 2)])
+        compare(
+            [dict(name=o.name, value=o.value) for o in self.session.query(AutoPK)],
+            expected=[dict(name='a', value=2)]
+        )
+
+    def test_bulk_add(self):
+        self.session.add(Simple(key='a', value=1))
+
+        imported = [
+            dict(key='a', value=1),
+            dict(key='b', value=2),
+            dict(key='c', value=3),
+            dict(key='d', value=4),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+            bulk_add = True
+            batch_size = 2
+
+        diff = TestDiff(self.session, imported)
+
+        diff.apply()
+
+        compare([o.key for o in self.session.identity_map.values() if o.key != 'a'],
+                expected=[])
+
+        expected = [
+            dict(key='a', value=1),
+            dict(key='b', value=2),
+            dict(key='c', value=3),
+            dict(key='d', value=4),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value)
+            for o in self.session.query(Simple).order_by('key')
+        ]
+
+        compare(expected, actual)
+
+    def test_bulk_add_no_type_flush(self):
+        self.session.add(Simple(key='a', value=1))
+
+        imported = [
+            dict(key='d', value=1),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+            flush_per_type = False
+            bulk_add = True
+
+        diff = TestDiff(self.session, imported)
+        diff.apply()
+
+        expected = [
+            dict(key='d', value=1),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value)
+            for o in self.session.query(Simple).order_by('key')
+        ]
+
+        compare(expected, actual)
+
+    def test_bulk_update(self):
+        self.session.add(AutoPK(id=1, name='a', value=1))
+        self.session.add(AutoPK(id=2, name='b', value=2))
+        self.session.add(AutoPK(id=3, name='c', value=3))
+        self.session.add(AutoPK(id=4, name='d', value=4))
+        self.session.add(AutoPK(id=5, name='e', value=5))
+        self.session.flush()
+
+        imported = [
+            dict(id=1, name='a', value=1),
+            dict(id=2, name='B', value=2),
+            dict(id=3, name='c', value=30),
+            dict(id=4, name='D', value=40),
+            dict(id=5, name='e', value=50),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = AutoPK
+            extract_imported = MultiKeyDictExtractor('id')
+            bulk_update = True
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, executemany))
+
+        diff = TestDiff(self.session, imported)
+        diff.compute()
+
+        event.listen(self.session.bind, 'before_cursor_execute', record)
+        try:
+            diff.apply()
+        finally:
+            event.remove(self.session.bind, 'before_cursor_execute', record)
+
+        compare(statements, expected=[
+            ('UPDATE auto_pk SET name=%(new_name)s WHERE auto_pk.id = %(pk_id)s',
+             False),
+            ('UPDATE auto_pk SET value=%(new_value)s WHERE auto_pk.id = %(pk_id)s',
+             True),
+            ('UPDATE auto_pk SET name=%(new_name)s, value=%(new_value)s '
+             'WHERE auto_pk.id = %(pk_id)s',
+             False),
+        ])
+
+        compare(self.session.dirty, expected=set())
+        compare(
+            [dict(id=o.id, name=o.name, value=o.value)
+             for o in self.session.query(AutoPK).order_by('id')],
+            expected=imported
+        )
+        self.session.expire_all()
+        compare(
+            [dict(id=o.id, name=o.name, value=o.value)
+             for o in self.session.query(AutoPK).order_by('id')],
+            expected=imported
+        )
+
+    def test_bulk_update_multi_column_primary_key(self):
+        self.session.add(MultiPK(name='a', index=0, value=1))
+        self.session.add(MultiPK(name='a', index=1, value=2))
+
+        imported = [
+            dict(name='a', index=0, value=1),
+            dict(name='a', index=1, value=3),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            bulk_update = True
+
+        diff = TestDiff(self.session, imported)
+        diff.apply()
+        self.session.expire_all()
+
+        compare(
+            [dict(name=o.name, index=o.index, value=o.value)
+             for o in self.session.query(MultiPK).order_by('index')],
+            expected=imported
+        )
+
+    def test_bulk_delete(self):
+        self.session.add(Simple(key='a', value=1))
+        self.session.add(Simple(key='b', value=2))
+        self.session.add(Simple(key='c', value=3))
+
+        imported = [
+            dict(key='b', value=2),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+            bulk_delete = True
+
+        diff = TestDiff(self.session, imported)
+        diff.apply()
+
+        compare([o.key for o in self.session.identity_map.values() if o.key != 'a'],
+                expected=[])
+        compare(
+            [dict(key=o.key, value=o.value)
+             for o in self.session.query(Simple).order_by('key')],
+            expected=imported
+        )
+
+    def test_bulk_delete_multi_column_primary_key(self):
+        self.session.add(MultiPK(name='a', index=0, value=1))
+        self.session.add(MultiPK(name='a', index=1, value=2))
+        self.session.add(MultiPK(name='b', index=0, value=3))
+        self.session.add(MultiPK(name='b', index=1, value=4))
+
+        imported = [
+            dict(name='a', index=1, value=2),
+            dict(name='b', index=0, value=3),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            bulk_delete = True
+            batch_size = 1
+
+        diff = TestDiff(self.session, imported)
+        diff.apply()
+
+        compare(
+            [dict(name=o.name, index=o.index, value=o.value)
+             for o in self.session.query(MultiPK).order_by('name', 'index')],
+            expected=imported
+        )
+
+
+    def test_load_columns(self):
+        self.session.add(AutoPK(id=1, name='a', value=1))
+        self.session.add(AutoPK(id=2, name='b', value=2))
+        self.session.add(AutoPK(id=3, name='c', value=3))
+        self.session.flush()
+        self.session.expunge_all()
+
+        imported = [
+            dict(name='b', value=2),
+            dict(name='c', value=4),
+            dict(name='d', value=5),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+
+            model = AutoPK
+            extract_imported = MultiKeyDictExtractor('name')
+            ignore_fields = {'id'}
+            load_columns = True
+
+            def extract_existing(self, obj):
+                _, extracted = super(TestDiff, self).extract_existing(obj)
+                return (extracted['name'],), extracted
+
+        diff = TestDiff(self.session, imported)
+
+        diff.compute()
+
+        compare(len(self.session.identity_map), expected=0)
+        compare(
+            diff.to_update,
+            expected=[
+                Update(
+                    key=('c',),
+                    existing=(3, 'c', 3),
+                    existing_extracted={'value': 3, 'name': 'c'},
+                    imported={'value': 4, 'name': 'c'},
+                    imported_extracted={'value': 4, 'name': 'c'},
+                )
+            ],
+        )
+        compare(
+            diff.to_delete,
+            expected=[
+                Deletion(
+                    key=('a',),
+                    existing=(1, 'a', 1),
+                    existing_extracted={'name': 'a', 'value': 1},
+                )
+            ],
+        )
+
+        diff.apply()
+
+        compare(
+            [dict(name=o.name, value=o.value)
+             for o in self.session.query(AutoPK).order_by('name')],
+            expected=imported
+        )
+
+    def test_load_columns_bulk(self):
+        self.session.add(MultiPK(name='a', index=0, value=1))
+        self.session.add(MultiPK(name='b', index=0, value=2))
+        self.session.add(MultiPK(name='c', index=0, value=3))
+        self.session.flush()
+        self.session.expunge_all()
+
+        imported = [
+            dict(name='b', index=0, value=2),
+            dict(name='c', index=0, value=4),
+            dict(name='d', index=0, value=5),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            load_columns = bulk_add = bulk_update = bulk_delete = True
+
+        diff = TestDiff(self.session, imported)
+        diff.apply()
+
+        compare(len(self.session.identity_map), expected=0)
+        compare(
+            [dict(name=o.name, index=o.index, value=o.value)
+             for o in self.session.query(MultiPK).order_by('name')],
+            expected=imported
+        )
+
+    def test_yield_per(self):
+        for i in range(5):
+            self.session.add(MultiPK(name='a', index=i, value=i))
+        self.session.flush()
+
+        imported = [dict(name='a', index=i, value=i*2) for i in range(5)]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            yield_per = 2
+
+        cursors = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT'):
+                cursors.append(cursor.name)
+
+        diff = TestDiff(self.session, imported)
+        event.listen(self.session.bind, 'before_cursor_execute', record)
+        try:
+            diff.compute()
+        finally:
+            event.remove(self.session.bind, 'before_cursor_execute', record)
+
+        compare(len(cursors), expected=1)
+        assert cursors[0] is not None, 'not a server-side cursor'
+
+        diff.apply()
+        self.session.expire_all()
+
+        compare(
+            [dict(name=o.name, index=o.index, value=o.value)
+             for o in self.session.query(MultiPK).order_by('index')],
+            expected=imported
+        )
+
+    def test_restrict_existing(self):
+        for name in 'abc':
+            for index in range(3):
+                self.session.add(MultiPK(name=name, index=index, value=0))
+        self.session.flush()
+
+        imported = [
+            dict(name='a', index=0, value=0),
+            dict(name='a', index=1, value=1),
+            dict(name='b', index=0, value=2),
+            dict(name='d', index=0, value=3),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            restrict_existing = True
+            batch_size = 2
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+
+        diff = TestDiff(self.session, imported)
+        event.listen(self.session.bind, 'before_cursor_execute', record)
+        try:
+            diff.compute()
+        finally:
+            event.remove(self.session.bind, 'before_cursor_execute', record)
+
+        compare(len(statements), expected=2)
+        compare(diff.to_delete, expected=[])
+        compare([a.key for a in diff.to_add], expected=[('d', 0)])
+        compare([u.key for u in diff.to_update], expected=[('a', 1), ('b', 0)])
+
+        diff.apply()
+        self.session.expire_all()
+
+        compare(
+            [(o.name, o.index, o.value)
+             for o in self.session.query(MultiPK).order_by('name', 'index')],
+            expected=[
+                ('a', 0, 0), ('a', 1, 1), ('a', 2, 0),
+                ('b', 0, 2), ('b', 1, 0), ('b', 2, 0),
+                ('c', 0, 0), ('c', 1, 0), ('c', 2, 0),
+                ('d', 0, 3),
+            ]
+        )
+
+    def test_restrict_existing_deletion_scope(self):
+        for name in 'abc':
+            for index in range(2):
+                self.session.add(MultiPK(name=name, index=index, value=0))
+        self.session.flush()
+
+        imported = [
+            dict(name='a', index=0, value=1),
+            dict(name='b', index=0, value=0),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            restrict_existing = True
+
+            def deletion_scope(self):
+                return MultiPK.name == 'a'
+
+        diff = TestDiff(self.session, imported)
+        diff.apply()
+        self.session.expire_all()
+
+        compare(
+            [(o.name, o.index, o.value)
+             for o in self.session.query(MultiPK).order_by('name', 'index')],
+            expected=[
+                ('a', 0, 1),
+                ('b', 0, 0), ('b', 1, 0),
+                ('c', 0, 0), ('c', 1, 0),
+            ]
+        )
+
+    def test_restrict_existing_sorted_inputs(self):
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            restrict_existing = True
+            sorted_inputs = True
+
+        with ShouldRaise(TypeError('restrict_existing cannot be used with sorted_inputs')):
+            TestDiff(self.session, [])
+
+    def test_restrict_existing_spill_after(self):
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            restrict_existing = True
+            spill_after = 10
+
+        with ShouldRaise(TypeError('restrict_existing cannot be used with spill_after')):
+            TestDiff(self.session, [])
+
+    def test_digest(self):
+        for index in range(4):
+            self.session.add(MultiPK(name='a', index=index, value=index))
+        self.session.add(MultiPK(name='a', index=4, value=None))
+        self.session.flush()
+        self.session.expunge_all()
+
+        imported = [
+            dict(name='a', index=0, value=0),
+            dict(name='a', index=1, value=10),
+            # different text but equal, so loaded but not updated:
+            dict(name='a', index=2, value=2.0),
+            dict(name='a', index=4, value=None),
+            dict(name='a', index=5, value=5),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            digest = True
+
+        loaded = []
+
+        def record(target, context):
+            loaded.append(target.index)
+
+        diff = TestDiff(self.session, imported)
+        event.listen(MultiPK, 'load', record)
+        try:
+            diff.compute()
+        finally:
+            event.remove(MultiPK, 'load', record)
+
+        # only rows whose digests differ, or that are to be deleted, are loaded:
+        compare(sorted(loaded), expected=[1, 2, 3])
+        compare([a.key for a in diff.to_add], expected=[('a', 5)])
+        compare(
+            [(u.key, u.existing.value, u.existing_extracted) for u in diff.to_update],
+            expected=[(('a', 1), 1, dict(name='a', index=1, value=1))]
+        )
+        compare(
+            [(d.key, d.existing.value, d.existing_extracted) for d in diff.to_delete],
+            expected=[(('a', 3), 3, dict(name='a', index=3, value=3))]
+        )
+
+        diff.apply()
+        self.session.expire_all()
+
+        compare(
+            [(o.index, o.value)
+             for o in self.session.query(MultiPK).order_by('index')],
+            expected=[(0, 0), (1, 10), (2, 2), (4, None), (5, 5)]
+        )
+
+    def test_digest_matches_database(self):
+        values = ['', 'a,b', '1:2', None]
+        for value in values:
+            self.session.add(AutoPK(name=value, value=len(value or '')))
+        self.session.flush()
+
+        class TestDiff(SQLAlchemyDiff):
+            model = AutoPK
+            extract_imported = MultiKeyDictExtractor('id')
+            digest = True
+
+        diff = TestDiff(self.session, [])
+        expected = {
+            (o.id,): diff.row_digest(dict(id=o.id, name=o.name, value=o.value))
+            for o in self.session.query(AutoPK)
+        }
+        actual = {}
+        for row in diff.existing:
+            key, digest = diff.extract_existing(row)
+            actual[key] = digest
+        compare(expected, actual=actual)
+
+    def test_digest_matches_database_types(self):
+        # the default before Postgres 12, which rounds the text of floats:
+        self.session.execute(text('SET LOCAL extra_float_digits = 0'))
+        values = [
+            dict(id=1, ratio=0.30000000000000004, small=0.5, amount=Decimal('1.10'),
+                 at=dt(2001, 2, 3, 4, 5, 6, 7)),
+            dict(id=2, ratio=1e100, small=-2.0, amount=Decimal('-3'), at=dt(2001, 2, 3)),
+            dict(id=3, ratio=0, small=None, amount=None, at=None),
+        ]
+        for value in values:
+            self.session.add(Measurement(**value))
+        self.session.flush()
+
+        class TestDiff(SQLAlchemyDiff):
+            model = Measurement
+            extract_imported = MultiKeyDictExtractor('id')
+            digest = True
+
+        diff = TestDiff(self.session, [])
+        expected = {(value['id'],): diff.row_digest(value) for value in values}
+        actual = {}
+        for row in diff.existing:
+            key, digest = diff.extract_existing(row)
+            actual[key] = digest
+        compare(expected, actual=actual)
+
+    def test_digest_float_rounding(self):
+        self.session.add(Measurement(id=1, ratio=0.30000000000000004))
+        self.session.flush()
+
+        class TestDiff(SQLAlchemyDiff):
+            model = Measurement
+            extract_imported = MultiKeyDictExtractor('id')
+            digest = True
+
+        imported = [dict(id=1, ratio=0.3, small=None, amount=None, at=None)]
+
+        # rounded to 15 digits, both values would have the same text:
+        self.session.execute(text('SET LOCAL extra_float_digits = 0'))
+        diff = TestDiff(self.session, imported)
+        (row,) = diff.existing
+        assert diff.differs(diff.extract_existing(row)[1], imported[0])
+
+        self.session.execute(text('SET LOCAL extra_float_digits = 1'))
+        compare(TestDiff(self.session, imported).apply(),
+                expected=Counts(add=0, update=1, delete=0))
+        self.session.expire_all()
+        compare(self.session.query(Measurement.ratio).scalar(), expected=0.3)
+
+    def test_digest_load_columns_bulk(self):
+        self.session.add(MultiPK(name='a', index=0, value=0))
+        self.session.add(MultiPK(name='a', index=1, value=1))
+        self.session.add(MultiPK(name='a', index=2, value=2))
+        self.session.flush()
+
+        imported = [
+            dict(name='a', index=0, value=0),
+            dict(name='a', index=1, value=3),
+        ]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            digest = True
+            load_columns = True
+            bulk_update = bulk_delete = True
+
+        diff = TestDiff(self.session, imported)
+        compare(diff.apply(), expected=Counts(add=0, update=1, delete=1))
+        self.session.expire_all()
+
+        compare(
+            [(o.index, o.value)
+             for o in self.session.query(MultiPK).order_by('index')],
+            expected=[(0, 0), (1, 3)]
+        )
+
+    def test_digest_sorted_inputs(self):
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            digest = True
+            sorted_inputs = True
+
+        with ShouldRaise(TypeError('digest cannot be used with sorted_inputs')):
+            TestDiff(self.session, [])
+
+    def test_flush_every(self):
+        for index in range(6):
+            self.session.add(MultiPK(name='a', index=index, value=index))
+        self.session.flush()
+        self.session.expunge_all()
+
+        imported = [dict(name='a', index=i, value=i*10) for i in range(3, 9)]
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            flush_every = 2
+            flush_per_type = False
+
+        flushes = []
+
+        def record(session, context, instances):
+            flushes.append((len(session.deleted), len(session.dirty), len(session.new)))
+
+        diff = TestDiff(self.session, imported)
+        event.listen(self.session, 'before_flush', record)
+        try:
+            compare(diff.apply(), expected=Counts(add=3, update=3, delete=3))
+        finally:
+            event.remove(self.session, 'before_flush', record)
+
+        compare(flushes, expected=[
+            (2, 0, 0), (1, 0, 0),
+            (0, 2, 0), (0, 1, 0),
+            (0, 0, 2), (0, 0, 1),
+        ])
+        compare(list(self.session), expected=[])
+
+        compare(
+            [(o.index, o.value)
+             for o in self.session.query(MultiPK).order_by('index')],
+            expected=[(3, 30), (4, 40), (5, 50), (6, 60), (7, 70), (8, 80)]
+        )
+
+    def test_handled_only_recorded_for_flush_every(self):
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            streaming = True
+
+        imported = [dict(name='a', index=i, value=i) for i in range(10)]
+        diff = TestDiff(self.session, imported)
+        compare(diff.apply(), expected=Counts(add=10, update=0, delete=0))
+        compare(diff.handled, expected=[])
+
+    def test_flush_every_leaves_other_objects(self):
+        self.session.add(MultiPK(name='a', index=0, value=0))
+        self.session.add(Simple(key='x', value=1))
+        self.session.flush()
+        mine = self.session.query(Simple).one()
+        mine.value = 2
+        pending = Simple(key='y', value=3)
+        self.session.add(pending)
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            flush_every = 1
+
+        imported = [dict(name='a', index=0, value=10), dict(name='a', index=1, value=1)]
+        # so that the caller's changes are still pending when the diff flushes:
+        with self.session.no_autoflush:
+            compare(TestDiff(self.session, imported).apply(),
+                    expected=Counts(add=1, update=1, delete=0))
+
+        assert mine in self.session
+        assert pending in self.session
+        compare([o for o in self.session if isinstance(o, MultiPK)], expected=[])
+        compare([(o.key, o.value) for o in self.session.query(Simple).order_by('key')],
+                expected=[('x', 2), ('y', 3)])
+
+    def test_snapshot(self, tmp_path):
+        for index in range(4):
+            self.session.add(MultiPK(name='a', index=index, value=index))
+        self.session.flush()
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+            batch_size = 2
+
+        imported = [dict(name='a', index=i, value=i) for i in range(4)]
+        diff = TestDiff(self.session, imported)
+        compare(diff.apply(), expected=Counts(add=0, update=0, delete=0))
+        diff.save_snapshot()
+        self.session.expunge_all()
+
+        imported = [
+            dict(name='a', index=0, value=0),
+            dict(name='a', index=1, value=10),
+            dict(name='a', index=2, value=2),
+            dict(name='a', index=4, value=4),
+        ]
+
+        loaded = []
+
+        def record(target, context):
+            loaded.append(target.index)
+
+        diff = TestDiff(self.session, imported)
+        event.listen(MultiPK, 'load', record)
+        try:
+            compare(diff.apply(), expected=Counts(add=1, update=1, delete=1))
+        finally:
+            event.remove(MultiPK, 'load', record)
+
+        compare(sorted(loaded), expected=[1, 3])
+        self.session.expire_all()
+        compare(
+            [(o.index, o.value)
+             for o in self.session.query(MultiPK).order_by('index')],
+            expected=[(0, 0), (1, 10), (2, 2), (4, 4)]
+        )
+        assert not TestDiff.snapshot.valid(diff.existing_fingerprint())
+        diff.save_snapshot()
+        assert TestDiff.snapshot.valid(diff.existing_fingerprint())
+
+    def test_snapshot_updated_in_place(self, tmp_path):
+        for index in range(3):
+            self.session.add(MultiPK(name='a', index=index, value=index))
+        self.session.flush()
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+
+        imported = [dict(name='a', index=i, value=i) for i in range(3)]
+        diff = TestDiff(self.session, imported)
+        diff.apply()
+        diff.save_snapshot()
+
+        # changed behind the diff's back, without changing the number of rows:
+        self.session.query(MultiPK).filter_by(index=1).update({'value': 100})
+        self.session.expire_all()
+
+        diff = TestDiff(self.session, imported)
+        compare(diff.apply(), expected=Counts(add=0, update=1, delete=0))
+        self.session.expire_all()
+        compare(
+            [(o.index, o.value) for o in self.session.query(MultiPK).order_by('index')],
+            expected=[(0, 0), (1, 1), (2, 2)]
+        )
+
+    def test_snapshot_restrict_existing(self, tmp_path):
+        for name in 'ab':
+            for index in range(2):
+                self.session.add(MultiPK(name=name, index=index, value=0))
+        self.session.flush()
+
+        class TestDiff(SQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            snapshot = Snapshot(str(tmp_path / 'snapshot.db'))
+            restrict_existing = True
+
+            def deletion_scope(self):
+                return MultiPK.name == 'a'
+
+        imported = [
+            dict(name=name, index=index, value=0) for name in 'ab' for index in range(2)
+        ]
+        diff = TestDiff(self.session, imported)
+        compare(diff.apply(), expected=Counts(add=0, update=0, delete=0))
+        diff.save_snapshot()
+
+        # keys that have left the import are only deleted within the scope:
+        imported = [dict(name='a', index=0, value=1)]
+        diff = TestDiff(self.session, imported)
+        compare(diff.apply(), expected=Counts(add=0, update=1, delete=1))
+        self.session.expire_all()
+        compare(
+            [(o.name, o.index, o.value)
+             for o in self.session.query(MultiPK).order_by('name', 'index')],
+            expected=[('a', 0, 1), ('b', 0, 0), ('b', 1, 0)]
+        )
+
+
+class TestAsyncSQLAlchemy:
+
+    def test_simple(self, run_async):
+
+        class TestDiff(AsyncSQLAlchemyDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+            yield_per = 2
+
+        async def imported():
+            for key, value in ('b', 2), ('c', 4), ('d', 5):
+                yield dict(key=key, value=value)
+
+        async def test(session):
+            session.add_all([Simple(key='a', value=1),
+                             Simple(key='b', value=2),
+                             Simple(key='c', value=3)])
+            await session.flush()
+            counts = await TestDiff(session, imported()).apply()
+            result = await session.execute(
+                select(Simple.key, Simple.value).order_by(Simple.key)
+            )
+            return counts, result.all()
+
+        counts, rows = run_async(Base, test)
+        compare(counts, expected=Counts(add=1, update=1, delete=1))
+        compare(rows, expected=[('b', 2), ('c', 4), ('d', 5)])
+
+    def test_load_columns_bulk(self, run_async):
+
+        class TestDiff(AsyncSQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            load_columns = True
+            bulk_add = bulk_update = bulk_delete = True
+            batch_size = 2
+
+        imported = [dict(name='a', index=i, value=i*10) for i in range(2, 6)]
+
+        async def test(session):
+            session.add_all([MultiPK(name='a', index=i, value=i) for i in range(4)])
+            await session.flush()
+            counts = await TestDiff(session, imported).apply()
+            result = await session.execute(
+                select(MultiPK.index, MultiPK.value).order_by(MultiPK.index)
+            )
+            return counts, result.all()
+
+        counts, rows = run_async(Base, test)
+        compare(counts, expected=Counts(add=2, update=2, delete=2))
+        compare(rows, expected=[(2, 20), (3, 30), (4, 40), (5, 50)])
+
+    def test_restrict_existing(self, run_async):
+
+        class TestDiff(AsyncSQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            restrict_existing = True
+            batch_size = 2
+
+            def deletion_scope(self):
+                return MultiPK.name == 'a'
+
+        imported = [
+            dict(name='a', index=0, value=1),
+            dict(name='b', index=0, value=0),
+            dict(name='b', index=1, value=2),
+        ]
+        loaded = []
+
+        def record(target, context):
+            loaded.append((target.name, target.index))
+
+        async def test(session):
+            for name in 'abc':
+                session.add_all(
+                    [MultiPK(name=name, index=i, value=0) for i in range(2)]
+                )
+            await session.flush()
+            session.expunge_all()
+            event.listen(MultiPK, 'load', record)
+            try:
+                counts = await TestDiff(session, imported).apply()
+            finally:
+                event.remove(MultiPK, 'load', record)
+            result = await session.execute(
+                select(MultiPK.name, MultiPK.index, MultiPK.value)
+                .order_by(MultiPK.name, MultiPK.index)
+            )
+            return counts, result.all()
+
+        counts, rows = run_async(Base, test)
+        compare(counts, expected=Counts(add=0, update=2, delete=1))
+        compare(sorted(loaded), expected=[('a', 0), ('a', 1), ('b', 0), ('b', 1)])
+        compare(rows, expected=[
+            ('a', 0, 1),
+            ('b', 0, 0), ('b', 1, 2),
+            ('c', 0, 0), ('c', 1, 0),
+        ])
+
+    def test_restrict_existing_imported_problem(self, run_async):
+
+        class TestDiff(AsyncSQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            restrict_existing = True
+
+            def handle_imported_problem(self, key, dups):
+                # the second of the duplicates is really for the next index:
+                (first, first_extracted), (second, second_extracted) = dups
+                yield key, first, first_extracted
+                name, index = key
+                yield (name, index + 1), second, dict(second_extracted, index=index + 1)
+
+        imported = [
+            dict(name='a', index=0, value=1),
+            dict(name='a', index=0, value=2),
+        ]
+
+        async def test(session):
+            session.add_all([MultiPK(name='a', index=i, value=0) for i in range(2)])
+            await session.flush()
+            session.expunge_all()
+            counts = await TestDiff(session, imported).apply()
+            result = await session.execute(
+                select(MultiPK.name, MultiPK.index, MultiPK.value)
+                .order_by(MultiPK.name, MultiPK.index)
+            )
+            return counts, result.all()
+
+        counts, rows = run_async(Base, test)
+        compare(counts, expected=Counts(add=0, update=2, delete=0))
+        compare(rows, expected=[('a', 0, 1), ('a', 1, 2)])
+
+    def test_streaming(self, run_async):
+
+        class TestDiff(AsyncSQLAlchemyDiff):
+            model = MultiPK
+            extract_imported = MultiKeyDictExtractor('name', 'index')
+            streaming = True
+
+        async def test(session):
+            with ShouldRaise(TypeError('streaming cannot be used with AsyncDiff')):
+                TestDiff(session, [])
+
+        run_async(Base, test)
+
+    def test_digest(self):
+
+        class TestDiff(AsyncSQLAlchemyDiff):
+            model = Simple
+            extract_imported = MultiKeyDictExtractor('key')
+            digest = True
+
+        with ShouldRaise(TypeError('digest cannot be used with an AsyncSession')):
+            TestDiff(AsyncSession(), [])
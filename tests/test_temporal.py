@@ -4,13 +4,15 @@ import pytest
 from mortar_mixins import Temporal
 from mortar_mixins.testing import create_tables_and_session
 from psycopg2.extras import DateTimeRange as R
-from sqlalchemy import Column, Integer
+from sqlalchemy import Column, Integer, event, select
 from sqlalchemy import String
+from sqlalchemy.engine import Row
 from sqlalchemy.ext.declarative import declarative_base
 from testfixtures import ShouldRaise, compare
 
 from mortar_import.extractors import MultiKeyDictExtractor, DictExtractor
-from mortar_import.temporal import TemporalDiff
+from mortar_import.diff import Counts
+from mortar_import.temporal import TemporalDiff, AsyncTemporalDiff
 
 Base = declarative_base()
 
@@ -252,3 +254,617 @@ class TestTemporal:
         ]
 
         compare(expected, actual)
+
+    def test_load_columns(self):
+        active = R(dt(2000, 1, 1), None)
+
+        self.session.add(Model(key='a', value=1, period=active))
+        self.session.add(Model(key='b', value=2, period=active))
+        self.session.add(Model(key='c', value=3, period=active))
+        self.session.flush()
+        self.session.expunge_all()
+
+        imported = [
+            dict(key='b', value=2, source=''),
+            dict(key='c', value=4, source=''),
+            dict(key='d', value=5, source=''),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            load_columns = True
+
+        diff = TestDiff(self.session, imported, dt(2001, 1, 1))
+
+        diff.compute()
+        compare(
+            [type(change.existing) for change in diff.to_update + diff.to_delete],
+            expected=[Row, Row],
+        )
+        diff.apply()
+
+        expected = [
+            dict(key='a', value=1, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='b', value=2, period=active),
+            dict(key='c', value=3, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='c', value=4, period=R(dt(2001, 1, 1), None)),
+            dict(key='d', value=5, period=R(dt(2001, 1, 1), None)),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value, period=o.period)
+            for o in self.session.query(Model).order_by('key', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_flush_every(self):
+        active = R(dt(2000, 1, 1), None)
+
+        self.session.add(Model(key='a', value=1, period=active))
+        self.session.add(Model(key='b', value=2, period=active))
+        self.session.add(Model(key='c', value=3, period=active))
+        self.session.flush()
+        self.session.expunge_all()
+
+        imported = [
+            dict(key='b', value=2, source=''),
+            dict(key='c', value=4, source=''),
+            dict(key='d', value=5, source=''),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            flush_every = 1
+
+        diff = TestDiff(self.session, imported, dt(2001, 1, 1))
+        compare(diff.apply(), expected=Counts(add=1, update=1, delete=1))
+
+        compare(diff.handled, expected=[])
+        compare(sorted(o.key for o in self.session), expected=[])
+        compare(
+            [(o.key, o.value, o.period)
+             for o in self.session.query(Model).order_by('key', 'period')],
+            expected=[
+                ('a', 1, R(dt(2000, 1, 1), dt(2001, 1, 1))),
+                ('b', 2, active),
+                ('c', 3, R(dt(2000, 1, 1), dt(2001, 1, 1))),
+                ('c', 4, R(dt(2001, 1, 1), None)),
+                ('d', 5, R(dt(2001, 1, 1), None)),
+            ]
+        )
+
+    def test_restrict_existing(self):
+        active = R(dt(2000, 1, 1), None)
+
+        self.session.add(Model(key='a', value=1, period=active))
+        self.session.add(Model(key='b', value=2, period=active))
+        self.session.add(Model(key='c', value=3, period=active))
+        self.session.add(Model(key='x', value=42, period=active, source='foo'))
+
+        imported = [
+            dict(key='b', value=2, source=''),
+            dict(key='c', value=4, source=''),
+            dict(key='d', value=5, source=''),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            restrict_existing = True
+
+            def deletion_scope(self):
+                return Model.source == ''
+
+        diff = TestDiff(self.session, imported, dt(2001, 1, 1))
+
+        diff.apply()
+
+        expected = [
+            dict(key='a', value=1, period=R(dt(2000, 1, 1), dt(2001, 1, 1)), source=''),
+            dict(key='b', value=2, period=active, source=''),
+            dict(key='c', value=3, period=R(dt(2000, 1, 1), dt(2001, 1, 1)), source=''),
+            dict(key='c', value=4, period=R(dt(2001, 1, 1), None), source=''),
+            dict(key='d', value=5, period=R(dt(2001, 1, 1), None), source=''),
+            dict(key='x', value=42, period=active, source='foo'),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value, period=o.period, source=o.source)
+            for o in self.session.query(Model).order_by('key', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_digest(self):
+        active = R(dt(2000, 1, 1), None)
+
+        self.session.add(Model(key='a', value=1, period=active))
+        self.session.add(Model(key='b', value=2, period=active))
+        self.session.add(Model(key='c', value=3, period=active))
+
+        imported = [
+            dict(key='b', value=2, source=''),
+            dict(key='c', value=4, source=''),
+            dict(key='d', value=5, source=''),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            digest = True
+
+        diff = TestDiff(self.session, imported, dt(2001, 1, 1))
+
+        diff.apply()
+
+        expected = [
+            dict(key='a', value=1, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='b', value=2, period=active),
+            dict(key='c', value=3, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='c', value=4, period=R(dt(2001, 1, 1), None)),
+            dict(key='d', value=5, period=R(dt(2001, 1, 1), None)),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value, period=o.period)
+            for o in self.session.query(Model).order_by('key', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_bulk(self):
+        past = R(None, dt(2000, 1, 1), bounds='()')
+        active = R(dt(2000, 1, 1), None)
+        future = R(dt(3000, 1, 1), None, bounds='()')
+
+        self.session.add(Model(key='a', value=1, period=active))
+        self.session.add(Model(key='b', value=2, period=active))
+        self.session.add(Model(key='c', value=3, period=active))
+        self.session.add(Model(key='e', value=6, period=past))
+        self.session.add(Model(key='e', value=7, period=R(dt(2000, 1, 1), dt(3000, 1, 1))))
+        self.session.add(Model(key='e', value=8, period=future))
+
+        imported = [
+            dict(key='b', value=2, source=''),
+            dict(key='c', value=4, source=''),
+            dict(key='d', value=5, source=''),
+            dict(key='e', value=9, source=''),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            bulk_add = bulk_update = bulk_delete = True
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if not statement.startswith('SELECT'):
+                statements.append(statement.split()[0])
+
+        diff = TestDiff(self.session, imported, dt(2001, 1, 1))
+        diff.compute()
+        event.listen(self.session.bind, 'before_cursor_execute', record)
+        try:
+            diff.apply()
+        finally:
+            event.remove(self.session.bind, 'before_cursor_execute', record)
+
+        compare(statements, expected=['UPDATE', 'UPDATE', 'INSERT', 'INSERT'])
+
+        self.session.expire_all()
+
+        expected = [
+            dict(key='a', value=1, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='b', value=2, period=active),
+            dict(key='c', value=3, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='c', value=4, period=R(dt(2001, 1, 1), None)),
+            dict(key='d', value=5, period=R(dt(2001, 1, 1), None)),
+            dict(key='e', value=6, period=past),
+            dict(key='e', value=7, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='e', value=9, period=R(dt(2001, 1, 1), dt(3000, 1, 1))),
+            dict(key='e', value=8, period=future),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value, period=o.period)
+            for o in self.session.query(Model).order_by('key', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_bulk_load_columns(self):
+        active = R(dt(2000, 1, 1), None)
+
+        self.session.add(Model(key='a', value=1, period=active))
+        self.session.add(Model(key='b', value=2, period=active))
+        self.session.flush()
+        self.session.expunge_all()
+
+        imported = [
+            dict(key='b', value=3, source=''),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            load_columns = True
+            bulk_update = bulk_delete = True
+
+        diff = TestDiff(self.session, imported, dt(2001, 1, 1))
+
+        diff.compute()
+        compare(
+            [type(change.existing) for change in diff.to_update + diff.to_delete],
+            expected=[Row, Row],
+        )
+        diff.apply()
+
+        expected = [
+            dict(key='a', value=1, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='b', value=2, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='b', value=3, period=R(dt(2001, 1, 1), None)),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value, period=o.period)
+            for o in self.session.query(Model).order_by('key', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_bulk_replace_exact_row(self):
+        active = R(dt(2000, 1, 1), dt(2001, 1, 1))
+
+        self.session.add(Model(key='a', value=1, period=active))
+        self.session.add(Model(key='b', value=2, period=R(dt(1999, 1, 1), None)))
+
+        imported = [
+            dict(key='a', value=2, source=''),
+            dict(key='b', value=3, source=''),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            bulk_update = True
+
+        diff = TestDiff(self.session, imported, dt(2000, 1, 1))
+
+        with ShouldRaise(ValueError(
+            "Replacing existing value for ('a', '') over "
+            "DateTimeRange(datetime.datetime(2000, 1, 1, 0, 0), "
+            "datetime.datetime(2001, 1, 1, 0, 0), '[)') would lose history. "
+            "Existing: {'key': 'a', 'source': '', 'value': 1}, "
+            "imported {'key': 'a', 'value': 2, 'source': ''}."
+        )):
+            diff.apply()
+
+        # nothing in the batch was applied:
+        compare(self.session.query(Model).count(), expected=2)
+
+    def test_bulk_replace_exact_row_loss_allowed(self):
+        active = R(dt(2000, 1, 1), dt(2001, 1, 1))
+
+        self.session.add(Model(key='a', value=1, period=active))
+        self.session.add(Model(key='b', value=2, period=R(dt(1999, 1, 1), None)))
+
+        imported = [
+            dict(key='a', value=2, source=''),
+            dict(key='b', value=3, source=''),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            replace = True
+            bulk_update = True
+
+        diff = TestDiff(self.session, imported, dt(2000, 1, 1))
+
+        diff.apply()
+        self.session.expire_all()
+
+        expected = [
+            dict(key='a', value=2, period=active),
+            dict(key='b', value=2, period=R(dt(1999, 1, 1), dt(2000, 1, 1))),
+            dict(key='b', value=3, period=R(dt(2000, 1, 1), None)),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value, period=o.period)
+            for o in self.session.query(Model).order_by('key', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_backfill(self):
+        active = R(dt(2000, 1, 1), None)
+
+        self.session.add(Model(key='a', value=1, period=active))
+        self.session.add(Model(key='b', value=2, period=active))
+        self.session.add(Model(key='x', value=42, period=R(dt(2000, 1, 1), dt(2001, 1, 1))))
+
+        snapshots = [
+            (dt(2001, 1, 1), [
+                dict(key='a', value=1, source=''),
+                dict(key='b', value=3, source=''),
+                dict(key='c', value=4, source=''),
+            ]),
+            (dt(2002, 1, 1), [
+                dict(key='a', value=1, source=''),
+                dict(key='b', value=3, source=''),
+            ]),
+            (dt(2003, 1, 1), [
+                dict(key='a', value=2, source=''),
+                dict(key='b', value=3, source=''),
+                dict(key='c', value=5, source=''),
+            ]),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if not statement.startswith('SELECT'):
+                statements.append(statement.split()[0])
+
+        event.listen(self.session.bind, 'before_cursor_execute', record)
+        try:
+            counts = TestDiff.backfill(self.session, snapshots)
+        finally:
+            event.remove(self.session.bind, 'before_cursor_execute', record)
+
+        compare(counts, expected=Counts(add=2, update=2, delete=1))
+        # the flush of the rows set up above, then the writes:
+        compare(statements, expected=['INSERT', 'UPDATE', 'INSERT', 'INSERT'])
+
+        expected = [
+            dict(key='a', value=1, period=R(dt(2000, 1, 1), dt(2003, 1, 1))),
+            dict(key='a', value=2, period=R(dt(2003, 1, 1), None)),
+            dict(key='b', value=2, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='b', value=3, period=R(dt(2001, 1, 1), None)),
+            dict(key='c', value=4, period=R(dt(2001, 1, 1), dt(2002, 1, 1))),
+            dict(key='c', value=5, period=R(dt(2003, 1, 1), None)),
+            dict(key='x', value=42, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value, period=o.period)
+            for o in self.session.query(Model).order_by('key', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_backfill_checkpoint(self):
+        self.session.add(Model(key='a', value=1, period=R(dt(2000, 1, 1), None)))
+
+        snapshots = [
+            (dt(2001, 1, 1), [dict(key='a', value=1, source='')]),
+            (dt(2002, 1, 1), [dict(key='a', value=2, source='')]),
+            (dt(2003, 1, 1), [dict(key='b', value=3, source='')]),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+
+        committed = []
+
+        def commit():
+            self.session.expire_all()
+            committed.append([
+                (o.key, o.value, o.period)
+                for o in self.session.query(Model).order_by('key', 'period')
+            ])
+
+        self.session.commit = commit
+
+        counts = TestDiff.backfill(self.session, snapshots, checkpoint=2)
+
+        compare(counts, expected=Counts(add=1, update=1, delete=1))
+        compare(committed, expected=[[
+            ('a', 1, R(dt(2000, 1, 1), dt(2002, 1, 1))),
+            ('a', 2, R(dt(2002, 1, 1), None)),
+        ]])
+
+        expected = [
+            dict(key='a', value=1, period=R(dt(2000, 1, 1), dt(2002, 1, 1))),
+            dict(key='a', value=2, period=R(dt(2002, 1, 1), dt(2003, 1, 1))),
+            dict(key='b', value=3, period=R(dt(2003, 1, 1), None)),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value, period=o.period)
+            for o in self.session.query(Model).order_by('key', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_backfill_replace(self):
+        self.session.add(Model(key='a', value=1, period=R(dt(2000, 1, 1), None)))
+
+        snapshots = [
+            (dt(2000, 1, 1), [dict(key='a', value=2, source='')]),
+            (dt(2001, 1, 1), [dict(key='a', value=3, source='')]),
+        ]
+
+        class TestDiff(TemporalDiff):
+            model = Model
+
+        with ShouldRaise(ValueError):
+            TestDiff.backfill(self.session, snapshots)
+
+        TestDiff.replace = True
+        TestDiff.backfill(self.session, snapshots)
+
+        expected = [
+            dict(key='a', value=2, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='a', value=3, period=R(dt(2001, 1, 1), None)),
+        ]
+
+        actual = [
+            dict(key=o.key, value=o.value, period=o.period)
+            for o in self.session.query(Model).order_by('key', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_backfill_out_of_order(self):
+
+        class TestDiff(TemporalDiff):
+            model = Model
+
+        with ShouldRaise(ValueError(
+            'Snapshots are not in order: '
+            'datetime.datetime(2001, 1, 1, 0, 0) follows '
+            'datetime.datetime(2002, 1, 1, 0, 0)'
+        )):
+            TestDiff.backfill(self.session, [(dt(2002, 1, 1), []), (dt(2001, 1, 1), [])])
+
+    def test_backfill_past_end_of_period(self):
+        self.session.add(Model(key='a', value=1, period=R(dt(2000, 1, 1), dt(2002, 1, 1))))
+
+        class TestDiff(TemporalDiff):
+            model = Model
+
+        snapshots = [
+            (dt(2001, 1, 1), [dict(key='a', value=1, source='')]),
+            (dt(2003, 1, 1), [dict(key='a', value=1, source='')]),
+        ]
+
+        with ShouldRaise(ValueError(
+            "The period for ('a', '') ends at datetime.datetime(2002, 1, 1, 0, 0), "
+            "before the snapshot at datetime.datetime(2003, 1, 1, 0, 0)"
+        )):
+            TestDiff.backfill(self.session, snapshots)
+
+    def add_runs(self):
+        for key, value, start, end in (
+            ('a', 1, 2000, 2001),
+            ('a', 1, 2001, 2002),
+            ('a', 2, 2002, 2003),
+            ('a', 2, 2003, 2004),
+            ('a', 2, 2004, None),
+            ('b', 1, 2000, 2001),
+            ('b', 1, 2002, None),
+            ('c', None, 2000, 2001),
+            ('c', None, 2001, None),
+        ):
+            self.session.add(Model(
+                key=key,
+                value=value,
+                period=R(dt(start, 1, 1), None if end is None else dt(end, 1, 1)),
+            ))
+        self.session.add(Model(key='a', source='x', value=2, period=R(dt(2001, 1, 1), None)))
+
+    def test_compact(self):
+        self.add_runs()
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            batch_size = 2
+
+        compare(
+            TestDiff.compact(self.session),
+            expected=Counts(add=0, update=3, delete=4)
+        )
+
+        expected = [
+            dict(key='a', source='', value=1, period=R(dt(2000, 1, 1), dt(2002, 1, 1))),
+            dict(key='a', source='', value=2, period=R(dt(2002, 1, 1), None)),
+            dict(key='a', source='x', value=2, period=R(dt(2001, 1, 1), None)),
+            dict(key='b', source='', value=1, period=R(dt(2000, 1, 1), dt(2001, 1, 1))),
+            dict(key='b', source='', value=1, period=R(dt(2002, 1, 1), None)),
+            dict(key='c', source='', value=None, period=R(dt(2000, 1, 1), None)),
+        ]
+
+        actual = [
+            dict(key=o.key, source=o.source, value=o.value, period=o.period)
+            for o in self.session.query(Model).order_by('key', 'source', 'period')
+        ]
+
+        compare(expected, actual)
+
+    def test_compact_dry_run(self):
+        self.add_runs()
+        self.session.flush()
+        before = self.session.query(Model).count()
+
+        class TestDiff(TemporalDiff):
+            model = Model
+
+        compare(
+            TestDiff.compact(self.session, dry_run=True),
+            expected=Counts(add=0, update=3, delete=4)
+        )
+        compare(self.session.query(Model).count(), expected=before)
+
+    def test_compact_scope_and_ignored_fields(self):
+        self.add_runs()
+
+        class TestDiff(TemporalDiff):
+            model = Model
+            ignore_fields = {'value'}
+
+        compare(
+            TestDiff.compact(self.session, scope=Model.key == 'a'),
+            expected=Counts(add=0, update=1, delete=4)
+        )
+
+        actual = [
+            (o.key, o.source, o.period)
+            for o in self.session.query(Model).order_by('key', 'source', 'period')
+        ]
+
+        compare(actual[:2], expected=[
+            ('a', '', R(dt(2000, 1, 1), None)),
+            ('a', 'x', R(dt(2001, 1, 1), None)),
+        ])
+        compare(len(actual), expected=6)
+
+
+class TestAsyncTemporal:
+
+    def check(self, run_async, bulk):
+        active = R(dt(2000, 1, 1), None)
+        past = R(None, dt(2000, 1, 1), bounds='()')
+
+        class TestDiff(AsyncTemporalDiff):
+            model = Model
+            bulk_add = bulk_update = bulk_delete = bulk
+
+        async def imported():
+            for key, value in ('b', 2), ('c', 4), ('d', 5):
+                yield dict(key=key, value=value, source='')
+
+        async def test(session):
+            session.add_all([
+                Model(key='a', value=1, period=active),
+                Model(key='b', value=2, period=active),
+                Model(key='c', value=3, period=active),
+                Model(key='x', value=42, period=past),
+            ])
+            await session.flush()
+            counts = await TestDiff(session, imported(), dt(2001, 1, 1)).apply()
+            result = await session.execute(
+                select(Model.key, Model.value, Model.period)
+                .order_by(Model.key, Model.period)
+            )
+            return counts, [
+                (key, value, period.lower, period.upper)
+                for key, value, period in result
+            ]
+
+        counts, rows = run_async(Base, test)
+        compare(counts, expected=Counts(add=1, update=1, delete=1))
+        compare(rows, expected=[
+            ('a', 1, dt(2000, 1, 1), dt(2001, 1, 1)),
+            ('b', 2, dt(2000, 1, 1), None),
+            ('c', 3, dt(2000, 1, 1), dt(2001, 1, 1)),
+            ('c', 4, dt(2001, 1, 1), None),
+            ('d', 5, dt(2001, 1, 1), None),
+            ('x', 42, None, dt(2000, 1, 1)),
+        ])
+
+    def test_normal_set(self, run_async):
+        self.check(run_async, bulk=False)
+
+    def test_bulk(self, run_async):
+        self.check(run_async, bulk=True)